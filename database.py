@@ -1,22 +1,54 @@
 from __future__ import annotations
 
+import gzip
+import json
+import logging
+import math
 import os
+import re
 import secrets
 import sqlite3
-from contextlib import closing
+import threading
+import time
+import zlib
+from collections import deque
+from contextlib import closing, contextmanager
 from dataclasses import dataclass
-from datetime import datetime
-from hashlib import pbkdf2_hmac
+from datetime import datetime, timedelta
+from hashlib import pbkdf2_hmac, sha256
 from pathlib import Path
-from typing import Iterable, List, Optional
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import metrics
 
 BASE_DIR = Path(__file__).resolve().parent
 DATA_DIR = BASE_DIR / "data"
 DB_PATH = DATA_DIR / "app.db"
 
-PASSWORD_ITERATIONS = 390000
+PASSWORD_ITERATIONS = int(os.getenv("PASSWORD_ITERATIONS", "390000"))
 SALT_BYTES = 16
 
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_STATEMENT_CACHE_SIZE = int(os.getenv("SQLITE_STATEMENT_CACHE_SIZE", "256"))
+DB_SLOW_QUERY_SECONDS = float(os.getenv("DB_SLOW_QUERY_SECONDS", "0"))
+SESSION_CACHE_TTL_SECONDS = float(os.getenv("SESSION_CACHE_TTL_SECONDS", "30"))
+SESSION_FLUSH_INTERVAL_SECONDS = float(os.getenv("SESSION_FLUSH_INTERVAL_SECONDS", "15"))
+UNLOCK_CACHE_TTL_SECONDS = float(os.getenv("UNLOCK_CACHE_TTL_SECONDS", "30"))
+BLOB_COMPRESSION_LEVEL = int(os.getenv("BLOB_COMPRESSION_LEVEL", "6"))
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", str(DATA_DIR / "archive")))
+RUN_RETENTION_DAYS = int(os.getenv("RUN_RETENTION_DAYS", "365"))
+SESSION_RETENTION_DAYS = int(os.getenv("SESSION_RETENTION_DAYS", "30"))
+RETENTION_CHUNK_SIZE = max(1, int(os.getenv("RETENTION_CHUNK_SIZE", "500")))
+RUN_LOG_QUEUE_SIZE = int(os.getenv("RUN_LOG_QUEUE_SIZE", "1000"))
+RUN_LOG_BATCH_SIZE = max(1, int(os.getenv("RUN_LOG_BATCH_SIZE", "100")))
+RUN_LOG_FLUSH_INTERVAL_SECONDS = float(os.getenv("RUN_LOG_FLUSH_INTERVAL_SECONDS", "0.2"))
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_query_stats: Dict[str, List[float]] = {}
+_query_stats_lock = threading.Lock()
+
 
 @dataclass
 class UserRecord:
@@ -25,6 +57,33 @@ class UserRecord:
     is_admin: bool
 
 
+# token -> (ユーザー情報, キャッシュの有効期限 [time.monotonic()])
+_session_cache: Dict[str, tuple[UserRecord, float]] = {}
+# token -> まだ DB に書いていない last_seen_at
+_pending_last_seen: Dict[str, str] = {}
+# ログアウトやユーザーの更新・削除でキャッシュを捨てるたびに増やす。DB を読んでいる間に
+# 捨てられたセッションを、読み終えた側がキャッシュへ戻してしまわないようにするため
+_session_generation = 0
+_session_lock = threading.Lock()
+_session_flusher: Optional[threading.Thread] = None
+_session_flusher_stop = threading.Event()
+
+# user_id -> (解除済み教材のビット集合 [bit n = 教材 n], DB から読んだ時刻 [time.monotonic()])
+_unlock_cache: Dict[int, tuple[int, float]] = {}
+_unlock_lock = threading.Lock()
+
+# 書き込み待ちの実行記録。ライターが取り出してからコミットするまでは _run_log_inflight に置く。
+_run_log_queue: deque = deque()
+_run_log_inflight: List[dict] = []
+_run_log_cond = threading.Condition()
+# ライターはバッチの INSERT〜コミット〜inflight の解放をこのロックの中で行う。
+# 未書き込み分を重ねて読むクエリも同じロックを取り、同じ実行を二重に数えないようにする。
+_run_log_commit_lock = threading.Lock()
+_run_log_stats = {"written": 0, "batches": 0, "overflow_writes": 0, "failed_batches": 0}
+_run_log_writer: Optional[threading.Thread] = None
+_run_log_stop = threading.Event()
+
+
 def _ensure_data_dir() -> None:
     """データベースファイルの保存先ディレクトリを作成する。"""
     DATA_DIR.mkdir(parents=True, exist_ok=True)
@@ -32,16 +91,100 @@ def _ensure_data_dir() -> None:
 
 def get_connection() -> sqlite3.Connection:
     """
-    SQLite への接続を返すヘルパー。フォルダ作成・外部キー有効化までをセットで行う。
-    呼び出し側は closing と組み合わせて安全に接続を閉じる。
+    SQLite への新しい接続を返すヘルパー。フォルダ作成・外部キー有効化に加えて、
+    WAL モード・synchronous=NORMAL・ビジータイムアウトなどの PRAGMA をまとめて設定する。
+
+    WAL にすることで読み取りと書き込みが互いを待たなくなり、
+    synchronous=NORMAL でコミットごとの fsync を減らしている。
     """
     _ensure_data_dir()
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=SQLITE_STATEMENT_CACHE_SIZE,
+    )
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON")
+    # 新規作成時のみ効く。既存のファイルは incremental_vacuum(convert=True) で VACUUM して切り替える
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+def _thread_connection() -> sqlite3.Connection:
+    """
+    スレッドごとに 1 本の接続を使い回す。sqlite3 の接続はスレッド間で共有できないため、
+    threading.local に保持し、fork 後の子プロセスや DB_PATH の変更時は作り直す。
+    """
+    key = (os.getpid(), str(DB_PATH))
+    conn: Optional[sqlite3.Connection] = getattr(_local, "connection", None)
+    if conn is not None and getattr(_local, "key", None) == key:
+        return conn
+    if conn is not None and _local.key[0] == key[0]:
+        conn.close()
+    conn = get_connection()
+    _local.connection = conn
+    _local.key = key
     return conn
 
 
+def close_thread_connection() -> None:
+    """現在のスレッドが保持している接続を閉じる (シャットダウン時やテスト用)。"""
+    conn: Optional[sqlite3.Connection] = getattr(_local, "connection", None)
+    if conn is not None and _local.key[0] == os.getpid():
+        conn.close()
+    _local.connection = None
+    _local.key = None
+
+
+_query_duration = metrics.histogram(
+    "db_query_duration_seconds",
+    "Time spent inside each database helper, including waits for SQLite locks",
+    ("helper",),
+    buckets=metrics.DB_BUCKETS,
+)
+
+
+def _record_query_time(name: str, elapsed: float) -> None:
+    _query_duration.observe(elapsed, name)
+    with _query_stats_lock:
+        stats = _query_stats.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+    if DB_SLOW_QUERY_SECONDS > 0 and elapsed >= DB_SLOW_QUERY_SECONDS:
+        logger.warning("slow query in %s: %.3fs", name, elapsed)
+
+
+def get_query_stats() -> Dict[str, Dict[str, float]]:
+    """ヘルパーごとのクエリ回数・合計時間・最大時間 (秒) を返す。診断用。"""
+    with _query_stats_lock:
+        return {
+            name: {"count": int(count), "total_seconds": total, "max_seconds": longest}
+            for name, (count, total, longest) in _query_stats.items()
+        }
+
+
+@contextmanager
+def _connection(name: str) -> Iterator[sqlite3.Connection]:
+    """
+    スレッドごとの接続を貸し出し、ブロック内のクエリ時間を name ごとに記録する。
+
+    コミットされずに残ったトランザクションは、以前の closing() と同じく破棄 (ロールバック) する。
+    """
+    conn = _thread_connection()
+    start = time.perf_counter()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        _record_query_time(name, time.perf_counter() - start)
+
+
 def hash_password(password: str, *, salt: Optional[bytes] = None) -> str:
     """
     PBKDF2-HMAC を使ってパスワードをハッシュ化する。ソルトと反復回数を含めて保存する。
@@ -54,6 +197,12 @@ def hash_password(password: str, *, salt: Optional[bytes] = None) -> str:
     return f"{PASSWORD_ITERATIONS}${salt.hex()}${dk.hex()}"
 
 
+def password_needs_rehash(stored_hash: str) -> bool:
+    """保存されたハッシュの反復回数が現在の PASSWORD_ITERATIONS と違えば True を返す。"""
+    iterations_str, _, _ = stored_hash.partition("$")
+    return iterations_str != str(PASSWORD_ITERATIONS)
+
+
 def verify_password(password: str, stored_hash: str) -> bool:
     """
     保存されたハッシュ文字列を解析し、入力パスワードと照合する。
@@ -70,57 +219,432 @@ def verify_password(password: str, stored_hash: str) -> bool:
     return secrets.compare_digest(candidate.hex(), hash_hex)
 
 
+def _ensure_column(conn: sqlite3.Connection, table: str, column: str, definition: str) -> None:
+    """既存のデータベースに後から追加した列が無ければ ALTER TABLE で追加する。"""
+    columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _blob_hash(text: Optional[str]) -> Optional[str]:
+    if text is None:
+        return None
+    return sha256(text.encode("utf-8")).hexdigest()
+
+
+def _store_blobs(conn: sqlite3.Connection, texts: Iterable[Optional[str]]) -> None:
+    """
+    コードや出力の本文を内容のハッシュをキーに blobs へ zlib 圧縮して保存する。
+    (圧縮したものは BLOB、短くて圧縮が効かないものは TEXT のまま data に入る。)
+    同じ本文 (教材の例題をそのまま実行した場合など) は 1 行だけになり、
+    既にある本文は圧縮もしない。
+
+    「既にあるか」の確認から呼び出し側のコミットまでを 1 つの書き込みトランザクションにする。
+    確認を自動コミットで読むと、その直後に delete_unreferenced_blobs が同じ本文を
+    消してしまい、存在しないハッシュを指す実行記録をコミットしうるため。
+    """
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    unique = {_blob_hash(text): text for text in texts if text is not None}
+    if not unique:
+        return
+    hashes = list(unique)
+    existing = set()
+    # SQLite のパラメータ数の上限に掛からないよう分けて問い合わせる
+    for start in range(0, len(hashes), 500):
+        chunk = hashes[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        existing.update(
+            row[0] for row in conn.execute(f"SELECT hash FROM blobs WHERE hash IN ({placeholders})", chunk)
+        )
+    rows = []
+    for digest in hashes:
+        if digest in existing:
+            continue
+        text = unique[digest]
+        raw = text.encode("utf-8")
+        compressed = zlib.compress(raw, BLOB_COMPRESSION_LEVEL)
+        # 短い本文は圧縮すると逆に大きくなるので、その場合は TEXT のまま保存する
+        rows.append((digest, len(raw), compressed if len(compressed) < len(raw) else text))
+    conn.executemany("INSERT OR IGNORE INTO blobs (hash, size, data) VALUES (?, ?, ?)", rows)
+
+
+def _blob_text(data: Optional[bytes | str]) -> Optional[str]:
+    if data is None or isinstance(data, str):
+        return data
+    return zlib.decompress(data).decode("utf-8")
+
+
+# program_runs の本文列を blobs から復元して読むための SELECT 句と JOIN
+_PROGRAM_RUN_TEXT_COLUMNS = "code_blob.data AS code, stdout_blob.data AS stdout, stderr_blob.data AS stderr"
+_PROGRAM_RUN_TEXT_JOINS = (
+    "LEFT JOIN blobs AS code_blob ON code_blob.hash = program_runs.code_hash "
+    "LEFT JOIN blobs AS stdout_blob ON stdout_blob.hash = program_runs.stdout_hash "
+    "LEFT JOIN blobs AS stderr_blob ON stderr_blob.hash = program_runs.stderr_hash"
+)
+
+
+# blobs の行を参照している実行が 1 つもないことを表す条件。各列のインデックスで引ける
+_BLOB_UNREFERENCED = (
+    "NOT EXISTS (SELECT 1 FROM program_runs WHERE code_hash = blobs.hash) "
+    "AND NOT EXISTS (SELECT 1 FROM program_runs WHERE stdout_hash = blobs.hash) "
+    "AND NOT EXISTS (SELECT 1 FROM program_runs WHERE stderr_hash = blobs.hash)"
+)
+
+
+def _program_run_from_row(row: sqlite3.Row) -> dict:
+    run = dict(row)
+    for key in ("code", "stdout", "stderr"):
+        run[key] = _blob_text(run[key])
+    if "timings" in run:
+        run["timings"] = json.loads(run["timings"]) if run["timings"] else None
+    return run
+
+
+def _migrate_base_tables(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            is_admin INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS program_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            code TEXT NOT NULL,
+            stdout TEXT,
+            stderr TEXT,
+            success INTEGER NOT NULL,
+            execution_time REAL NOT NULL DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS unlocks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            material_id INTEGER NOT NULL,
+            unlocked_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, material_id),
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            token TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            last_seen_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """
+    )
+
+
+def _migrate_program_run_cached_flag(conn: sqlite3.Connection) -> None:
+    _ensure_column(conn, "program_runs", "cached", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _migrate_hot_query_indexes(conn: sqlite3.Connection) -> None:
+    # 履歴表示とレート制限の復元はユーザーごと・時刻順に読むので (user_id, created_at) で引く。
+    # unlocks(user_id) は UNIQUE(user_id, material_id) の自動インデックスで足りる。
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_program_runs_user_created ON program_runs (user_id, created_at)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_program_runs_created ON program_runs (created_at)")
+    # ユーザー削除時の ON DELETE CASCADE が sessions を全件走査しないようにする
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)")
+
+
+def _migrate_program_run_blobs(conn: sqlite3.Connection) -> None:
+    """
+    program_runs の code/stdout/stderr を blobs へ移し、各行はハッシュだけを持つようにする。
+    列を削除できるよう新しいテーブルへ詰め替えてから差し替える。
+    空いた領域をファイルから返すには別途 VACUUM が必要。
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            data NOT NULL
+        ) WITHOUT ROWID
+        """
+    )
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(program_runs)")}
+    if "code_hash" in columns:
+        return
+    conn.execute("DROP TABLE IF EXISTS program_runs_new")
+    conn.execute(
+        """
+        CREATE TABLE program_runs_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            code_hash TEXT NOT NULL,
+            stdout_hash TEXT,
+            stderr_hash TEXT,
+            success INTEGER NOT NULL,
+            execution_time REAL NOT NULL DEFAULT 0,
+            cached INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """
+    )
+    cursor = conn.execute(
+        "SELECT id, user_id, code, stdout, stderr, success, execution_time, cached, created_at "
+        "FROM program_runs ORDER BY id"
+    )
+    while True:
+        rows = cursor.fetchmany(500)
+        if not rows:
+            break
+        _store_blobs(conn, (row[key] for row in rows for key in ("code", "stdout", "stderr")))
+        conn.executemany(
+            """
+            INSERT INTO program_runs_new
+                (id, user_id, code_hash, stdout_hash, stderr_hash, success, execution_time, cached, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    row["id"],
+                    row["user_id"],
+                    _blob_hash(row["code"]),
+                    _blob_hash(row["stdout"]),
+                    _blob_hash(row["stderr"]),
+                    row["success"],
+                    row["execution_time"],
+                    row["cached"],
+                    row["created_at"],
+                )
+                for row in rows
+            ],
+        )
+    conn.execute("DROP TABLE program_runs")
+    conn.execute("ALTER TABLE program_runs_new RENAME TO program_runs")
+    _migrate_hot_query_indexes(conn)
+
+
+def _migrate_program_run_timings(conn: sqlite3.Connection) -> None:
+    # サンドボックス内の段階ごとの所要時間 (秒) を JSON で持つ。計測していない実行は NULL
+    _ensure_column(conn, "program_runs", "timings", "TEXT")
+
+
+def _migrate_blob_reference_indexes(conn: sqlite3.Connection) -> None:
+    # 不要になった blobs を探すとき、ハッシュごとに参照している実行があるかをインデックスで引く
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_program_runs_code_hash ON program_runs (code_hash)")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_program_runs_stdout_hash ON program_runs (stdout_hash) "
+        "WHERE stdout_hash IS NOT NULL"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_program_runs_stderr_hash ON program_runs (stderr_hash) "
+        "WHERE stderr_hash IS NOT NULL"
+    )
+
+
+def _migrate_activity_summaries(conn: sqlite3.Connection) -> None:
+    """
+    管理画面の集計用に、ユーザー別・日別・教材別の集計テーブルを作って既存の記録から埋める。
+    retention で ARCHIVE_DIR へ移した実行記録も含める (既定の rebuild-stats と同じ)。
+    以後は実行記録や解除の書き込みと同じトランザクションで少しずつ更新する。
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_activity (
+            user_id INTEGER PRIMARY KEY,
+            runs INTEGER NOT NULL DEFAULT 0,
+            successes INTEGER NOT NULL DEFAULT 0,
+            cached_runs INTEGER NOT NULL DEFAULT 0,
+            cpu_seconds REAL NOT NULL DEFAULT 0,
+            first_run_at TEXT,
+            last_run_at TEXT,
+            unlocks INTEGER NOT NULL DEFAULT 0,
+            last_unlocked_at TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS daily_activity (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            runs INTEGER NOT NULL DEFAULT 0,
+            successes INTEGER NOT NULL DEFAULT 0,
+            cached_runs INTEGER NOT NULL DEFAULT 0,
+            cpu_seconds REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day),
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+        """
+    )
+    # 全員分の日別推移は day の範囲で引く
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_daily_activity_day ON daily_activity (day)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS material_activity (
+            material_id INTEGER PRIMARY KEY,
+            unlocks INTEGER NOT NULL DEFAULT 0,
+            first_unlocked_at TEXT,
+            last_unlocked_at TEXT
+        )
+        """
+    )
+    archived_users, archived_days, archived_runs = _summarize_archived_runs(conn, ARCHIVE_DIR)
+    _rebuild_activity_summaries(conn, (archived_users, archived_days))
+    if archived_runs:
+        logger.info("included %d archived program runs in activity summaries", archived_runs)
+
+
+# (バージョン, 説明, 適用関数)。適用済みのバージョンは PRAGMA user_version に記録する。
+# 既存のデータベースにも安全に流せるよう、各マイグレーションは冪等に書く。
+SCHEMA_MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "create base tables", _migrate_base_tables),
+    (2, "add program_runs.cached", _migrate_program_run_cached_flag),
+    (3, "index program_runs and sessions for hot queries", _migrate_hot_query_indexes),
+    (4, "move program_runs text into compressed blobs", _migrate_program_run_blobs),
+    (5, "add per-user, per-day and per-material activity summaries", _migrate_activity_summaries),
+    (6, "add program_runs.timings", _migrate_program_run_timings),
+    (7, "index program_runs blob hashes", _migrate_blob_reference_indexes),
+]
+
+
+def get_schema_version() -> int:
+    with _connection("get_schema_version") as conn:
+        return int(conn.execute("PRAGMA user_version").fetchone()[0])
+
+
+def migrate() -> List[Tuple[int, str]]:
+    """
+    未適用のマイグレーションを番号順に 1 つずつトランザクション内で適用し、
+    適用したものを返す。複数のワーカーが同時に起動しても二重に流れないよう、
+    BEGIN IMMEDIATE で書き込みロックを取ってからバージョンを確認する。
+    """
+    applied: List[Tuple[int, str]] = []
+    with _connection("migrate") as conn:
+        for version, description, apply in SCHEMA_MIGRATIONS:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                current = int(conn.execute("PRAGMA user_version").fetchone()[0])
+                if current >= version:
+                    conn.rollback()
+                    continue
+                apply(conn)
+                conn.execute(f"PRAGMA user_version = {int(version)}")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            applied.append((version, description))
+            logger.info("applied schema migration %d: %s", version, description)
+    return applied
+
+
+# 本番で頻繁に実行されるクエリ。check_query_plans でテーブル全走査になっていないか確認する。
+HOT_QUERIES: List[Tuple[str, str, tuple]] = [
+    (
+        "get_user_by_token",
+        "SELECT users.id, users.username, users.is_admin FROM sessions "
+        "JOIN users ON sessions.user_id = users.id WHERE sessions.token = ?",
+        ("token",),
+    ),
+    (
+        "list_program_runs_by_user_id",
+        f"SELECT program_runs.id, {_PROGRAM_RUN_TEXT_COLUMNS}, success, execution_time, cached, "
+        f"program_runs.created_at FROM program_runs {_PROGRAM_RUN_TEXT_JOINS} "
+        "WHERE user_id = ? ORDER BY program_runs.created_at DESC, program_runs.id DESC LIMIT ?",
+        (1, 20),
+    ),
+    (
+        "list_program_runs_by_user_id (before)",
+        f"SELECT program_runs.id, {_PROGRAM_RUN_TEXT_COLUMNS}, success, execution_time, cached, "
+        f"program_runs.created_at FROM program_runs {_PROGRAM_RUN_TEXT_JOINS} "
+        "WHERE user_id = ? AND (program_runs.created_at, program_runs.id) < (?, ?) "
+        "ORDER BY program_runs.created_at DESC, program_runs.id DESC LIMIT ?",
+        (1, "2024-01-01 00:00:00", 1, 20),
+    ),
+    (
+        "get_last_program_run_time",
+        "SELECT created_at FROM program_runs WHERE user_id = ? ORDER BY created_at DESC LIMIT 1",
+        (1,),
+    ),
+    (
+        "get_execution_time_since",
+        "SELECT COALESCE(SUM(execution_time), 0) AS total FROM program_runs "
+        "WHERE user_id = ? AND cached = 0 AND created_at >= datetime('now', ?)",
+        (1, "-60 seconds"),
+    ),
+    (
+        "list_recent_program_runs",
+        "SELECT user_id, execution_time, cached, created_at FROM program_runs "
+        "WHERE created_at >= datetime('now', ?) ORDER BY created_at",
+        ("-60 seconds",),
+    ),
+    ("load_user_unlocks", "SELECT material_id FROM unlocks WHERE user_id = ?", (1,)),
+    (
+        "delete_unreferenced_blobs",
+        f"SELECT hash FROM blobs WHERE hash IN (?) AND {_BLOB_UNREFERENCED}",
+        ("0" * 64,),
+    ),
+    ("delete_user_sessions", "SELECT token FROM sessions WHERE user_id = ?", (1,)),
+    (
+        "get_activity_overview",
+        "SELECT day, COUNT(*) AS active_users, SUM(runs) AS runs FROM daily_activity "
+        "WHERE day >= ? GROUP BY day ORDER BY day",
+        ("2024-01-01",),
+    ),
+    (
+        "get_user_activity",
+        "SELECT day, runs, successes, cached_runs, cpu_seconds FROM daily_activity "
+        "WHERE user_id = ? AND day >= ? ORDER BY day",
+        (1, "2024-01-01"),
+    ),
+]
+
+# "SCAN t" も "SCAN t USING INDEX i" (インデックス順の全件走査) も全走査として扱う
+_FULL_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW)\w+")
+
+
+def check_query_plans() -> List[str]:
+    """
+    HOT_QUERIES を EXPLAIN QUERY PLAN にかけ、インデックスを使わずにテーブルを
+    全走査しているクエリを「名前: プランの行」の形で返す。空なら問題なし。
+    """
+    problems: List[str] = []
+    # EXPLAIN はスキーマの変更を検知しないため、文キャッシュを持つ共有接続ではなく新しい接続で調べる
+    with closing(get_connection()) as conn:
+        for name, sql, params in HOT_QUERIES:
+            for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+                detail = row["detail"]
+                if _FULL_SCAN.match(detail):
+                    problems.append(f"{name}: {detail}")
+    return problems
+
+
 def init_db() -> None:
     """
-    データベースを初期化し、必要なテーブルが無ければ作成する。
+    データベースを初期化し、未適用のスキーママイグレーションを流す。
 
     初回起動時にはデフォルト管理者 (admin/admin) を登録して、
     管理画面に入れる最低限のアカウントを用意する。
     """
     _ensure_data_dir()
-    with closing(get_connection()) as conn:
-        conn.executescript(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                is_admin INTEGER NOT NULL DEFAULT 0,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            );
-
-            CREATE TABLE IF NOT EXISTS program_runs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                code TEXT NOT NULL,
-                stdout TEXT,
-                stderr TEXT,
-                success INTEGER NOT NULL,
-                execution_time REAL NOT NULL DEFAULT 0,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-            );
-
-            CREATE TABLE IF NOT EXISTS unlocks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                material_id INTEGER NOT NULL,
-                unlocked_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user_id, material_id),
-                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-            );
-
-            CREATE TABLE IF NOT EXISTS sessions (
-                token TEXT PRIMARY KEY,
-                user_id INTEGER NOT NULL,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                last_seen_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-            );
-            """
-        )
-        conn.commit()
-
+    migrate()
+    with _connection("init_db") as conn:
         existing_admin = conn.execute(
             "SELECT id FROM users WHERE username = ?", ("admin",)
         ).fetchone()
@@ -134,7 +658,7 @@ def init_db() -> None:
 
 
 def get_user_by_username(username: str) -> Optional[UserRecord]:
-    with closing(get_connection()) as conn:
+    with _connection("get_user_by_username") as conn:
         row = conn.execute(
             "SELECT id, username, is_admin FROM users WHERE username = ?",
             (username,),
@@ -146,7 +670,7 @@ def get_user_by_username(username: str) -> Optional[UserRecord]:
 
 def fetch_user_credentials(username: str) -> Optional[sqlite3.Row]:
     """ログイン時の認証用に、ハッシュされたパスワードを含む行を取得する。"""
-    with closing(get_connection()) as conn:
+    with _connection("fetch_user_credentials") as conn:
         return conn.execute(
             "SELECT id, username, password_hash, is_admin FROM users WHERE username = ?",
             (username,),
@@ -159,7 +683,7 @@ def create_user(username: str, password: str, *, is_admin: bool = False) -> int:
     一意制約エラーなどを適切な HTTP 応答に変換する前提となっている。
     """
     password_hash = hash_password(password)
-    with closing(get_connection()) as conn:
+    with _connection("create_user") as conn:
         cursor = conn.execute(
             "INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)",
             (username, password_hash, 1 if is_admin else 0),
@@ -168,6 +692,44 @@ def create_user(username: str, password: str, *, is_admin: bool = False) -> int:
         return cursor.lastrowid
 
 
+def create_users_bulk(
+    users: Iterable[dict], *, atomic: bool = False
+) -> List[Tuple[Optional[int], Optional[str]]]:
+    """
+    ハッシュ済みの password_hash を持つユーザー (username, password_hash, is_admin) を
+    1 トランザクションでまとめて追加する。行ごとに (ユーザーID, None) か (None, エラー内容) を返す。
+    atomic なら 1 行でも失敗したときに全体を取り消す。
+    """
+    results: List[Tuple[Optional[int], Optional[str]]] = []
+    with _connection("create_users_bulk") as conn:
+        conn.execute("BEGIN")
+        for user in users:
+            try:
+                cursor = conn.execute(
+                    "INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)",
+                    (user["username"], user["password_hash"], 1 if user.get("is_admin") else 0),
+                )
+            except sqlite3.IntegrityError:
+                results.append((None, f"username '{user['username']}' already exists"))
+            else:
+                results.append((cursor.lastrowid, None))
+        if atomic and any(error is not None for _, error in results):
+            conn.rollback()
+            return [(None, error or "rolled back") for _, error in results]
+        conn.commit()
+    return results
+
+
+def export_users(*, include_password_hash: bool = False) -> List[dict]:
+    """名簿の書き出し用に全ユーザーを返す。include_password_hash なら再取り込みできるようハッシュも含める。"""
+    columns = "id, username, is_admin, created_at"
+    if include_password_hash:
+        columns += ", password_hash"
+    with _connection("export_users") as conn:
+        rows = conn.execute(f"SELECT {columns} FROM users ORDER BY id").fetchall()
+    return [{**dict(row), "is_admin": bool(row["is_admin"])} for row in rows]
+
+
 def update_user(
     user_id: int,
     *,
@@ -194,19 +756,32 @@ def update_user(
     if not updates:
         return False
     params.append(user_id)
-    with closing(get_connection()) as conn:
+    with _connection("update_user") as conn:
         cursor = conn.execute(
             f"UPDATE users SET {', '.join(updates)} WHERE id = ?",
             tuple(params),
         )
         conn.commit()
-        return cursor.rowcount > 0
+    invalidate_user_sessions(user_id=user_id)
+    with _unlock_lock:
+        _unlock_cache.pop(user_id, None)
+    return cursor.rowcount > 0
+
+
+def set_user_password_hash(user_id: int, password_hash: str) -> None:
+    """
+    ハッシュ済みのパスワードをそのまま保存する。ログイン時に反復回数を更新するための
+    書き直しで、パスワード自体は変わらないのでセッションは無効にしない。
+    """
+    with _connection("set_user_password_hash") as conn:
+        conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
+        conn.commit()
 
 
 def update_user_password(username: str, password: str) -> bool:
     """ユーザー名をキーにパスワードだけを更新する簡易ヘルパー。"""
     password_hash = hash_password(password)
-    with closing(get_connection()) as conn:
+    with _connection("update_user_password") as conn:
         cursor = conn.execute(
             "UPDATE users SET password_hash = ? WHERE username = ?",
             (password_hash, username),
@@ -217,22 +792,26 @@ def update_user_password(username: str, password: str) -> bool:
 
 def delete_user(username: str) -> bool:
     """ユーザー名指定でレコードを削除し、成功可否を返す。"""
-    with closing(get_connection()) as conn:
+    with _connection("delete_user") as conn:
+        _forget_user_unlock_activity(conn, "SELECT id FROM users WHERE username = ?", username)
         cursor = conn.execute("DELETE FROM users WHERE username = ?", (username,))
         conn.commit()
-        return cursor.rowcount > 0
+    invalidate_user_sessions(username=username)
+    return cursor.rowcount > 0
 
 
 def delete_user_by_id(user_id: int) -> bool:
     """ユーザーID指定でレコードを削除し、成功可否を返す。"""
-    with closing(get_connection()) as conn:
+    with _connection("delete_user_by_id") as conn:
+        _forget_user_unlock_activity(conn, "?", user_id)
         cursor = conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
         conn.commit()
-        return cursor.rowcount > 0
+    invalidate_user_sessions(user_id=user_id)
+    return cursor.rowcount > 0
 
 
 def list_users() -> List[dict]:
-    with closing(get_connection()) as conn:
+    with _connection("list_users") as conn:
         rows = conn.execute(
             "SELECT id, username, is_admin, created_at FROM users ORDER BY id"
         ).fetchall()
@@ -241,7 +820,7 @@ def list_users() -> List[dict]:
 
 def create_session(user_id: int) -> str:
     token = secrets.token_hex(32)
-    with closing(get_connection()) as conn:
+    with _connection("create_session") as conn:
         conn.execute(
             "INSERT INTO sessions (token, user_id) VALUES (?, ?)",
             (token, user_id),
@@ -251,13 +830,49 @@ def create_session(user_id: int) -> str:
 
 
 def delete_session(token: str) -> None:
-    with closing(get_connection()) as conn:
+    global _session_generation
+    with _connection("delete_session") as conn:
         conn.execute("DELETE FROM sessions WHERE token = ?", (token,))
         conn.commit()
+    # 行を消してから捨てる。先に捨てると、その間に DB を読んだ get_user_by_token がキャッシュし直せる
+    with _session_lock:
+        _session_cache.pop(token, None)
+        _pending_last_seen.pop(token, None)
+        _session_generation += 1
+
+
+def invalidate_user_sessions(*, user_id: Optional[int] = None, username: Optional[str] = None) -> None:
+    """ユーザーの更新・削除をコミットした後に、そのユーザーのセッションキャッシュを捨てる。"""
+    global _session_generation
+    with _session_lock:
+        _session_generation += 1
+        stale = [
+            token
+            for token, (user, _) in _session_cache.items()
+            if user.id == user_id or (username is not None and user.username == username)
+        ]
+        for token in stale:
+            del _session_cache[token]
 
 
 def get_user_by_token(token: str) -> Optional[UserRecord]:
-    with closing(get_connection()) as conn:
+    """
+    トークンからユーザーを引く。結果は SESSION_CACHE_TTL_SECONDS の間メモリに保持し、
+    last_seen_at の更新は _pending_last_seen に溜めて flush_session_activity でまとめて書く。
+
+    キャッシュを捨てるのはこのプロセスの中だけなので、別プロセス (他のワーカーや CLI) での
+    ログアウトやユーザーの更新・削除は、期限が切れて DB を読み直すまで最大
+    SESSION_CACHE_TTL_SECONDS 秒遅れて反映される。
+    """
+    now = time.monotonic()
+    seen_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    with _session_lock:
+        cached = _session_cache.get(token)
+        if cached is not None and cached[1] > now:
+            _pending_last_seen[token] = seen_at
+            return cached[0]
+        generation = _session_generation
+    with _connection("get_user_by_token") as conn:
         row = conn.execute(
             """
             SELECT users.id, users.username, users.is_admin
@@ -267,14 +882,313 @@ def get_user_by_token(token: str) -> Optional[UserRecord]:
             """,
             (token,),
         ).fetchone()
-        if row is None:
-            return None
-        conn.execute(
-            "UPDATE sessions SET last_seen_at = CURRENT_TIMESTAMP WHERE token = ?",
-            (token,),
+    if row is None:
+        return None
+    user = UserRecord(id=row["id"], username=row["username"], is_admin=bool(row["is_admin"]))
+    with _session_lock:
+        # 読んでいる間にキャッシュが捨てられていたら、読んだ結果は古いかもしれないのでキャッシュしない
+        if SESSION_CACHE_TTL_SECONDS > 0 and generation == _session_generation:
+            _session_cache[token] = (user, now + SESSION_CACHE_TTL_SECONDS)
+        _pending_last_seen[token] = seen_at
+    return user
+
+
+def flush_session_activity() -> int:
+    """
+    溜まっている last_seen_at の更新を 1 トランザクションで書き込み、件数を返す。
+    あわせて期限切れのセッションキャッシュを掃除する。
+    """
+    now = time.monotonic()
+    with _session_lock:
+        pending = list(_pending_last_seen.items())
+        _pending_last_seen.clear()
+        for token in [token for token, (_, expires) in _session_cache.items() if expires <= now]:
+            del _session_cache[token]
+    if not pending:
+        return 0
+    with _connection("flush_session_activity") as conn:
+        conn.executemany(
+            "UPDATE sessions SET last_seen_at = ? WHERE token = ?",
+            [(seen_at, token) for token, seen_at in pending],
         )
         conn.commit()
-        return UserRecord(id=row["id"], username=row["username"], is_admin=bool(row["is_admin"]))
+    return len(pending)
+
+
+def _session_flusher_loop(interval: float) -> None:
+    while not _session_flusher_stop.wait(interval):
+        try:
+            flush_session_activity()
+        except sqlite3.Error:
+            logger.exception("failed to flush session activity")
+    flush_session_activity()
+    close_thread_connection()
+
+
+def start_session_activity_flusher(interval: float = SESSION_FLUSH_INTERVAL_SECONDS) -> None:
+    """last_seen_at を定期的に書き込むバックグラウンドスレッドを起動する。"""
+    global _session_flusher
+    if _session_flusher is not None and _session_flusher.is_alive():
+        return
+    _session_flusher_stop.clear()
+    _session_flusher = threading.Thread(
+        target=_session_flusher_loop, args=(interval,), name="session-flusher", daemon=True
+    )
+    _session_flusher.start()
+
+
+def stop_session_activity_flusher() -> None:
+    """スレッドを止め、残っている last_seen_at を書き込んでから戻る。"""
+    global _session_flusher
+    _session_flusher_stop.set()
+    if _session_flusher is not None:
+        _session_flusher.join()
+        _session_flusher = None
+    else:
+        flush_session_activity()
+
+
+def _summarize_runs(runs: Iterable[dict], users: Dict[int, list], days: Dict[Tuple[int, str], list]) -> None:
+    """
+    実行記録を users (ユーザー別) と days ((ユーザー, 日) 別) に集計して足し込む。
+    日は created_at と同じ UTC で区切る。cpu_seconds はキャッシュから返した実行を含めない。
+    """
+    for run in runs:
+        success = 1 if run["success"] else 0
+        cached = 1 if run["cached"] else 0
+        cpu = 0.0 if cached else float(run["execution_time"] or 0.0)
+        created_at = str(run["created_at"])
+        user = users.get(run["user_id"])
+        if user is None:
+            users[run["user_id"]] = [1, success, cached, cpu, created_at, created_at]
+        else:
+            user[0] += 1
+            user[1] += success
+            user[2] += cached
+            user[3] += cpu
+            user[4] = min(user[4], created_at)
+            user[5] = max(user[5], created_at)
+        day = days.setdefault((run["user_id"], created_at[:10]), [0, 0, 0, 0.0])
+        day[0] += 1
+        day[1] += success
+        day[2] += cached
+        day[3] += cpu
+
+
+def _write_run_activity(conn: sqlite3.Connection, users: Dict[int, list], days: Dict[Tuple[int, str], list]) -> None:
+    if not users:
+        return
+    conn.executemany(
+        """
+        INSERT INTO user_activity (user_id, runs, successes, cached_runs, cpu_seconds, first_run_at, last_run_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            runs = runs + excluded.runs,
+            successes = successes + excluded.successes,
+            cached_runs = cached_runs + excluded.cached_runs,
+            cpu_seconds = cpu_seconds + excluded.cpu_seconds,
+            first_run_at = COALESCE(MIN(first_run_at, excluded.first_run_at), excluded.first_run_at),
+            last_run_at = COALESCE(MAX(last_run_at, excluded.last_run_at), excluded.last_run_at)
+        """,
+        [(user_id, *values) for user_id, values in users.items()],
+    )
+    conn.executemany(
+        """
+        INSERT INTO daily_activity (user_id, day, runs, successes, cached_runs, cpu_seconds)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            runs = runs + excluded.runs,
+            successes = successes + excluded.successes,
+            cached_runs = cached_runs + excluded.cached_runs,
+            cpu_seconds = cpu_seconds + excluded.cpu_seconds
+        """,
+        [(user_id, day, *values) for (user_id, day), values in days.items()],
+    )
+
+
+def _add_run_activity(conn: sqlite3.Connection, runs: Iterable[dict]) -> None:
+    """
+    実行記録を user_activity と daily_activity に足し込む。バッチ内で (ユーザー, 日) ごとに
+    まとめてから UPSERT するので、書き込む行数は実行数ではなく関わったユーザーと日の数で済む。
+    """
+    users: Dict[int, list] = {}
+    days: Dict[Tuple[int, str], list] = {}
+    _summarize_runs(runs, users, days)
+    _write_run_activity(conn, users, days)
+
+
+def _add_unlock_activity(conn: sqlite3.Connection, unlocks: List[Tuple[int, int]], unlocked_at: str) -> None:
+    """新しく入った (user_id, material_id) の解除を user_activity と material_activity に足し込む。"""
+    if not unlocks:
+        return
+    per_user: Dict[int, int] = {}
+    per_material: Dict[int, int] = {}
+    for user_id, material_id in unlocks:
+        per_user[user_id] = per_user.get(user_id, 0) + 1
+        per_material[material_id] = per_material.get(material_id, 0) + 1
+    conn.executemany(
+        """
+        INSERT INTO user_activity (user_id, unlocks, last_unlocked_at) VALUES (?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            unlocks = unlocks + excluded.unlocks,
+            last_unlocked_at = COALESCE(MAX(last_unlocked_at, excluded.last_unlocked_at), excluded.last_unlocked_at)
+        """,
+        [(user_id, count, unlocked_at) for user_id, count in per_user.items()],
+    )
+    conn.executemany(
+        """
+        INSERT INTO material_activity (material_id, unlocks, first_unlocked_at, last_unlocked_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (material_id) DO UPDATE SET
+            unlocks = unlocks + excluded.unlocks,
+            first_unlocked_at = COALESCE(MIN(first_unlocked_at, excluded.first_unlocked_at), excluded.first_unlocked_at),
+            last_unlocked_at = COALESCE(MAX(last_unlocked_at, excluded.last_unlocked_at), excluded.last_unlocked_at)
+        """,
+        [(material_id, count, unlocked_at, unlocked_at) for material_id, count in per_material.items()],
+    )
+
+
+def _forget_user_unlock_activity(conn: sqlite3.Connection, user_id_sql: str, param: object) -> None:
+    """
+    削除するユーザーの解除を material_activity から引く。user_activity と daily_activity は
+    外部キーの ON DELETE CASCADE で消えるが、教材別の件数は自分で戻す必要がある。
+    """
+    conn.execute(
+        "UPDATE material_activity SET unlocks = unlocks - 1 "
+        f"WHERE material_id IN (SELECT material_id FROM unlocks WHERE user_id = ({user_id_sql}))",
+        (param,),
+    )
+
+
+def _rebuild_activity_summaries(
+    conn: sqlite3.Connection,
+    archived: Optional[Tuple[Dict[int, list], Dict[Tuple[int, str], list]]] = None,
+) -> None:
+    """
+    集計テーブルを program_runs と unlocks から作り直す。archived に _summarize_runs で
+    集計済みのアーカイブ分を渡すと、それも足し込む。トランザクションは呼び出し側が持つ。
+    """
+    conn.execute("DELETE FROM user_activity")
+    conn.execute("DELETE FROM daily_activity")
+    conn.execute("DELETE FROM material_activity")
+    conn.execute(
+        """
+        INSERT INTO user_activity (user_id, runs, successes, cached_runs, cpu_seconds, first_run_at, last_run_at)
+        SELECT user_id, COUNT(*), SUM(success), SUM(cached),
+               TOTAL(CASE WHEN cached = 0 THEN execution_time END), MIN(created_at), MAX(created_at)
+        FROM program_runs GROUP BY user_id
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO daily_activity (user_id, day, runs, successes, cached_runs, cpu_seconds)
+        SELECT user_id, substr(created_at, 1, 10), COUNT(*), SUM(success), SUM(cached),
+               TOTAL(CASE WHEN cached = 0 THEN execution_time END)
+        FROM program_runs GROUP BY user_id, substr(created_at, 1, 10)
+        """
+    )
+    if archived is not None:
+        _write_run_activity(conn, *archived)
+    conn.execute(
+        """
+        INSERT INTO user_activity (user_id, unlocks, last_unlocked_at)
+        SELECT user_id, COUNT(*), MAX(unlocked_at) FROM unlocks WHERE true GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            unlocks = excluded.unlocks, last_unlocked_at = excluded.last_unlocked_at
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO material_activity (material_id, unlocks, first_unlocked_at, last_unlocked_at)
+        SELECT material_id, COUNT(*), MIN(unlocked_at), MAX(unlocked_at) FROM unlocks GROUP BY material_id
+        """
+    )
+
+
+def _summarize_archived_runs(
+    conn: sqlite3.Connection, archive_dir: Path
+) -> Tuple[Dict[int, list], Dict[Tuple[int, str], list], int]:
+    """
+    archive_dir のアーカイブ済み実行記録をユーザーと日ごとに集計し、集計した実行数と一緒に返す。
+    まだ program_runs に残っている id と、削除済みユーザーの記録は除く。
+    """
+    users: Dict[int, list] = {}
+    days: Dict[Tuple[int, str], list] = {}
+    user_ids = {int(row["id"]) for row in conn.execute("SELECT id FROM users")}
+
+    def add_archived(runs: List[dict]) -> int:
+        placeholders = ", ".join("?" for _ in runs)
+        present = {
+            int(row["id"])
+            for row in conn.execute(
+                f"SELECT id FROM program_runs WHERE id IN ({placeholders})", [run["id"] for run in runs]
+            )
+        }
+        kept = [run for run in runs if run["id"] not in present and run["user_id"] in user_ids]
+        _summarize_runs(kept, users, days)
+        return len(kept)
+
+    count = 0
+    chunk: List[dict] = []
+    for run in iter_archived_program_runs(archive_dir):
+        chunk.append(run)
+        if len(chunk) >= RETENTION_CHUNK_SIZE:
+            count += add_archived(chunk)
+            chunk = []
+    if chunk:
+        count += add_archived(chunk)
+    return users, days, count
+
+
+def rebuild_activity_summaries(archive_dir: Optional[Path] = None) -> dict:
+    """
+    集計テーブルを生の記録から作り直し、集計したユーザー数と実行数を返す。
+    archive_dir を渡すと、retention でアーカイブへ移した実行記録も読み込んで含める
+    (まだ DB に残っている id と、削除済みユーザーの記録は除く)。アーカイブはユーザーと日
+    ごとに集計しながら書き込みロックの外で読み、作り直し自体は 1 つの短いトランザクションで行う。
+    """
+    archived_users: Dict[int, list] = {}
+    archived_days: Dict[Tuple[int, str], list] = {}
+    archived_runs = 0
+    if archive_dir is not None:
+        with _connection("rebuild_activity_summaries") as conn:
+            archived_users, archived_days, archived_runs = _summarize_archived_runs(conn, archive_dir)
+    with _connection("rebuild_activity_summaries") as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            _rebuild_activity_summaries(conn, (archived_users, archived_days))
+            totals = conn.execute("SELECT COUNT(*) AS users, TOTAL(runs) AS runs FROM user_activity").fetchone()
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return {"users": int(totals["users"]), "runs": int(totals["runs"]), "archived_runs": archived_runs}
+
+
+def _insert_program_runs(conn: sqlite3.Connection, runs: List[dict]) -> None:
+    _store_blobs(conn, (run[key] for run in runs for key in ("code", "stdout", "stderr")))
+    conn.executemany(
+        """
+        INSERT INTO program_runs
+            (user_id, code_hash, stdout_hash, stderr_hash, success, execution_time, cached, timings, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        [
+            (
+                run["user_id"],
+                _blob_hash(run["code"]),
+                _blob_hash(run["stdout"]),
+                _blob_hash(run["stderr"]),
+                run["success"],
+                run["execution_time"],
+                run["cached"],
+                run["timings"],
+                run["created_at"],
+            )
+            for run in runs
+        ],
+    )
+    _add_run_activity(conn, runs)
 
 
 def record_program_run(
@@ -284,47 +1198,274 @@ def record_program_run(
     stderr: str,
     success: bool,
     execution_time: float,
+    *,
+    cached: bool = False,
+    timings: Optional[Dict[str, object]] = None,
 ) -> None:
-    with closing(get_connection()) as conn:
-        conn.execute(
-            """
-            INSERT INTO program_runs (user_id, code, stdout, stderr, success, execution_time)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (user_id, code, stdout, stderr, 1 if success else 0, execution_time),
-        )
+    """
+    実行結果を保存する。cached はサンドボックスを使わずキャッシュから返した実行を表し、
+    CPU 使用量の集計からは除外される。timings はサンドボックス内の段階ごとの所要時間で、
+    JSON にして一緒に保存する。
+
+    書き込みスレッドが動いていればキューに積むだけで戻り、INSERT はまとめて行われる。
+    キューが満杯のとき (書き込みが追いついていないとき) は捨てずにその場で書き込む。
+    そのため失われうるのは、プロセスが異常終了した時点でキューに残っていた分だけになる。
+    """
+    run = {
+        "user_id": user_id,
+        "code": code,
+        "stdout": stdout,
+        "stderr": stderr,
+        "success": 1 if success else 0,
+        "execution_time": execution_time,
+        "cached": 1 if cached else 0,
+        "timings": json.dumps(timings) if timings else None,
+        # CURRENT_TIMESTAMP と同じ形式。書き込みが遅れても実行した時刻で記録する
+        "created_at": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    with _run_log_cond:
+        if _run_log_writer is not None and len(_run_log_queue) + len(_run_log_inflight) < RUN_LOG_QUEUE_SIZE:
+            _run_log_queue.append(run)
+            _run_log_cond.notify()
+            return
+        if _run_log_writer is not None:
+            _run_log_stats["overflow_writes"] += 1
+    with _connection("record_program_run") as conn:
+        _insert_program_runs(conn, [run])
         conn.commit()
 
 
+def flush_program_runs(limit: Optional[int] = None) -> int:
+    """
+    キューに溜まった実行記録を最大 limit 件 (省略時は RUN_LOG_BATCH_SIZE 件) 取り出し、
+    1 トランザクションで書き込んで件数を返す。失敗した分はキューの先頭に戻す。
+    """
+    with _run_log_commit_lock:
+        with _run_log_cond:
+            count = min(len(_run_log_queue), limit or RUN_LOG_BATCH_SIZE)
+            batch = [_run_log_queue.popleft() for _ in range(count)]
+            _run_log_inflight.extend(batch)
+        if not batch:
+            return 0
+        try:
+            with _connection("flush_program_runs") as conn:
+                _insert_program_runs(conn, batch)
+                conn.commit()
+        except BaseException:
+            with _run_log_cond:
+                _run_log_inflight.clear()
+                _run_log_queue.extendleft(reversed(batch))
+                _run_log_stats["failed_batches"] += 1
+            raise
+        with _run_log_cond:
+            _run_log_inflight.clear()
+            _run_log_stats["written"] += len(batch)
+            _run_log_stats["batches"] += 1
+    return len(batch)
+
+
+def _pending_program_runs(user_id: Optional[int] = None) -> List[dict]:
+    """
+    まだ DB に書かれていない実行記録を古い順に返す。呼び出し側は
+    _run_log_commit_lock を持ったまま DB を読み、結果に重ねること。
+    """
+    with _run_log_cond:
+        runs = _run_log_inflight + list(_run_log_queue)
+    if user_id is None:
+        return runs
+    return [run for run in runs if run["user_id"] == user_id]
+
+
+def get_run_log_stats() -> dict:
+    """書き込み待ちの件数 (キューの深さ) と、これまでの書き込み状況を返す。"""
+    with _run_log_cond:
+        return {
+            "queued": len(_run_log_queue) + len(_run_log_inflight),
+            "capacity": RUN_LOG_QUEUE_SIZE,
+            "running": _run_log_writer is not None,
+            **_run_log_stats,
+        }
+
+
+def _run_log_writer_loop(interval: float) -> None:
+    while True:
+        with _run_log_cond:
+            # 1 件来たら、バッチが埋まるか interval が経つまで少し待ってまとめる
+            _run_log_cond.wait_for(lambda: _run_log_queue or _run_log_stop.is_set())
+            if not _run_log_stop.is_set():
+                _run_log_cond.wait_for(
+                    lambda: len(_run_log_queue) >= RUN_LOG_BATCH_SIZE or _run_log_stop.is_set(),
+                    timeout=interval,
+                )
+            if _run_log_stop.is_set() and not _run_log_queue:
+                break
+        try:
+            flush_program_runs()
+        except sqlite3.Error:
+            logger.exception("failed to write program runs; retrying")
+            if _run_log_stop.wait(max(interval, 1.0)):
+                break
+    # 停止時は残りをすべて書き切る
+    try:
+        while flush_program_runs():
+            pass
+    except sqlite3.Error:
+        logger.exception("dropping %d unwritten program runs at shutdown", len(_run_log_queue))
+    close_thread_connection()
+
+
+def start_program_run_writer(interval: float = RUN_LOG_FLUSH_INTERVAL_SECONDS) -> None:
+    """実行記録をまとめて書き込むバックグラウンドスレッドを起動する。RUN_LOG_QUEUE_SIZE=0 なら何もしない。"""
+    global _run_log_writer
+    if RUN_LOG_QUEUE_SIZE <= 0:
+        return
+    with _run_log_cond:
+        if _run_log_writer is not None and _run_log_writer.is_alive():
+            return
+        _run_log_stop.clear()
+        _run_log_writer = threading.Thread(
+            target=_run_log_writer_loop, args=(interval,), name="program-run-writer", daemon=True
+        )
+        _run_log_writer.start()
+
+
+def stop_program_run_writer() -> None:
+    """新しい記録の受け付けを同期書き込みに戻し、キューを書き切ってからスレッドを止める。"""
+    global _run_log_writer
+    with _run_log_cond:
+        writer = _run_log_writer
+        _run_log_writer = None
+        _run_log_stop.set()
+        _run_log_cond.notify_all()
+    if writer is not None:
+        writer.join()
+    else:
+        while flush_program_runs():
+            pass
+
+
+def _load_unlock_bits(user_id: int) -> int:
+    """DB からユーザーの解除済み教材を読み、キャッシュに入れてビット集合で返す。"""
+    with _connection("load_user_unlocks") as conn:
+        rows = conn.execute("SELECT material_id FROM unlocks WHERE user_id = ?", (user_id,)).fetchall()
+    bits = 0
+    for row in rows:
+        bits |= 1 << int(row["material_id"])
+    with _unlock_lock:
+        # 読んでいる間に record_unlock されたものを失わないよう OR で重ねる
+        current = _unlock_cache.get(user_id)
+        if current is not None:
+            bits |= current[0]
+        _unlock_cache[user_id] = (bits, time.monotonic())
+    return bits
+
+
+def load_user_unlocks(user_id: int) -> None:
+    """ログイン時に呼び、そのユーザーの解除状況を DB から読み直してキャッシュしておく。"""
+    _load_unlock_bits(user_id)
+
+
+def _unlock_bits(user_id: int) -> int:
+    """
+    解除済み教材のビット集合を返す。キャッシュが UNLOCK_CACHE_TTL_SECONDS より古ければ、
+    他のワーカープロセスでの解除 (学習者自身の解除や、管理者の /api/admin/unlocks による
+    一括解除) を拾うため DB から読み直す。
+    """
+    with _unlock_lock:
+        cached = _unlock_cache.get(user_id)
+    if cached is not None and time.monotonic() - cached[1] < UNLOCK_CACHE_TTL_SECONDS:
+        return cached[0]
+    return _load_unlock_bits(user_id)
+
+
 def record_unlock(user_id: int, material_id: int) -> None:
-    with closing(get_connection()) as conn:
-        conn.execute(
-            "INSERT OR IGNORE INTO unlocks (user_id, material_id) VALUES (?, ?)",
-            (user_id, material_id),
+    unlocked_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    with _connection("record_unlock") as conn:
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO unlocks (user_id, material_id, unlocked_at) VALUES (?, ?, ?)",
+            (user_id, material_id, unlocked_at),
         )
+        if cursor.rowcount > 0:
+            _add_unlock_activity(conn, [(user_id, material_id)], unlocked_at)
         conn.commit()
+    with _unlock_lock:
+        cached = _unlock_cache.get(user_id)
+        if cached is not None:
+            _unlock_cache[user_id] = (cached[0] | (1 << material_id), cached[1])
 
 
-def get_user_unlocks(user_id: int) -> List[int]:
-    with closing(get_connection()) as conn:
+def bulk_unlock(user_ids: Optional[Iterable[int]], material_ids: Iterable[int]) -> int:
+    """
+    複数のユーザー (None なら全ユーザー) に複数の教材をまとめて解除し、新しく解除した件数を返す。
+    DB は 1 トランザクションで書き、コミットできたときだけキャッシュにも反映する。
+    """
+    material_ids = sorted(set(material_ids))
+    mask = 0
+    for material_id in material_ids:
+        mask |= 1 << material_id
+    with _connection("bulk_unlock") as conn:
+        if user_ids is None:
+            user_ids = [int(row["id"]) for row in conn.execute("SELECT id FROM users")]
+        else:
+            user_ids = sorted(set(user_ids))
+        unlocked_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        # 集計に足すため、新しく入った組だけを RETURNING で受け取る。
+        # 既に解除済みの組は OR IGNORE で飛ばされ、RETURNING にも現れない
         rows = conn.execute(
-            "SELECT material_id FROM unlocks WHERE user_id = ? ORDER BY material_id",
-            (user_id,),
+            """
+            INSERT OR IGNORE INTO unlocks (user_id, material_id, unlocked_at)
+            SELECT users.value, materials.value, ?
+            FROM json_each(?) AS users CROSS JOIN json_each(?) AS materials
+            RETURNING user_id, material_id
+            """,
+            (unlocked_at, json.dumps(user_ids), json.dumps(material_ids)),
         ).fetchall()
-        return [int(row["material_id"]) for row in rows]
+        inserted_pairs = [(int(row["user_id"]), int(row["material_id"])) for row in rows]
+        _add_unlock_activity(conn, inserted_pairs, unlocked_at)
+        inserted = len(inserted_pairs)
+        # キャッシュの更新とコミットの間に他のスレッドが古い値を読み込まないよう、ロックを持ったままコミットする
+        with _unlock_lock:
+            conn.commit()
+            for user_id in user_ids:
+                cached = _unlock_cache.get(user_id)
+                if cached is not None:
+                    _unlock_cache[user_id] = (cached[0] | mask, cached[1])
+    return inserted
+
+
+def get_user_unlocks(user_id: int) -> List[int]:
+    """解除済みの教材 ID を昇順で返す。キャッシュが新しければ DB には問い合わせない。"""
+    bits = _unlock_bits(user_id)
+    unlocks = []
+    material_id = 0
+    while bits:
+        if bits & 1:
+            unlocks.append(material_id)
+        bits >>= 1
+        material_id += 1
+    return unlocks
 
 
 def has_unlocked(user_id: int, material_id: int) -> bool:
-    with closing(get_connection()) as conn:
-        row = conn.execute(
-            "SELECT 1 FROM unlocks WHERE user_id = ? AND material_id = ?",
-            (user_id, material_id),
-        ).fetchone()
-        return row is not None
+    """
+    教材を解除済みか調べる。解除は取り消されないので、解除済みならキャッシュだけで答える。
+    未解除のときは、別のプロセス (他のワーカーや CLI) での解除を拾うため、
+    キャッシュが UNLOCK_CACHE_TTL_SECONDS より古ければ DB から読み直す。
+    """
+    with _unlock_lock:
+        cached = _unlock_cache.get(user_id)
+    if cached is None:
+        return bool(_load_unlock_bits(user_id) >> material_id & 1)
+    bits, loaded_at = cached
+    if bits >> material_id & 1:
+        return True
+    if time.monotonic() - loaded_at < UNLOCK_CACHE_TTL_SECONDS:
+        return False
+    return bool(_load_unlock_bits(user_id) >> material_id & 1)
 
 
 def list_user_programs(username: str, limit: Optional[int] = None) -> List[dict]:
-    with closing(get_connection()) as conn:
+    with _connection("list_user_programs") as conn:
         user_row = conn.execute(
             "SELECT id FROM users WHERE username = ?",
             (username,),
@@ -332,15 +1473,16 @@ def list_user_programs(username: str, limit: Optional[int] = None) -> List[dict]
         if user_row is None:
             return []
         query = (
-            "SELECT code, stdout, stderr, success, execution_time, created_at "
-            "FROM program_runs WHERE user_id = ? ORDER BY created_at DESC"
+            f"SELECT {_PROGRAM_RUN_TEXT_COLUMNS}, success, execution_time, cached, program_runs.created_at "
+            f"FROM program_runs {_PROGRAM_RUN_TEXT_JOINS} "
+            "WHERE user_id = ? ORDER BY program_runs.created_at DESC"
         )
         params: Iterable = (user_row["id"],)
         if limit is not None:
             query += " LIMIT ?"
             params = (user_row["id"], limit)
         rows = conn.execute(query, params).fetchall()
-        return [dict(row) for row in rows]
+        return [_program_run_from_row(row) for row in rows]
 
 
 def _parse_timestamp(timestamp: str) -> Optional[datetime]:
@@ -351,7 +1493,10 @@ def _parse_timestamp(timestamp: str) -> Optional[datetime]:
 
 
 def get_last_program_run_time(user_id: int) -> Optional[datetime]:
-    with closing(get_connection()) as conn:
+    with _run_log_commit_lock, _connection("get_last_program_run_time") as conn:
+        pending = _pending_program_runs(user_id)
+        if pending:
+            return _parse_timestamp(pending[-1]["created_at"])
         row = conn.execute(
             "SELECT created_at FROM program_runs WHERE user_id = ? ORDER BY created_at DESC LIMIT 1",
             (user_id,),
@@ -361,54 +1506,552 @@ def get_last_program_run_time(user_id: int) -> Optional[datetime]:
         return _parse_timestamp(row["created_at"])
 
 
+def _pending_runs_within_window(user_id: int, window_seconds: float) -> List[dict]:
+    """キュー上の未書き込みの実行のうち、CPU 使用量の集計対象になるものを返す。"""
+    threshold = (datetime.utcnow() - timedelta(seconds=int(window_seconds))).strftime("%Y-%m-%d %H:%M:%S")
+    return [
+        run
+        for run in _pending_program_runs(user_id)
+        if not run["cached"] and run["created_at"] >= threshold
+    ]
+
+
 def get_execution_time_since(user_id: int, window_seconds: float) -> float:
-    with closing(get_connection()) as conn:
+    with _run_log_commit_lock, _connection("get_execution_time_since") as conn:
+        pending = _pending_runs_within_window(user_id, window_seconds)
         row = conn.execute(
             """
             SELECT COALESCE(SUM(execution_time), 0) AS total
             FROM program_runs
             WHERE user_id = ?
+              AND cached = 0
               AND created_at >= datetime('now', ?)
             """,
             (user_id, f"-{int(window_seconds)} seconds"),
         ).fetchone()
-        return float(row["total"] if row else 0.0)
+        total = float(row["total"] if row else 0.0)
+        return total + sum(float(run["execution_time"]) for run in pending)
 
 
 def get_oldest_run_within_window(user_id: int, window_seconds: float) -> Optional[datetime]:
-    with closing(get_connection()) as conn:
+    with _run_log_commit_lock, _connection("get_oldest_run_within_window") as conn:
+        pending = _pending_runs_within_window(user_id, window_seconds)
         row = conn.execute(
             """
             SELECT MIN(created_at) AS oldest
             FROM program_runs
             WHERE user_id = ?
+              AND cached = 0
               AND created_at >= datetime('now', ?)
             """,
             (user_id, f"-{int(window_seconds)} seconds"),
         ).fetchone()
-        if row is None or row["oldest"] is None:
+        oldest = row["oldest"] if row is not None else None
+        if oldest is None and pending:
+            oldest = pending[0]["created_at"]
+        if oldest is None:
             return None
-        return _parse_timestamp(row["oldest"])
+        return _parse_timestamp(oldest)
+
+
+def list_recent_program_runs(window_seconds: float) -> List[dict]:
+    """
+    全ユーザーの直近 window_seconds 秒の実行を古い順に返す。
+    起動時にメモリ上のレート制限を復元するために使う。
+    """
+    with _connection("list_recent_program_runs") as conn:
+        rows = conn.execute(
+            """
+            SELECT user_id, execution_time, cached, created_at
+            FROM program_runs
+            WHERE created_at >= datetime('now', ?)
+            ORDER BY created_at
+            """,
+            (f"-{int(math.ceil(window_seconds))} seconds",),
+        ).fetchall()
+    runs = []
+    for row in rows:
+        created_at = _parse_timestamp(row["created_at"])
+        if created_at is not None:
+            runs.append({**dict(row), "created_at": created_at})
+    return runs
 
 
 def list_program_runs_by_user_id(
-    user_id: int, limit: Optional[int] = None
+    user_id: int,
+    limit: Optional[int] = None,
+    *,
+    before: Optional[Tuple[str, int]] = None,
+    preview_chars: Optional[int] = None,
 ) -> List[dict]:
-    with closing(get_connection()) as conn:
-        query = (
-            "SELECT id, code, stdout, stderr, success, execution_time, created_at "
-            "FROM program_runs WHERE user_id = ? ORDER BY created_at DESC"
-        )
-        params: Iterable = (user_id,)
+    """
+    ユーザーの実行履歴を (created_at, id) の新しい順に返す。before を渡すと
+    その位置より古いものだけを返す (キーセットページング)。
+
+    preview_chars を指定すると code/stdout/stderr の全文の代わりに、先頭 preview_chars 文字の
+    code_preview/stdout_preview/stderr_preview (切り詰めたものは末尾に "…") と、
+    どれかを切り詰めたかを表す truncated を返す。
+
+    書き込み待ちの実行は (DB のどの行よりも新しいので) 最初のページの先頭に id=None で重ねる。
+    数が limit を超えてもすべて返すので、そのときだけ limit より多く返る。
+    """
+    conditions = "user_id = ?"
+    params: List = [user_id]
+    if before is not None:
+        conditions += " AND (program_runs.created_at, program_runs.id) < (?, ?)"
+        params.extend(before)
+    columns = _PROGRAM_RUN_TEXT_COLUMNS
+    if preview_chars is not None:
+        columns += ", code_blob.size AS code_size, stdout_blob.size AS stdout_size, stderr_blob.size AS stderr_size"
+    else:
+        columns += ", timings"
+    query = (
+        f"SELECT program_runs.id, {columns}, success, execution_time, cached, program_runs.created_at "
+        f"FROM program_runs {_PROGRAM_RUN_TEXT_JOINS} WHERE {conditions} "
+        "ORDER BY program_runs.created_at DESC, program_runs.id DESC"
+    )
+    with _run_log_commit_lock, _connection("list_program_runs_by_user_id") as conn:
+        pending = [] if before is not None else [
+            _pending_history_entry(run, preview_chars) for run in reversed(_pending_program_runs(user_id))
+        ]
         if limit is not None:
             query += " LIMIT ?"
-            params = (user_id, limit)
+            params.append(max(limit - len(pending), 0))
         rows = conn.execute(query, params).fetchall()
-        return [dict(row) for row in rows]
+    if preview_chars is None:
+        return pending + [_program_run_from_row(row) for row in rows]
+    return pending + [_program_run_summary_from_row(row, preview_chars) for row in rows]
+
+
+def _pending_history_entry(run: dict, preview_chars: Optional[int]) -> dict:
+    """キュー上の実行を、list_program_runs_by_user_id が DB から返すのと同じ形にする。"""
+    if preview_chars is None:
+        entry = {"id": None, **{key: run[key] for key in ("code", "stdout", "stderr")}}
+        entry["timings"] = json.loads(run["timings"]) if run["timings"] else None
+        entry.update({key: run[key] for key in ("success", "execution_time", "cached", "created_at")})
+        return entry
+    entry = {"id": None, **{key: run[key] for key in ("success", "execution_time", "cached", "created_at")}}
+    truncated = False
+    for key in ("code", "stdout", "stderr"):
+        text = run[key]
+        preview = text[:preview_chars] if text is not None else None
+        if preview is not None and len(preview) < len(text):
+            preview += "…"
+            truncated = True
+        entry[f"{key}_preview"] = preview
+    entry["truncated"] = truncated
+    return entry
+
+
+def _program_run_summary_from_row(row: sqlite3.Row, preview_chars: int) -> dict:
+    run = {key: row[key] for key in ("id", "success", "execution_time", "cached", "created_at")}
+    truncated = False
+    for key in ("code", "stdout", "stderr"):
+        preview = _blob_preview(row[key], preview_chars)
+        if preview is not None and len(preview.encode("utf-8")) < row[f"{key}_size"]:
+            preview += "…"
+            truncated = True
+        run[f"{key}_preview"] = preview
+    run["truncated"] = truncated
+    return run
+
+
+def _blob_preview(data: Optional[bytes | str], chars: int) -> Optional[str]:
+    """本文の先頭 chars 文字を返す。圧縮済みの本文は必要な分だけ展開する。"""
+    if data is None or isinstance(data, str):
+        return data[:chars] if data is not None else None
+    # UTF-8 は 1 文字最大 4 バイト。途中で切れた最後の文字は捨てる
+    head = zlib.decompressobj().decompress(data, chars * 4)
+    return head.decode("utf-8", errors="ignore")[:chars]
+
+
+def get_program_run(user_id: int, run_id: int) -> Optional[dict]:
+    """
+    そのユーザーの実行 1 件を全文付きで返す。他人の実行や存在しない id なら None。
+    書き込み待ちの実行はまだ id を持たないので対象外 (一覧には id=None で載る)。
+    """
+    with _connection("get_program_run") as conn:
+        row = conn.execute(
+            f"SELECT program_runs.id, {_PROGRAM_RUN_TEXT_COLUMNS}, success, execution_time, cached, "
+            f"timings, program_runs.created_at FROM program_runs {_PROGRAM_RUN_TEXT_JOINS} "
+            "WHERE program_runs.id = ? AND user_id = ?",
+            (run_id, user_id),
+        ).fetchone()
+    return _program_run_from_row(row) if row is not None else None
+
+
+def iter_program_runs(
+    *,
+    usernames: Optional[Iterable[str]] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    success: Optional[bool] = None,
+    batch_size: int = 500,
+) -> Iterator[dict]:
+    """
+    実行記録を (created_at, id) の古い順に 1 件ずつ返す。全件を読み込まず、
+    batch_size 件ずつキーセットで区切って読むので、件数が多くても使うメモリは一定で、
+    読み取りのトランザクションも長く開いたままにならない。
+    since/until は created_at と比較する文字列で、since は含み until は含まない。
+    """
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be at least 1, got {batch_size}")
+    conditions = ["1 = 1"]
+    params: List = []
+    if usernames is not None:
+        names = list(usernames)
+        conditions.append(f"users.username IN ({', '.join('?' * len(names))})")
+        params.extend(names)
+    if since is not None:
+        conditions.append("program_runs.created_at >= ?")
+        params.append(since)
+    if until is not None:
+        conditions.append("program_runs.created_at < ?")
+        params.append(until)
+    if success is not None:
+        conditions.append("program_runs.success = ?")
+        params.append(1 if success else 0)
+    query = (
+        f"SELECT program_runs.id, users.username, {_PROGRAM_RUN_TEXT_COLUMNS}, success, execution_time, "
+        f"cached, timings, program_runs.created_at FROM program_runs JOIN users ON users.id = program_runs.user_id "
+        f"{_PROGRAM_RUN_TEXT_JOINS} WHERE {' AND '.join(conditions)} "
+        "AND (program_runs.created_at, program_runs.id) > (?, ?) "
+        "ORDER BY program_runs.created_at, program_runs.id LIMIT ?"
+    )
+    after: Tuple[str, int] = ("", 0)
+    while True:
+        with _connection("iter_program_runs") as conn:
+            rows = conn.execute(query, (*params, *after, batch_size)).fetchall()
+        for row in rows:
+            yield _program_run_from_row(row)
+        if len(rows) < batch_size:
+            return
+        after = (rows[-1]["created_at"], rows[-1]["id"])
+
+
+def get_blob_storage_stats() -> dict:
+    """
+    実行履歴の本文の保存状況を返す。logical_bytes は全実行の本文をそのまま持った場合の
+    サイズ、unique_bytes は重複を除いたサイズ、stored_bytes は圧縮後に実際に保存している
+    サイズで、compression_ratio は logical_bytes / stored_bytes。
+    """
+    with _connection("get_blob_storage_stats") as conn:
+        runs = conn.execute(
+            f"""
+            SELECT
+                COUNT(*) AS runs,
+                COALESCE(SUM(code_blob.size), 0)
+                    + COALESCE(SUM(stdout_blob.size), 0)
+                    + COALESCE(SUM(stderr_blob.size), 0) AS logical_bytes
+            FROM program_runs {_PROGRAM_RUN_TEXT_JOINS}
+            """
+        ).fetchone()
+        blobs = conn.execute(
+            "SELECT COUNT(*) AS blobs, COALESCE(SUM(size), 0) AS unique_bytes, "
+            "COALESCE(SUM(LENGTH(CAST(data AS BLOB))), 0) AS stored_bytes FROM blobs"
+        ).fetchone()
+    stats = {**dict(runs), **dict(blobs)}
+    stored = stats["stored_bytes"]
+    stats["compression_ratio"] = stats["logical_bytes"] / stored if stored else None
+    return stats
+
+
+def _with_success_rate(row: sqlite3.Row) -> dict:
+    summary = dict(row)
+    summary["success_rate"] = summary["successes"] / summary["runs"] if summary["runs"] else None
+    return summary
+
+
+def _daily_activity_since(days: int) -> str:
+    return (datetime.utcnow() - timedelta(days=max(1, days) - 1)).strftime("%Y-%m-%d")
+
+
+def get_activity_overview(days: int = 30) -> dict:
+    """
+    全体の累計と、直近 days 日 (UTC、今日を含む) の日別推移を集計テーブルだけから返す。
+    書き込みキューに残っている実行はまだ含まれない。
+    """
+    with _connection("get_activity_overview") as conn:
+        totals = conn.execute(
+            """
+            SELECT COUNT(*) AS users,
+                   COUNT(user_activity.first_run_at) AS active_users,
+                   COALESCE(SUM(user_activity.runs), 0) AS runs,
+                   COALESCE(SUM(user_activity.successes), 0) AS successes,
+                   COALESCE(SUM(user_activity.cached_runs), 0) AS cached_runs,
+                   TOTAL(user_activity.cpu_seconds) AS cpu_seconds,
+                   COALESCE(SUM(user_activity.unlocks), 0) AS unlocks,
+                   MAX(user_activity.last_run_at) AS last_run_at
+            FROM users LEFT JOIN user_activity ON user_activity.user_id = users.id
+            """
+        ).fetchone()
+        daily = conn.execute(
+            """
+            SELECT day, COUNT(*) AS active_users, SUM(runs) AS runs, SUM(successes) AS successes,
+                   SUM(cached_runs) AS cached_runs, TOTAL(cpu_seconds) AS cpu_seconds
+            FROM daily_activity WHERE day >= ? GROUP BY day ORDER BY day
+            """,
+            (_daily_activity_since(days),),
+        ).fetchall()
+    return {"totals": _with_success_rate(totals), "daily": [_with_success_rate(row) for row in daily]}
+
+
+def list_user_activity() -> List[dict]:
+    """全ユーザーの累計 (実行数・成功率・CPU 秒・最終活動など) をユーザー名順に返す。"""
+    with _connection("list_user_activity") as conn:
+        rows = conn.execute(
+            """
+            SELECT users.id AS user_id, users.username, users.is_admin,
+                   COALESCE(runs, 0) AS runs, COALESCE(successes, 0) AS successes,
+                   COALESCE(cached_runs, 0) AS cached_runs, COALESCE(cpu_seconds, 0) AS cpu_seconds,
+                   first_run_at, last_run_at, COALESCE(unlocks, 0) AS unlocks, last_unlocked_at,
+                   MAX(COALESCE(last_run_at, ''), COALESCE(last_unlocked_at, '')) AS last_activity_at
+            FROM users LEFT JOIN user_activity ON user_activity.user_id = users.id
+            ORDER BY users.username
+            """
+        ).fetchall()
+    activity = []
+    for row in rows:
+        summary = _with_success_rate(row)
+        summary["last_activity_at"] = summary["last_activity_at"] or None
+        activity.append(summary)
+    return activity
+
+
+def get_user_activity(user_id: int, days: int = 30) -> Optional[dict]:
+    """1 人分の累計と直近 days 日の日別推移を返す。ユーザーがいなければ None。"""
+    with _connection("get_user_activity") as conn:
+        row = conn.execute(
+            """
+            SELECT users.id AS user_id, users.username,
+                   COALESCE(runs, 0) AS runs, COALESCE(successes, 0) AS successes,
+                   COALESCE(cached_runs, 0) AS cached_runs, COALESCE(cpu_seconds, 0) AS cpu_seconds,
+                   first_run_at, last_run_at, COALESCE(unlocks, 0) AS unlocks, last_unlocked_at
+            FROM users LEFT JOIN user_activity ON user_activity.user_id = users.id
+            WHERE users.id = ?
+            """,
+            (user_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        daily = conn.execute(
+            "SELECT day, runs, successes, cached_runs, cpu_seconds FROM daily_activity "
+            "WHERE user_id = ? AND day >= ? ORDER BY day",
+            (user_id, _daily_activity_since(days)),
+        ).fetchall()
+    return {**_with_success_rate(row), "daily": [_with_success_rate(day) for day in daily]}
+
+
+def list_material_activity() -> List[dict]:
+    """教材ごとの解除人数と、最初・最後に解除された時刻を教材 ID 順に返す。"""
+    with _connection("list_material_activity") as conn:
+        rows = conn.execute(
+            "SELECT material_id, unlocks, first_unlocked_at, last_unlocked_at "
+            "FROM material_activity ORDER BY material_id"
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def _archive_path(archive_dir: Path, month: str) -> Path:
+    return archive_dir / f"program_runs-{month}.jsonl.gz"
+
+
+def _append_archive(path: Path, runs: List[dict]) -> None:
+    """
+    実行記録を JSON Lines として gzip のメンバーごと追記する。既存の内容は書き換えない。
+    DB から消す前に確実にディスクへ書くため fsync まで行う。
+    """
+    payload = "".join(json.dumps(run, ensure_ascii=False) + "\n" for run in runs).encode("utf-8")
+    with open(path, "ab") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="ab") as archive:
+            archive.write(payload)
+        raw.flush()
+        os.fsync(raw.fileno())
+
+
+def archive_program_runs(
+    older_than_days: int = RUN_RETENTION_DAYS,
+    archive_dir: Optional[Path] = None,
+    chunk_size: int = RETENTION_CHUNK_SIZE,
+) -> dict:
+    """
+    older_than_days 日より前の実行記録を月ごとのアーカイブ (program_runs-YYYY-MM.jsonl.gz)
+    へ追記し、DB から削除する。chunk_size 件ずつ「書き出し → 短いトランザクションで削除」を
+    繰り返すので、書き込みロックを長く握らない。途中で中断すると同じ記録が二重に
+    書かれることがあるが、iter_archived_program_runs は id で重複を除いて読む。
+
+    戻り値の blob_hashes は移した実行が参照していた blobs のハッシュで、
+    delete_unreferenced_blobs に渡すとその中から不要になったものだけを調べて消せる。
+    """
+    archive_dir = Path(archive_dir or ARCHIVE_DIR)
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    archived = 0
+    months = set()
+    blob_hashes: set = set()
+    while True:
+        with _connection("archive_program_runs") as conn:
+            rows = conn.execute(
+                f"""
+                SELECT program_runs.id, program_runs.user_id, users.username, {_PROGRAM_RUN_TEXT_COLUMNS},
+                       success, execution_time, cached, timings, program_runs.created_at,
+                       code_hash, stdout_hash, stderr_hash
+                FROM program_runs
+                JOIN users ON users.id = program_runs.user_id
+                {_PROGRAM_RUN_TEXT_JOINS}
+                WHERE program_runs.created_at < datetime('now', ?)
+                ORDER BY program_runs.created_at, program_runs.id
+                LIMIT ?
+                """,
+                (f"-{int(older_than_days)} days", chunk_size),
+            ).fetchall()
+        if not rows:
+            break
+        by_month: Dict[str, List[dict]] = {}
+        for row in rows:
+            run = _program_run_from_row(row)
+            for key in ("code_hash", "stdout_hash", "stderr_hash"):
+                blob_hash = run.pop(key)
+                if blob_hash is not None:
+                    blob_hashes.add(blob_hash)
+            by_month.setdefault(str(run["created_at"])[:7], []).append(run)
+        for month, runs in by_month.items():
+            _append_archive(_archive_path(archive_dir, month), runs)
+        with _connection("archive_program_runs") as conn:
+            conn.executemany("DELETE FROM program_runs WHERE id = ?", [(row["id"],) for row in rows])
+            conn.commit()
+        archived += len(rows)
+        months.update(by_month)
+    return {"archived": archived, "months": sorted(months), "blob_hashes": blob_hashes}
+
+
+def iter_archived_program_runs(
+    archive_dir: Optional[Path] = None,
+    *,
+    username: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+) -> Iterator[dict]:
+    """
+    アーカイブ済みの実行記録を古い月から順に返す。since/until は created_at と比較する
+    文字列 ("2024-04" や "2024-04-01" など) で、since は含み until は含まない。
+    """
+    archive_dir = Path(archive_dir or ARCHIVE_DIR)
+    seen = set()
+    for path in sorted(archive_dir.glob("program_runs-*.jsonl.gz")):
+        month = path.name[len("program_runs-"):-len(".jsonl.gz")]
+        if (since and month < since[:7]) or (until and month > until[:7]):
+            continue
+        with gzip.open(path, "rt", encoding="utf-8") as archive:
+            for line in archive:
+                run = json.loads(line)
+                if run["id"] in seen:
+                    continue
+                seen.add(run["id"])
+                if username is not None and run["username"] != username:
+                    continue
+                if (since and run["created_at"] < since) or (until and run["created_at"] >= until):
+                    continue
+                yield run
+
+
+def _delete_unreferenced_blob_chunk(hashes: Sequence[str]) -> int:
+    placeholders = ", ".join("?" for _ in hashes)
+    with _connection("delete_unreferenced_blobs") as conn:
+        cursor = conn.execute(
+            f"DELETE FROM blobs WHERE hash IN ({placeholders}) AND {_BLOB_UNREFERENCED}", list(hashes)
+        )
+        conn.commit()
+    return cursor.rowcount
+
+
+def delete_unreferenced_blobs(
+    chunk_size: int = RETENTION_CHUNK_SIZE, hashes: Optional[Iterable[str]] = None
+) -> int:
+    """
+    どの実行記録からも参照されなくなった blobs を chunk_size 件ずつ削除し、件数を返す。
+
+    hashes を渡すとその中だけを調べる (archive_program_runs の blob_hashes を渡す想定)。
+    省略すると blobs 全体をハッシュ順に区切って調べる。ユーザー削除で消えた実行の分も
+    拾えるが、blobs を全件読むので時間がかかる。参照の有無はハッシュ列のインデックスで引く。
+    """
+    deleted = 0
+    if hashes is not None:
+        candidates = sorted(hashes)
+        for start in range(0, len(candidates), chunk_size):
+            deleted += _delete_unreferenced_blob_chunk(candidates[start:start + chunk_size])
+        return deleted
+    after = ""
+    while True:
+        with _connection("delete_unreferenced_blobs") as conn:
+            chunk = [
+                row["hash"]
+                for row in conn.execute(
+                    "SELECT hash FROM blobs WHERE hash > ? ORDER BY hash LIMIT ?", (after, chunk_size)
+                )
+            ]
+        if not chunk:
+            return deleted
+        deleted += _delete_unreferenced_blob_chunk(chunk)
+        after = chunk[-1]
+
+
+def delete_stale_sessions(
+    older_than_days: int = SESSION_RETENTION_DAYS, chunk_size: int = RETENTION_CHUNK_SIZE
+) -> int:
+    """older_than_days 日以上使われていないセッションを chunk_size 件ずつ削除し、件数を返す。"""
+    deleted = 0
+    while True:
+        with _connection("delete_stale_sessions") as conn:
+            cursor = conn.execute(
+                """
+                DELETE FROM sessions WHERE token IN (
+                    SELECT token FROM sessions WHERE last_seen_at < datetime('now', ?) LIMIT ?
+                )
+                """,
+                (f"-{int(older_than_days)} days", chunk_size),
+            )
+            conn.commit()
+        deleted += cursor.rowcount
+        if cursor.rowcount < chunk_size:
+            return deleted
+
+
+def incremental_vacuum(pages_per_step: int = 1000, *, convert: bool = False) -> dict:
+    """
+    空きページを少しずつファイルから切り詰める。
+
+    auto_vacuum=INCREMENTAL になっていない古いデータベースでは何もせず、切り替えが必要な
+    ことをログに残す。切り替えにはファイル全体を書き直す通常の VACUUM が要り、その間は
+    排他ロックを握り続けるので、convert=True のとき (利用者のいない時間に明示的に) だけ行う。
+    """
+    with _connection("incremental_vacuum") as conn:
+        if int(conn.execute("PRAGMA auto_vacuum").fetchone()[0]) != 2:
+            if not convert:
+                logger.warning(
+                    "auto_vacuum is not INCREMENTAL; skipped incremental vacuum "
+                    "(run retention --convert-auto-vacuum once during maintenance to switch)"
+                )
+                return {"full_vacuum": False, "conversion_pending": True, "freed_pages": 0}
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            return {"full_vacuum": True, "conversion_pending": False, "freed_pages": None}
+        freed = 0
+        free_pages = int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+        while free_pages > 0:
+            # execute() だと 1 ページしか進まないので、最後までステップする executescript を使う
+            conn.executescript(f"PRAGMA incremental_vacuum({int(pages_per_step)})")
+            remaining = int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+            if remaining >= free_pages:
+                break
+            freed += free_pages - remaining
+            free_pages = remaining
+        # WAL モードではチェックポイントで書き戻すまでファイルが縮まない
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        return {"full_vacuum": False, "conversion_pending": False, "freed_pages": freed}
 
 
 def list_user_unlocks(username: str) -> List[dict]:
-    with closing(get_connection()) as conn:
+    with _connection("list_user_unlocks") as conn:
         user_row = conn.execute(
             "SELECT id FROM users WHERE username = ?",
             (username,),
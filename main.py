@@ -1,52 +1,88 @@
+import asyncio
+import base64
+import binascii
 import contextlib
+import gzip
+import hashlib
 import io
+import json
+import logging
 import math
 import os
+import re
 import sqlite3
-from datetime import datetime
+import tempfile
+from datetime import datetime, timedelta
 try:
     import resource
 except ImportError:  # pragma: no cover - Windows環境では resource が利用できない
     resource = None  # type: ignore[assignment]
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli は任意の依存パッケージ
+    brotli = None  # type: ignore[assignment]
+import threading
 import time
 import traceback
-from multiprocessing import Process, Queue
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import Pipe, Process, Queue
+from multiprocessing.connection import Connection
 from pathlib import Path
 from typing import Any, Dict, Optional
 
+import bokeh
 import numpy as np
 from bokeh.embed import json_item
-from bokeh.models import LayoutDOM
+from bokeh.models import Circle, GlyphRenderer, LayoutDOM, Line, Plot, Scatter
 from bokeh.plotting import ColumnDataSource, figure
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from markdown import __version__ as markdown_version
 from markdown import markdown
 from pydantic import BaseModel
 
 from database import (
     UserRecord,
+    bulk_unlock,
     create_session,
     create_user,
     delete_session,
     delete_user_by_id,
     fetch_user_credentials,
+    get_activity_overview,
     get_user_by_token,
-    get_execution_time_since,
-    get_last_program_run_time,
-    get_oldest_run_within_window,
+    hash_password,
+    get_program_run,
+    get_query_stats,
+    get_run_log_stats,
+    get_user_activity,
     get_user_unlocks,
     has_unlocked,
     init_db,
+    list_material_activity,
     list_program_runs_by_user_id,
+    list_recent_program_runs,
+    list_user_activity,
     list_users,
+    load_user_unlocks,
+    password_needs_rehash,
     record_program_run,
     record_unlock,
+    set_user_password_hash,
+    start_program_run_writer,
+    start_session_activity_flusher,
+    stop_program_run_writer,
+    stop_session_activity_flusher,
     update_user,
     verify_password,
 )
+import metrics
 
 BASE_DIR = Path(__file__).resolve().parent
 LESSON_DIR = BASE_DIR / "lessons"
@@ -58,6 +94,72 @@ MEMORY_LIMIT_MB = int(os.getenv("EXECUTION_MEMORY_LIMIT_MB", "1024"))
 MIN_EXECUTION_INTERVAL = float(os.getenv("MIN_EXECUTION_INTERVAL_SECONDS", "5.0"))
 USER_CPU_BUDGET_SECONDS = float(os.getenv("USER_CPU_BUDGET_SECONDS", "15.0"))
 USER_CPU_BUDGET_WINDOW_SECONDS = float(os.getenv("USER_CPU_BUDGET_WINDOW_SECONDS", "60.0"))
+SANDBOX_POOL_SIZE = int(os.getenv("SANDBOX_POOL_SIZE", "4"))
+SANDBOX_MAX_JOBS_PER_WORKER = max(1, int(os.getenv("SANDBOX_MAX_JOBS_PER_WORKER", "1")))
+SANDBOX_WARMUP = os.getenv("SANDBOX_WARMUP", "1") not in ("0", "false", "False", "")
+SANDBOX_READY_TIMEOUT = float(os.getenv("SANDBOX_READY_TIMEOUT_SECONDS", "30.0"))
+MAX_CONCURRENT_EXECUTIONS = max(
+    1, int(os.getenv("MAX_CONCURRENT_EXECUTIONS", str(SANDBOX_POOL_SIZE if SANDBOX_POOL_SIZE > 0 else 4)))
+)
+EXECUTION_QUEUE_TIMEOUT = float(os.getenv("EXECUTION_QUEUE_TIMEOUT_SECONDS", "10.0"))
+PASSWORD_HASH_WORKERS = max(1, int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1)))))
+PASSWORD_HASH_MAX_PENDING = max(1, int(os.getenv("PASSWORD_HASH_MAX_PENDING", "32")))
+PLOT_ADAPTIVE_SAMPLING = os.getenv("PLOT_ADAPTIVE_SAMPLING", "1") not in ("0", "false", "False", "")
+PLOT_DOWNSAMPLE_POINTS_PER_PIXEL = float(os.getenv("PLOT_DOWNSAMPLE_POINTS_PER_PIXEL", "2.0"))
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+EXECUTION_CACHE_MAX_BYTES = int(os.getenv("EXECUTION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+EXECUTION_CACHE_DIR = os.getenv("EXECUTION_CACHE_DIR", "")
+EXECUTION_CACHE_DISK_MAX_BYTES = int(os.getenv("EXECUTION_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+LESSON_WARMUP = os.getenv("LESSON_WARMUP", "0") not in ("0", "false", "False", "")
+LESSON_WARMUP_CONCURRENCY = max(1, int(os.getenv("LESSON_WARMUP_CONCURRENCY", "2")))
+HISTORY_PREVIEW_CHARS = max(1, int(os.getenv("HISTORY_PREVIEW_CHARS", "200")))
+MATERIALS_RELOAD_INTERVAL = float(os.getenv("MATERIALS_RELOAD_INTERVAL_SECONDS", "2.0"))
+MATERIALS_RENDER_CACHE_DIR = os.getenv("MATERIALS_RENDER_CACHE_DIR", str(BASE_DIR / "data" / "render_cache"))
+MATERIALS_RENDER_WORKERS = max(1, int(os.getenv("MATERIALS_RENDER_WORKERS", str(min(4, os.cpu_count() or 1)))))
+
+logger = logging.getLogger(__name__)
+
+_request_duration = metrics.histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template",
+    ("method", "route", "status"),
+    buckets=metrics.REQUEST_BUCKETS,
+)
+_sandbox_spawn_seconds = metrics.histogram(
+    "sandbox_spawn_seconds",
+    "Sandbox process startup until the child is ready to run user code (pooled workers include warm-up)",
+    ("mode",),
+    buckets=metrics.SANDBOX_BUCKETS,
+)
+_sandbox_execution_seconds = metrics.histogram(
+    "sandbox_execution_seconds",
+    "Wall time of one sandbox run as seen by the server, including IPC",
+    ("outcome",),
+    buckets=metrics.SANDBOX_BUCKETS,
+)
+_sandbox_cpu_seconds = metrics.histogram(
+    "sandbox_cpu_seconds", "CPU time used inside the sandbox for one run", buckets=metrics.SANDBOX_BUCKETS
+)
+_plot_serialization_seconds = metrics.histogram(
+    "plot_serialization_seconds", "Time spent serializing a Bokeh plot with json_item", buckets=metrics.SANDBOX_BUCKETS
+)
+_sandbox_timeouts = metrics.counter("sandbox_timeouts_total", "Sandbox runs stopped after EXECUTION_TIMEOUT")
+_sandbox_crashes = metrics.counter("sandbox_crashes_total", "Sandbox runs whose process exited without a result")
+_rate_limited = metrics.counter(
+    "execution_rate_limited_total", "Executions rejected with 429, by limit", ("reason",)
+)
+for _reason in ("interval", "cpu_budget"):
+    _rate_limited.inc(_reason, amount=0)
+_execution_rejected = metrics.counter(
+    "execution_queue_rejected_total", "Executions rejected with 503 because the sandbox queue was full"
+)
+_sandboxes_active = metrics.gauge("sandboxes_active", "Sandbox runs in progress")
+_sandboxes_queued = metrics.gauge("sandboxes_queued", "Executions waiting for a free sandbox slot")
+
+# 適応サンプリングの初期分割数・最大細分化回数・許容誤差 (y 方向の値域に対する比率)
+_ADAPTIVE_INITIAL_POINTS = 33
+_ADAPTIVE_MAX_DEPTH = 12
+_ADAPTIVE_TOLERANCE = 0.002
 
 
 class CodeRequest(BaseModel):
@@ -85,31 +187,253 @@ class UserUpdateRequest(BaseModel):
     is_admin: Optional[bool] = None
 
 
-def _load_materials() -> list[dict[str, Any]]:
+class BulkUnlockRequest(BaseModel):
+    material_ids: list[int]
+    user_ids: Optional[list[int]] = None
+
+
+_PYTHON_CODE_BLOCK = re.compile(r"^```python[ \t]*\n(.*?)^```[ \t]*$", re.MULTILINE | re.DOTALL)
+
+
+def _extract_code_blocks(text: str) -> list[str]:
+    """教材 Markdown 中の ```python で囲まれたコードブロックを順番に取り出す。"""
+    return [block for block in _PYTHON_CODE_BLOCK.findall(text) if block.strip()]
+
+
+MARKDOWN_EXTENSIONS = ("fenced_code", "tables", "toc")
+
+
+def _render_markdown(text: str) -> str:
+    """教材 Markdown を HTML へ変換する。プロセスプールからも呼ぶのでモジュール直下に置く。"""
+    return markdown(text, extensions=list(MARKDOWN_EXTENSIONS))
+
+
+def _render_cache_key(source_hash: str) -> str:
+    """描画結果は本文と Markdown のバージョン・拡張の組み合わせだけで決まる。"""
+    settings = f"{markdown_version}\n{','.join(MARKDOWN_EXTENSIONS)}\n{source_hash}"
+    return hashlib.sha256(settings.encode("utf-8")).hexdigest()
+
+
+def _parse_material(path: Path, text: str, html: str) -> Dict[str, Any]:
+    """
+    最初の見出し行を教材タイトルとして利用し、コードブロックは
+    実行結果の事前キャッシュ用に code_blocks として残しておく。
+    """
+    title = path.stem
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("#"):
+            title = stripped.lstrip("# ")
+            break
+    return {"title": title, "content": html, "code_blocks": _extract_code_blocks(text)}
+
+
+class MaterialStore:
     """
-    lessonsフォルダの Markdown ファイルを読み込み、HTML へ変換してメモリに展開する。
+    lessons フォルダの Markdown ファイルを HTML へ変換してメモリに保持する。
+
+    ファイル名順に教材 ID を振る。reload_interval 秒ごと (負なら起動時のみ) に
+    mtime とサイズを確認し、変わったファイルは内容のハッシュを比べて、
+    本当に変わったものだけを描き直す。サーバーを再起動せずに教材の修正が反映される。
+
+    各教材の version は ID と本文のハッシュから作り、ETag と一覧 API の version に使う。
 
-    起動時に一度だけ実行され、以降のAPIリクエストではこのキャッシュされたリストを返す。
-    ファイル名から教材IDを決定し、最初の見出し行を教材タイトルとして利用する。
+    render_cache_dir を指定すると描画済み HTML をそこに保存し、再起動や別のワーカー
+    プロセスでは描き直さずに読み込む。refresh(parallel=True) のときはキャッシュに無い教材を
+    プロセスプールで並列に描画する。直近の読み込みにかかった時間は stats で確認できる。
     """
-    materials: list[dict[str, Any]] = []
-    if not LESSON_DIR.exists():
-        return materials
 
-    for idx, path in enumerate(sorted(LESSON_DIR.glob("*.md"))):
-        text = path.read_text(encoding="utf-8")
-        title = path.stem
-        for line in text.splitlines():
-            stripped = line.strip()
-            if stripped.startswith("#"):
-                title = stripped.lstrip("# ")
-                break
-        html = markdown(text, extensions=["fenced_code", "tables", "toc"])
-        materials.append({"id": idx, "title": title, "content": html})
-    return materials
+    def __init__(
+        self,
+        directory: Path,
+        reload_interval: float,
+        render_cache_dir: Optional[Path] = None,
+        render_workers: int = 1,
+    ) -> None:
+        self._directory = directory
+        self._reload_interval = reload_interval
+        self._render_cache_dir = render_cache_dir
+        self._render_workers = render_workers
+        self.stats: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        # path -> {"signature": (mtime_ns, size), "hash": str, "title": ..., "content": ..., "code_blocks": ...}
+        self._files: Dict[Path, Dict[str, Any]] = {}
+        self._materials: list[Dict[str, Any]] = []
+        self._version = ""
+        self._checked_at: Optional[float] = None
+
+    def materials(self) -> list[Dict[str, Any]]:
+        self._refresh_if_due()
+        return self._materials
+
+    def get(self, material_id: int) -> Optional[Dict[str, Any]]:
+        materials = self.materials()
+        if material_id < 0 or material_id >= len(materials):
+            return None
+        return materials[material_id]
+
+    @property
+    def version(self) -> str:
+        self._refresh_if_due()
+        return self._version
+
+    def _render_all(
+        self, sources: Dict[Path, tuple[str, str]], parallel: bool
+    ) -> tuple[Dict[Path, str], Dict[str, Any]]:
+        """
+        (本文, ハッシュ) の組を HTML にして返す。ディスクキャッシュにあるものは読み込み、
+        残りを (件数が多ければプロセスプールで並列に) 描画してキャッシュへ書き込む。
+        """
+        started = time.perf_counter()
+        html: Dict[Path, str] = {}
+        misses: list[Path] = []
+        for path, (_, digest) in sources.items():
+            cached = self._read_render_cache(digest)
+            if cached is None:
+                misses.append(path)
+            else:
+                html[path] = cached
+        # プロセスの起動に見合うよう、1 プロセスあたり 2 件以上あるときだけ並列にする
+        workers = min(self._render_workers, len(misses) // 2) if parallel else 1
+        texts = [sources[path][0] for path in misses]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_render_markdown, texts, chunksize=max(1, len(texts) // (workers * 4))))
+        else:
+            results = [_render_markdown(text) for text in texts]
+        for path, rendered in zip(misses, results):
+            html[path] = rendered
+            self._write_render_cache(sources[path][1], rendered)
+        return html, {
+            "cache_hits": len(sources) - len(misses),
+            "rendered": len(misses),
+            "render_workers": max(workers, 1) if misses else 0,
+            "render_seconds": time.perf_counter() - started,
+        }
+
+    def _render_cache_path(self, source_hash: str) -> Optional[Path]:
+        if self._render_cache_dir is None:
+            return None
+        return self._render_cache_dir / f"{_render_cache_key(source_hash)}.html"
+
+    def _read_render_cache(self, source_hash: str) -> Optional[str]:
+        path = self._render_cache_path(source_hash)
+        if path is None:
+            return None
+        try:
+            return path.read_text(encoding="utf-8")
+        except (FileNotFoundError, UnicodeDecodeError):
+            return None
+
+    def _write_render_cache(self, source_hash: str, html: str) -> None:
+        path = self._render_cache_path(source_hash)
+        if path is None:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # 別のワーカーが同時に書いても壊れないよう、一時ファイルから置き換える
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            tmp.write_text(html, encoding="utf-8")
+            os.replace(tmp, path)
+        except OSError:
+            logger.warning("failed to write render cache %s", path, exc_info=True)
+
+    def _refresh_if_due(self) -> None:
+        now = time.monotonic()
+        if self._checked_at is not None and (
+            self._reload_interval < 0 or now - self._checked_at < self._reload_interval
+        ):
+            return
+        self.refresh()
+
+    def refresh(self, parallel: bool = False) -> bool:
+        """
+        ファイルの変更を確認し、教材の一覧が変わったら True を返す。
+        parallel はプロセスを fork しても安全な (他のスレッドを起動する前の) 起動時にだけ使う。
+        """
+        with self._lock:
+            started = time.perf_counter()
+            self._checked_at = time.monotonic()
+            paths = sorted(self._directory.glob("*.md")) if self._directory.exists() else []
+            changed = paths != list(self._files)
+            files: Dict[Path, Dict[str, Any]] = {}
+            # 内容が変わったファイル: path -> (signature, text, hash)
+            modified: Dict[Path, tuple[tuple[int, int], str, str]] = {}
+            for path in paths:
+                try:
+                    stat = path.stat()
+                    signature = (stat.st_mtime_ns, stat.st_size)
+                    entry = self._files.get(path)
+                    if entry is None or entry["signature"] != signature:
+                        text = path.read_text(encoding="utf-8")
+                        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+                        if entry is None or entry["hash"] != digest:
+                            modified[path] = (signature, text, digest)
+                            changed = True
+                            continue
+                        entry = {**entry, "signature": signature}
+                except FileNotFoundError:
+                    # 確認中に削除されたファイルは次回の一覧から外れる
+                    changed = True
+                    continue
+                files[path] = entry
+            render_stats: Dict[str, Any] = {}
+            if modified:
+                rendered, render_stats = self._render_all(
+                    {path: (text, digest) for path, (_, text, digest) in modified.items()}, parallel
+                )
+                for path, (signature, text, digest) in modified.items():
+                    files[path] = {
+                        **_parse_material(path, text, rendered[path]),
+                        "hash": digest,
+                        "signature": signature,
+                    }
+            # ファイル名順を保つ
+            files = {path: files[path] for path in paths if path in files}
+            self._files = files
+            if not changed:
+                return False
+            materials = []
+            for idx, entry in enumerate(files.values()):
+                materials.append(
+                    {
+                        "id": idx,
+                        "title": entry["title"],
+                        "content": entry["content"],
+                        "code_blocks": entry["code_blocks"],
+                        "version": f"{idx}-{entry['hash'][:16]}",
+                    }
+                )
+            self._materials = materials
+            self._version = hashlib.sha256(
+                "\n".join(material["version"] for material in materials).encode("utf-8")
+            ).hexdigest()[:16]
+            self.stats = {
+                "materials": len(materials),
+                "modified": len(modified),
+                "seconds": time.perf_counter() - started,
+                **render_stats,
+            }
+            logger.info(
+                "loaded %d materials (version %s) in %.3fs: %s",
+                len(materials),
+                self._version,
+                self.stats["seconds"],
+                render_stats or "no changes to render",
+            )
+            return True
+
 
+def _material_payload(material: Dict[str, Any]) -> Dict[str, Any]:
+    return {"id": material["id"], "title": material["title"], "content": material["content"]}
 
-MATERIALS = _load_materials()
+
+material_store = MaterialStore(
+    LESSON_DIR,
+    MATERIALS_RELOAD_INTERVAL,
+    render_cache_dir=Path(MATERIALS_RENDER_CACHE_DIR) if MATERIALS_RENDER_CACHE_DIR else None,
+    render_workers=MATERIALS_RENDER_WORKERS,
+)
 
 
 security = HTTPBearer(auto_error=False)
@@ -132,6 +456,86 @@ def _ensure_admin(user: UserRecord) -> None:
         raise HTTPException(status_code=403, detail="管理者権限が必要です")
 
 
+@dataclass
+class _RunEntry:
+    started_at: datetime
+    cpu_seconds: float = 0.0
+    cached: bool = False
+
+
+class RunRateLimiter:
+    """
+    ユーザーごとの直近の実行履歴をメモリ上のスライディングウィンドウで保持し、
+    連続実行の間隔と CPU 使用量の上限を SQLite に問い合わせずに判定する。
+
+    起動時に program_runs から窓の範囲内の実行を読み込んで復元する。
+    実行は受け付けた時点で reserve して記録するため、同じユーザーの同時リクエストも
+    間隔制限にかかる。CPU 時間は実行後に complete で書き込む。
+    """
+
+    def __init__(self) -> None:
+        self._runs: Dict[int, "deque[_RunEntry]"] = {}
+        self._lock = threading.Lock()
+        self._retention = timedelta(seconds=max(MIN_EXECUTION_INTERVAL, USER_CPU_BUDGET_WINDOW_SECONDS))
+
+    def load(self, runs: list[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._runs.clear()
+            for run in sorted(runs, key=lambda item: item["created_at"]):
+                self._runs.setdefault(run["user_id"], deque()).append(
+                    _RunEntry(run["created_at"], float(run["execution_time"] or 0.0), bool(run["cached"]))
+                )
+
+    def _recent(self, user_id: int, now: datetime) -> "deque[_RunEntry]":
+        runs = self._runs.get(user_id)
+        if runs is None:
+            return deque()
+        while runs and now - runs[0].started_at > self._retention:
+            runs.popleft()
+        if not runs:
+            del self._runs[user_id]
+        return runs
+
+    def reserve(self, user_id: int, now: datetime) -> _RunEntry:
+        entry = _RunEntry(now)
+        with self._lock:
+            self._runs.setdefault(user_id, deque()).append(entry)
+        return entry
+
+    def complete(self, entry: _RunEntry, cpu_seconds: float, cached: bool) -> None:
+        with self._lock:
+            entry.cpu_seconds = cpu_seconds
+            entry.cached = cached
+
+    def cancel(self, user_id: int, entry: _RunEntry) -> None:
+        with self._lock:
+            runs = self._runs.get(user_id)
+            if runs is not None and entry in runs:
+                runs.remove(entry)
+
+    def seconds_until_next_run(self, user_id: int, now: datetime) -> float:
+        with self._lock:
+            runs = self._recent(user_id, now)
+            if not runs:
+                return 0.0
+            last_run = runs[-1].started_at
+        return max(0.0, MIN_EXECUTION_INTERVAL - (now - last_run).total_seconds())
+
+    def seconds_until_cpu_budget_resets(self, user_id: int, now: datetime) -> float:
+        window_start = now - timedelta(seconds=USER_CPU_BUDGET_WINDOW_SECONDS)
+        with self._lock:
+            in_window = [
+                run for run in self._recent(user_id, now) if not run.cached and run.started_at >= window_start
+            ]
+        if sum(run.cpu_seconds for run in in_window) < USER_CPU_BUDGET_SECONDS:
+            return 0.0
+        elapsed = (now - in_window[0].started_at).total_seconds()
+        return max(1.0, USER_CPU_BUDGET_WINDOW_SECONDS - elapsed)
+
+
+rate_limiter = RunRateLimiter()
+
+
 def _seconds_until_next_run(user_id: int, now: datetime) -> float:
     """
     直近の実行時刻からの経過を確認し、次に実行できるまでの残り秒数を計算する。
@@ -139,10 +543,7 @@ def _seconds_until_next_run(user_id: int, now: datetime) -> float:
     クライアント側のクールダウン表示と HTTP 429 応答の両方で利用するため、
     負の値にならないように 0 で下限を切り上げる。
     """
-    last_run = get_last_program_run_time(user_id)
-    if last_run is None:
-        return 0.0
-    return max(0.0, MIN_EXECUTION_INTERVAL - (now - last_run).total_seconds())
+    return rate_limiter.seconds_until_next_run(user_id, now)
 
 
 def _seconds_until_cpu_budget_resets(user_id: int, now: datetime) -> float:
@@ -153,14 +554,7 @@ def _seconds_until_cpu_budget_resets(user_id: int, now: datetime) -> float:
     """
     if USER_CPU_BUDGET_SECONDS <= 0:
         return 0.0
-    recent_cpu_usage = get_execution_time_since(user_id, USER_CPU_BUDGET_WINDOW_SECONDS)
-    if recent_cpu_usage < USER_CPU_BUDGET_SECONDS:
-        return 0.0
-    oldest_run = get_oldest_run_within_window(user_id, USER_CPU_BUDGET_WINDOW_SECONDS)
-    if oldest_run is None:
-        return MIN_EXECUTION_INTERVAL
-    elapsed = (now - oldest_run).total_seconds()
-    return max(1.0, USER_CPU_BUDGET_WINDOW_SECONDS - elapsed)
+    return rate_limiter.seconds_until_cpu_budget_resets(user_id, now)
 
 
 def get_current_user(
@@ -219,6 +613,161 @@ def _allowed_builtins() -> Dict[str, Any]:
     return safe_builtins
 
 
+def _to_float(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def _evaluate_pointwise(func: Any, values: np.ndarray) -> np.ndarray:
+    """1 点ずつ関数を呼び出す従来の経路。例外が出た点は NaN にする。"""
+    results = np.empty(len(values), dtype=float)
+    for index, value in enumerate(values):
+        try:
+            results[index] = _to_float(func(float(value)))
+        except Exception:
+            results[index] = float("nan")
+    return results
+
+
+def _evaluate_function(func: Any, values: np.ndarray) -> np.ndarray:
+    """
+    学習者が渡した関数を標本点全体に対して評価し、float の ndarray を返す。
+
+    まず配列をそのまま渡して numpy のベクトル演算 (ufunc や np.vectorize) で一括評価し、
+    math.sin のようにスカラーしか受け付けない関数や、形の合わない結果が返った場合は
+    1 点ずつ評価する経路にフォールバックする。
+    """
+    try:
+        with np.errstate(all="ignore"):
+            result = func(values)
+        if np.iscomplexobj(result):
+            raise TypeError("complex result")
+        array = np.array(result, dtype=float)
+    except Exception:
+        return _evaluate_pointwise(func, values)
+    if array.ndim == 0:
+        # lambda x: 3 のような定数関数は全点に広げる
+        array = np.full(len(values), float(array))
+    if array.shape != values.shape:
+        return _evaluate_pointwise(func, values)
+    # 1/x の x=0 のように 1 点ずつなら例外になる点は、同じく NaN として扱う
+    array[~np.isfinite(array)] = np.nan
+    return array
+
+
+def _locate_discontinuities(
+    func: Any, xs: np.ndarray, ys: np.ndarray, threshold: float
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    隣り合う標本の間で値が大きく変わる区間を二分探索し、不連続点を探す。
+
+    値の差が大きい側の半分を選びながら区間を狭めていき、滑らかな関数なら差は
+    毎回ほぼ半分に縮むので途中で候補から外す。最小幅まで狭めても差が縮まらない
+    区間を不連続点とみなし、その位置と両端の点を返す。
+    """
+    jump = np.abs(ys[1:] - ys[:-1])
+    candidates = np.flatnonzero(np.isfinite(jump) & (jump > threshold))
+    left, right = xs[:-1][candidates], xs[1:][candidates]
+    y_left, y_right = ys[:-1][candidates], ys[1:][candidates]
+    holes: list[np.ndarray] = []
+    for _ in range(_ADAPTIVE_MAX_DEPTH):
+        if not left.size:
+            break
+        previous = np.abs(y_right - y_left)
+        mid = (left + right) / 2
+        y_mid = _evaluate_function(func, mid)
+        hole = np.isnan(y_mid)
+        holes.append(mid[hole])
+        go_left = np.abs(y_mid - y_left) >= np.abs(y_right - y_mid)
+        left, right = np.where(go_left, left, mid), np.where(go_left, mid, right)
+        y_left, y_right = np.where(go_left, y_left, y_mid), np.where(go_left, y_mid, y_right)
+        keep = ~hole & (np.abs(y_right - y_left) > 0.75 * previous)
+        left, right, y_left, y_right = left[keep], right[keep], y_left[keep], y_right[keep]
+    breaks = np.concatenate([*holes, (left + right) / 2])
+    return breaks, left, y_left, right, y_right
+
+
+def _adaptive_sample(func: Any, start: float, end: float, budget: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    粗い等間隔の標本から始め、曲がっている区間や値が飛ぶ区間だけを中点で細分する。
+
+    先に不連続点を探して NaN を挟むことで線を切り、残りの点数で、中点の値と
+    両端の直線補間との差が y の値域に対して大きい区間を細分する。
+    点数が budget に達したら誤差の大きい区間を優先する。
+    """
+    budget = max(2, int(budget))
+    initial = min(budget, _ADAPTIVE_INITIAL_POINTS)
+    xs = np.linspace(start, end, initial)
+    ys = _evaluate_function(func, xs)
+    if initial < 3:
+        return xs, ys
+
+    finite = ys[np.isfinite(ys)]
+    scale = float(np.subtract(*np.percentile(finite, [95, 5]))) if finite.size else 0.0
+    if scale <= 0:
+        scale = max(float(np.max(np.abs(finite))) if finite.size else 0.0, 1.0)
+    tolerance = _ADAPTIVE_TOLERANCE * scale
+    min_width = abs(end - start) / ((initial - 1) * 2**_ADAPTIVE_MAX_DEPTH)
+
+    breaks, jump_left, jump_y_left, jump_right, jump_y_right = _locate_discontinuities(
+        func, xs, ys, tolerance
+    )
+    room = budget - xs.size
+    if breaks.size + 2 * jump_left.size > room:
+        # 点数が足りなければ線を切る NaN だけを残し、飛びの両側の点は諦める
+        breaks = np.sort(breaks)[:room]
+        jump_left = jump_y_left = jump_right = jump_y_right = np.empty(0)
+    xs = np.concatenate([xs, jump_left, jump_right])
+    ys = np.concatenate([ys, jump_y_left, jump_y_right])
+    order = np.argsort(xs, kind="stable")
+    xs, ys = xs[order], ys[order]
+
+    # 不連続点をまたぐ区間は細分しない
+    crosses_break = np.isin(xs[:-1], jump_left) & np.isin(xs[1:], jump_right)
+    left, right = xs[:-1][~crosses_break], xs[1:][~crosses_break]
+    y_left, y_right = ys[:-1][~crosses_break], ys[1:][~crosses_break]
+    added_x: list[np.ndarray] = []
+    added_y: list[np.ndarray] = []
+    # 末尾で足す不連続点の NaN も budget に数える
+    count = xs.size + breaks.size
+    while left.size and count < budget:
+        mid = (left + right) / 2
+        y_mid = _evaluate_function(func, mid)
+        nan_left, nan_right, nan_mid = np.isnan(y_left), np.isnan(y_right), np.isnan(y_mid)
+        with np.errstate(all="ignore"):
+            error = np.abs(y_mid - (y_left + y_right) / 2)
+        # 定義域の端を探すため、NaN が混ざる区間は優先して細分する
+        error[nan_left | nan_right | nan_mid] = np.inf
+        error[nan_left & nan_right & nan_mid] = 0.0
+        refine = (error > tolerance) & ((right - left) > min_width)
+
+        selected = np.flatnonzero(refine)
+        room = budget - count
+        if selected.size > room:
+            selected = np.sort(selected[np.argsort(-error[selected], kind="stable")[:room]])
+        added_x.append(mid[selected])
+        added_y.append(y_mid[selected])
+        count += selected.size
+
+        left, right = np.concatenate([left[selected], mid[selected]]), np.concatenate([mid[selected], right[selected]])
+        y_left, y_right = (
+            np.concatenate([y_left[selected], y_mid[selected]]),
+            np.concatenate([y_mid[selected], y_right[selected]]),
+        )
+
+    all_x = np.concatenate([xs, *added_x, breaks])
+    all_y = np.concatenate([ys, *added_y, np.full(breaks.size, np.nan)])
+    order = np.argsort(all_x, kind="stable")
+    return all_x[order], all_y[order]
+
+
+def _legend_kwargs(legend_label: Optional[str]) -> Dict[str, Any]:
+    # Bokeh は legend_label=None を受け付けないため、指定された時だけ渡す
+    return {"legend_label": legend_label} if legend_label is not None else {}
+
+
 def _create_environment() -> Dict[str, Any]:
     """
     実行環境に渡すグローバル辞書を生成する。
@@ -252,16 +801,16 @@ def _create_environment() -> Dict[str, Any]:
         target_plot: Optional[LayoutDOM] = None,
         line_color: str = "#1f77b4",
         legend_label: Optional[str] = None,
+        adaptive: Optional[bool] = None,
     ) -> LayoutDOM:
         target = _target_plot(target_plot)
-        xs = np.linspace(x_start, x_end, num)
-        ys = []
-        for x in xs:
-            try:
-                ys.append(func(float(x)))
-            except Exception:
-                ys.append(float("nan"))
-        target.line(xs, ys, color=line_color, line_width=2, legend_label=legend_label)
+        if adaptive if adaptive is not None else PLOT_ADAPTIVE_SAMPLING:
+            # num は適応サンプリングでの点数の上限として扱う
+            xs, ys = _adaptive_sample(func, x_start, x_end, num)
+        else:
+            xs = np.linspace(x_start, x_end, num)
+            ys = _evaluate_function(func, xs)
+        target.line(xs, ys, color=line_color, line_width=2, **_legend_kwargs(legend_label))
         return target
 
     def plot_points(
@@ -277,9 +826,9 @@ def _create_environment() -> Dict[str, Any]:
         source = ColumnDataSource({"x": list(x_values), "y": list(y_values)})
         glyph = getattr(target, marker, None)
         if callable(glyph):
-            glyph("x", "y", source=source, size=size, color=color, legend_label=legend_label)
+            glyph("x", "y", source=source, size=size, color=color, **_legend_kwargs(legend_label))
         else:
-            target.circle("x", "y", source=source, size=size, color=color, legend_label=legend_label)
+            target.circle("x", "y", source=source, size=size, color=color, **_legend_kwargs(legend_label))
         return target
 
     def plot_parametric(
@@ -294,16 +843,13 @@ def _create_environment() -> Dict[str, Any]:
     ) -> LayoutDOM:
         target = _target_plot(target_plot)
         ts = np.linspace(t_start, t_end, num)
-        xs = []
-        ys = []
-        for t in ts:
-            try:
-                xs.append(x_func(float(t)))
-                ys.append(y_func(float(t)))
-            except Exception:
-                xs.append(float("nan"))
-                ys.append(float("nan"))
-        target.line(xs, ys, color=line_color, line_width=2, legend_label=legend_label)
+        xs = _evaluate_function(x_func, ts)
+        ys = _evaluate_function(y_func, ts)
+        # 片方の座標だけ評価できなかった点は、従来どおり両方 NaN にして線を切る
+        invalid = np.isnan(xs) | np.isnan(ys)
+        xs[invalid] = np.nan
+        ys[invalid] = np.nan
+        target.line(xs, ys, color=line_color, line_width=2, **_legend_kwargs(legend_label))
         return target
 
     environment.update(
@@ -323,11 +869,25 @@ def _create_environment() -> Dict[str, Any]:
     return environment
 
 
-def _limit_system_resources() -> None:
+def _cpu_seconds_used() -> float:
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _limit_system_resources(max_jobs: int = 1) -> None:
+    """
+    サンドボックスプロセスの CPU 時間・メモリ・ファイルディスクリプタを制限する。
+
+    ワーカーを再利用する場合は max_jobs 回分の CPU 時間をハードリミットとして確保し、
+    ジョブごとのソフトリミットは _limit_job_cpu_time で設定する。
+    """
     if resource is None:
         return
     # CPU 時間を制限し、無限ループや重い処理がサーバーを占有しないようにする
-    resource.setrlimit(resource.RLIMIT_CPU, (int(EXECUTION_TIMEOUT), int(EXECUTION_TIMEOUT)))
+    cpu_limit = int(_cpu_seconds_used()) + int(EXECUTION_TIMEOUT) * max_jobs
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit))
     # メモリ使用量の上限を設定し、過剰なメモリ確保を防ぐ
     limit_bytes = MEMORY_LIMIT_MB * 1024 * 1024
     resource.setrlimit(resource.RLIMIT_AS, (limit_bytes, limit_bytes))
@@ -335,22 +895,232 @@ def _limit_system_resources() -> None:
     resource.setrlimit(resource.RLIMIT_NOFILE, (64, 64))
 
 
-def _execute_user_code(code: str, queue: Queue) -> None:
+def _limit_job_cpu_time() -> None:
+    """
+    再利用ワーカーで次のジョブを始める前に、CPU 時間のソフトリミットを張り直す。
+
+    RLIMIT_CPU はプロセスの累積値で判定されるため、これまでの使用量に
+    EXECUTION_TIMEOUT を足した値を上限とし、ハードリミットは超えないようにする。
+    """
+    if resource is None:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = math.ceil(_cpu_seconds_used()) + int(EXECUTION_TIMEOUT)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _lttb_indices(xs: np.ndarray, ys: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets で折れ線の形を保ったまま間引く点のインデックスを返す。
+
+    先頭と末尾の点は必ず残し、間の点を threshold - 2 個のバケツに分けて、
+    前に選んだ点と次のバケツの平均点とで作る三角形の面積が最大の点を 1 つずつ選ぶ。
+    """
+    length = xs.size
+    if threshold >= length or threshold < 3:
+        return np.arange(length)
+    edges = np.linspace(1, length - 1, threshold - 1).astype(int)
+    selected = np.empty(threshold, dtype=int)
+    selected[0] = 0
+    selected[-1] = length - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, stop = edges[bucket], max(edges[bucket + 1], edges[bucket] + 1)
+        next_start, next_stop = edges[bucket + 1], edges[bucket + 2] if bucket + 2 < edges.size else length
+        next_stop = max(next_stop, next_start + 1)
+        avg_x = xs[next_start:next_stop].mean()
+        avg_y = ys[next_start:next_stop].mean()
+        area = np.abs(
+            (xs[previous] - avg_x) * (ys[start:stop] - ys[previous])
+            - (xs[previous] - xs[start:stop]) * (avg_y - ys[previous])
+        )
+        previous = start + int(np.argmax(area))
+        selected[bucket + 1] = previous
+    return selected
+
+
+def _line_downsample_indices(xs: np.ndarray, ys: np.ndarray, budget: int) -> np.ndarray:
+    """
+    NaN で区切られた線分ごとに LTTB をかけ、線の切れ目 (NaN) はそのまま残す。
+
+    点数の上限は各線分の長さに比例して割り振る。
+    """
+    finite = np.isfinite(xs) & np.isfinite(ys)
+    breaks = np.flatnonzero(~finite)
+    bounds = np.concatenate([[-1], breaks, [xs.size]])
+    finite_count = max(int(finite.sum()), 1)
+    kept: list[np.ndarray] = [breaks]
+    for left, right in zip(bounds[:-1], bounds[1:]):
+        start, stop = left + 1, right
+        if stop <= start:
+            continue
+        share = max(3, int(budget * (stop - start) / finite_count))
+        kept.append(start + _lttb_indices(xs[start:stop], ys[start:stop], share))
+    return np.sort(np.concatenate(kept))
+
+
+def _scatter_downsample_indices(
+    xs: np.ndarray, ys: np.ndarray, budget: int, width: int, height: int
+) -> np.ndarray:
+    """
+    散布図の点を画面のピクセル格子に割り当て、同じマスに入る点は 1 つだけ残す。
+
+    それでも budget を超える場合は、マスの数を半分ずつ減らして粗くしていく。
+    """
+    finite = np.flatnonzero(np.isfinite(xs) & np.isfinite(ys))
+    if not finite.size:
+        return finite
+    fx, fy = xs[finite], ys[finite]
+    span_x = float(np.ptp(fx)) or 1.0
+    span_y = float(np.ptp(fy)) or 1.0
+    cells_x, cells_y = max(width, 1), max(height, 1)
+    while True:
+        col = ((fx - fx.min()) / span_x * (cells_x - 1)).astype(np.int64)
+        row = ((fy - fy.min()) / span_y * (cells_y - 1)).astype(np.int64)
+        _, first = np.unique(col * cells_y + row, return_index=True)
+        if first.size <= budget or (cells_x == 1 and cells_y == 1):
+            return np.sort(finite[first])
+        cells_x, cells_y = max(1, int(cells_x / math.sqrt(2))), max(1, int(cells_y / math.sqrt(2)))
+
+
+def _field_name(spec: Any) -> Optional[str]:
+    if isinstance(spec, str):
+        return spec
+    if isinstance(spec, dict) and isinstance(spec.get("field"), str):
+        return spec["field"]
+    return None
+
+
+def _downsample_plot(plot: LayoutDOM) -> list[Dict[str, Any]]:
+    """
+    json_item に渡す前に、点数が多すぎる折れ線・散布図のデータを間引く。
+
+    点数の上限はプロットの横幅 (ピクセル) × PLOT_DOWNSAMPLE_POINTS_PER_PIXEL で、
+    折れ線は LTTB、散布図はピクセル格子で間引く。他のレンダラーと共有されている
+    ColumnDataSource は触らない。間引いた内容を実行ログ表示用に返す。
+    """
+    if PLOT_DOWNSAMPLE_POINTS_PER_PIXEL <= 0:
+        return []
+    plots = plot.select({"type": Plot})
+    source_users: Dict[str, int] = {}
+    for target in plots:
+        for renderer in target.renderers:
+            if isinstance(renderer, GlyphRenderer):
+                source_users[renderer.data_source.id] = source_users.get(renderer.data_source.id, 0) + 1
+
+    report: list[Dict[str, Any]] = []
+    for target in plots:
+        width = int(target.width or 600)
+        height = int(target.height or 400)
+        budget = max(3, int(width * PLOT_DOWNSAMPLE_POINTS_PER_PIXEL))
+        for renderer in target.renderers:
+            if not isinstance(renderer, GlyphRenderer) or not isinstance(renderer.data_source, ColumnDataSource):
+                continue
+            glyph = renderer.glyph
+            if not isinstance(glyph, (Line, Scatter, Circle)):
+                continue
+            source = renderer.data_source
+            if source_users.get(source.id, 0) != 1:
+                continue
+            x_field, y_field = _field_name(glyph.x), _field_name(glyph.y)
+            data = dict(source.data)
+            if x_field not in data or y_field not in data:
+                continue
+            lengths = {len(column) for column in data.values()}
+            if len(lengths) != 1 or lengths.pop() <= budget:
+                continue
+            try:
+                xs = np.asarray(data[x_field], dtype=float)
+                ys = np.asarray(data[y_field], dtype=float)
+            except (TypeError, ValueError):
+                continue
+            if isinstance(glyph, Line):
+                indices = _line_downsample_indices(xs, ys, budget)
+            else:
+                indices = _scatter_downsample_indices(xs, ys, budget, width, height)
+            source.data = {
+                key: (np.asarray(column)[indices] if isinstance(column, np.ndarray) else [column[i] for i in indices])
+                for key, column in data.items()
+            }
+            report.append({"glyph": type(glyph).__name__, "original": int(xs.size), "kept": int(indices.size)})
+    return report
+
+
+def _use_binary_columns(plot: LayoutDOM) -> int:
+    """
+    数値だけのリスト列を ndarray に置き換え、json_item で base64 のバイナリとして送らせる。
+
+    Bokeh はリストを 10 進数の JSON 配列で書き出すが、ndarray なら 1 値 8 バイトの
+    base64 になる。置き換えで減った (と見積もれる) バイト数を返す。
     """
-    子プロセス側で実際にユーザーコードを実行する。
+    saved = 0
+    for source in plot.select({"type": ColumnDataSource}):
+        data = dict(source.data)
+        changed = False
+        for key, column in data.items():
+            if not isinstance(column, list) or not column:
+                continue
+            array = np.asarray(column)
+            if array.ndim != 1 or array.dtype.kind not in ("i", "f"):
+                continue
+            # 桁の少ない整数などはリストのほうが短いので、その場合は置き換えない。
+            # 列には numpy のスカラーが入っていることもあるので、tolist() で Python の数値にしてから測る
+            column_saved = len(json.dumps(array.tolist())) - 4 * math.ceil(array.nbytes / 3)
+            if column_saved <= 0:
+                continue
+            saved += column_saved
+            data[key] = array
+            changed = True
+        if changed:
+            source.data = data
+    return saved
+
+
+class _PhaseTimer:
+    """処理を段階に分け、段階ごとの経過時間 (秒) を timings に記録する。"""
+
+    def __init__(self) -> None:
+        self.timings: Dict[str, Any] = {}
+        self._phase: Optional[str] = None
+        self._start = 0.0
+
+    def start(self, phase: str) -> None:
+        """今の段階を終えて次の段階の計測を始める。"""
+        now = time.perf_counter()
+        self._finish(now)
+        self._phase, self._start = phase, now
+
+    def stop(self) -> Dict[str, Any]:
+        self._finish(time.perf_counter())
+        return self.timings
+
+    def _finish(self, now: float) -> None:
+        if self._phase is not None:
+            self.timings[self._phase] = self.timings.get(self._phase, 0.0) + now - self._start
+            self._phase = None
+
+
+def _run_user_code(code: str, env: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    渡された実行環境でユーザーコードを実行し、結果の辞書を返す。
 
     標準出力・エラーを StringIO で捕捉し、描画された Bokeh のプロットがあれば
-    json_item に変換して親プロセスへ送る。
+    json_item に変換して結果に含める。exec・プロットの選択・間引き・シリアライズの
+    所要時間を timings に入れる (起動や環境構築、通信の時間は呼び出し側が足す)。
     """
-    _limit_system_resources()
-    env = _create_environment()
     stdout_buffer = io.StringIO()
     stderr_buffer = io.StringIO()
 
+    timer = _PhaseTimer()
     start = time.perf_counter()
+    cpu_start = time.process_time()
     try:
+        timer.start("exec")
         with contextlib.redirect_stdout(stdout_buffer), contextlib.redirect_stderr(stderr_buffer):  # type: ignore[name-defined]
             exec(code, env, env)
+        timer.start("plot_selection")
         plot_candidate = None
         for key in ("plot", "fig", "figure", "p", "default_plot"):
             value = env.get(key)
@@ -366,64 +1136,847 @@ def _execute_user_code(code: str, queue: Queue) -> None:
                 plot_candidate = default_plot
         elif not getattr(plot_candidate, "renderers", []):
             plot_candidate = None
+        timer.start("downsample")
+        downsampled = _downsample_plot(plot_candidate) if plot_candidate is not None else []
+        timer.start("serialization")
+        binary_bytes_saved = _use_binary_columns(plot_candidate) if plot_candidate is not None else 0
         json_plot = json_item(plot_candidate, "bokeh-plot") if plot_candidate is not None else None
+        timer.stop()
         duration = time.perf_counter() - start
-        queue.put(
-            {
-                "success": True,
-                "plot": json_plot,
-                "stdout": stdout_buffer.getvalue(),
-                "stderr": stderr_buffer.getvalue(),
-                "execution_time": duration,
-            }
-        )
+        return {
+            "success": True,
+            "plot": json_plot,
+            "stdout": stdout_buffer.getvalue(),
+            "stderr": stderr_buffer.getvalue(),
+            "execution_time": duration,
+            "cpu_time": time.process_time() - cpu_start,
+            "timings": timer.timings,
+            "downsampled": downsampled,
+            "binary_bytes_saved": binary_bytes_saved,
+        }
     except Exception as exc:  # noqa: BLE001
+        timer.stop()
         duration = time.perf_counter() - start
-        queue.put(
-            {
-                "success": False,
-                "plot": None,
-                "stdout": stdout_buffer.getvalue(),
-                "stderr": stderr_buffer.getvalue() + "\n" + traceback.format_exc(),
-                "execution_time": duration,
-            }
+        return {
+            "success": False,
+            "plot": None,
+            "stdout": stdout_buffer.getvalue(),
+            "stderr": stderr_buffer.getvalue() + "\n" + traceback.format_exc(),
+            "execution_time": duration,
+            "cpu_time": time.process_time() - cpu_start,
+            "timings": timer.timings,
+        }
+
+
+def _execute_user_code(code: str, queue: Queue, spawned_at: float) -> None:
+    """
+    子プロセス側で実際にユーザーコードを実行する (プールを使わない場合の経路)。
+
+    リソース制限と実行環境の構築を行い、結果をキューで親プロセスへ送る。
+    起動 (spawned_at からここまで) と環境構築の時間も timings に入れ、
+    子プロセス内の合計を sandbox として添える (親が通信時間を求めるのに使う)。
+    """
+    job_start = time.perf_counter()
+    spawn_seconds = max(0.0, time.time() - spawned_at)
+    _limit_system_resources()
+    env_start = time.perf_counter()
+    env = _create_environment()
+    env_seconds = time.perf_counter() - env_start
+    result = _run_user_code(code, env)
+    result["timings"].update(spawn=spawn_seconds, environment=env_seconds)
+    result["timings"]["sandbox"] = spawn_seconds + time.perf_counter() - job_start
+    queue.put(result)
+
+
+_TIMEOUT_MESSAGE = "処理がタイムアウトしました。コードが長時間実行されていないか確認してください。"
+
+
+def _timeout_result() -> Dict[str, Any]:
+    return {
+        "success": False,
+        "plot": None,
+        "stdout": "",
+        "stderr": _TIMEOUT_MESSAGE,
+        "execution_time": EXECUTION_TIMEOUT,
+    }
+
+
+def _crash_result() -> Dict[str, Any]:
+    return {
+        "success": False,
+        "plot": None,
+        "stdout": "",
+        "stderr": "結果の取得中に問題が発生しました。",
+        "execution_time": 0.0,
+    }
+
+
+def _finish_timings(result: Dict[str, Any], mode: str, round_trip: float, spawn_wait: float = 0.0) -> Dict[str, Any]:
+    """
+    サンドボックスから届いた timings に、親プロセス側で測った値を足して仕上げる。
+    round_trip (依頼してから結果を受け取るまで) から子プロセス内の時間を引いた残りを
+    ipc (結果の受け渡しとプロセスの後始末) とし、spawn_wait は起動待ちとして spawn に足す。
+    """
+    timings = result.get("timings")
+    if timings is None:
+        return result
+    sandbox = timings.pop("sandbox", 0.0)
+    timings["spawn"] = timings.get("spawn", 0.0) + spawn_wait
+    timings["ipc"] = max(0.0, round_trip - sandbox)
+    timings["mode"] = mode
+    return result
+
+
+def _warm_up_sandbox() -> None:
+    """
+    ワーカー起動直後に一度だけ描画とシリアライズを空実行し、
+    Bokeh のモデル定義や numpy の遅延初期化を済ませておく。
+    """
+    env = _create_environment()
+    env["default_plot"].line([0.0, 1.0], [0.0, 1.0])
+    json_item(env["default_plot"], "bokeh-plot")
+
+
+def _sandbox_worker_main(conn: Connection, max_jobs: int, warmup: bool, spawned_at: float) -> None:
+    """
+    プールのワーカープロセス本体。
+
+    ウォームアップとリソース制限を済ませてから、起動にかかった秒数を添えて準備完了を通知し、
+    ジョブごとに新しい実行環境を用意して max_jobs 回まで実行したら終了する。
+    """
+    if warmup:
+        try:
+            _warm_up_sandbox()
+        except Exception:  # noqa: BLE001 - ウォームアップ失敗は本番の実行で検出する
+            pass
+    _limit_system_resources(max_jobs)
+    env_start = time.perf_counter()
+    env = _create_environment()
+    env_seconds = time.perf_counter() - env_start
+    conn.send(("ready", time.time() - spawned_at))
+    for job_index in range(max_jobs):
+        try:
+            code = conn.recv()
+        except EOFError:
+            return
+        if code is None:
+            return
+        job_start = time.perf_counter()
+        _limit_job_cpu_time()
+        result = _run_user_code(code, env)
+        # 環境はジョブが届く前に作ってあるので、environment は応答時間には含まれない
+        result["timings"]["environment"] = env_seconds
+        result["timings"]["sandbox"] = time.perf_counter() - job_start
+        conn.send(result)
+        if job_index + 1 < max_jobs:
+            # 前のジョブの変数やプロットが残らないよう、環境は毎回作り直す
+            env_start = time.perf_counter()
+            env = _create_environment()
+            env_seconds = time.perf_counter() - env_start
+
+
+class SandboxWorker:
+    """プールが管理する 1 つのサンドボックスプロセスと、その通信路をまとめたもの。"""
+
+    def __init__(self, max_jobs: int, warmup: bool) -> None:
+        parent_conn, child_conn = Pipe()
+        self.max_jobs = max_jobs
+        self.jobs_done = 0
+        self.ready = False
+        self.broken = False
+        self.conn = parent_conn
+        self.process = Process(
+            target=_sandbox_worker_main,
+            args=(child_conn, max_jobs, warmup, time.time()),
+            daemon=True,
         )
+        self.process.start()
+        child_conn.close()
+
+    @property
+    def reusable(self) -> bool:
+        return not self.broken and self.jobs_done < self.max_jobs and self.process.is_alive()
+
+    def _wait_ready(self) -> bool:
+        if self.ready:
+            return True
+        try:
+            if not self.conn.poll(SANDBOX_READY_TIMEOUT):
+                return False
+            message = self.conn.recv()
+        except (EOFError, OSError):
+            return False
+        self.ready = isinstance(message, tuple) and message[0] == "ready"
+        if self.ready:
+            _sandbox_spawn_seconds.observe(message[1], "pool")
+        return self.ready
+
+    def run(self, code: str) -> Dict[str, Any]:
+        """
+        ジョブを送信して結果を待つ。タイムアウトやクラッシュ時は broken にして
+        呼び出し側 (プール) に入れ替えを任せる。
+        """
+        wait_start = time.perf_counter()
+        if not self._wait_ready():
+            self.broken = True
+            return _crash_result()
+        try:
+            sent_at = time.perf_counter()
+            self.conn.send(code)
+            self.jobs_done += 1
+            if not self.conn.poll(EXECUTION_TIMEOUT):
+                self.broken = True
+                _sandbox_timeouts.inc()
+                return _timeout_result()
+            result = self.conn.recv()
+            return _finish_timings(result, "pool", time.perf_counter() - sent_at, sent_at - wait_start)
+        except (EOFError, OSError):
+            # RLIMIT による強制終了などでプロセスが結果を返さずに落ちた
+            self.broken = True
+            _sandbox_crashes.inc()
+            return _crash_result()
+
+    def close(self) -> None:
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+class SandboxPool:
+    """
+    事前に起動・ウォームアップ済みのサンドボックスワーカーを貸し出すプール。
 
+    ワーカーは max_jobs 回使い終えるか、タイムアウト・クラッシュした時点で破棄し、
+    バックグラウンドのスレッドで新しいプロセスを起動して台数を一定に保つ。起動に失敗した
+    (fork の EAGAIN や ENOMEM など) 場合も、間隔を空けて起動できるまでやり直す。
+    """
 
-def execute_code(code: str) -> Dict[str, Any]:
+    def __init__(self, size: int, max_jobs: int, warmup: bool) -> None:
+        self.size = size
+        self.max_jobs = max_jobs
+        self.warmup = warmup
+        self._idle: list[SandboxWorker] = []
+        self._condition = threading.Condition()
+        self._closed = False
+        self._stop = threading.Event()
+        self._replacers: set[threading.Thread] = set()
+
+    def _spawn(self) -> SandboxWorker:
+        return SandboxWorker(self.max_jobs, self.warmup)
+
+    @property
+    def idle_workers(self) -> int:
+        with self._condition:
+            return len(self._idle)
+
+    def start(self) -> None:
+        with self._condition:
+            while len(self._idle) < self.size:
+                self._idle.append(self._spawn())
+            self._condition.notify_all()
+
+    def _acquire(self, timeout: float) -> Optional[SandboxWorker]:
+        """空いたワーカーを取り出す。timeout 秒待っても空かないか、シャットダウンしたら None。"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while not self._idle and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            if self._closed:
+                return None
+            return self._idle.pop(0)
+
+    def _release(self, worker: SandboxWorker) -> None:
+        if worker.reusable:
+            with self._condition:
+                if not self._closed:
+                    self._idle.append(worker)
+                    self._condition.notify()
+                    return
+            worker.close()
+            return
+        # 古いプロセスの終了待ちと新しいプロセスの起動は、応答を返すスレッドではなく裏で行う
+        replacer = threading.Thread(target=self._replace, args=(worker,), name="sandbox-respawn", daemon=True)
+        with self._condition:
+            self._replacers.add(replacer)
+        replacer.start()
+
+    def _replace(self, worker: SandboxWorker) -> None:
+        try:
+            worker.close()
+            delay = 0.5
+            while not self._stop.is_set():
+                try:
+                    replacement = self._spawn()
+                except OSError:
+                    logger.exception("failed to start a sandbox worker; retrying in %.1f s", delay)
+                    self._stop.wait(delay)
+                    delay = min(delay * 2, 30.0)
+                    continue
+                with self._condition:
+                    if not self._closed:
+                        self._idle.append(replacement)
+                        self._condition.notify()
+                        return
+                replacement.close()
+                return
+        finally:
+            with self._condition:
+                self._replacers.discard(threading.current_thread())
+
+    def run(self, code: str) -> Dict[str, Any]:
+        worker = self._acquire(SANDBOX_READY_TIMEOUT)
+        if worker is None:
+            # 入れ替えが追いつかない (プロセスを起動できない) かシャットダウン中。プールを使わずに実行する
+            return _execute_in_new_process(code)
+        try:
+            return worker.run(code)
+        finally:
+            self._release(worker)
+
+    def shutdown(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._stop.set()
+            workers, self._idle = self._idle, []
+            replacers = list(self._replacers)
+            # 空きを待っているスレッドを起こし、プールを使わない実行に回す
+            self._condition.notify_all()
+        for worker in workers:
+            worker.close()
+        for replacer in replacers:
+            replacer.join()
+
+
+_sandbox_pool: Optional[SandboxPool] = None
+_sandbox_pool_lock = threading.Lock()
+
+
+def _get_sandbox_pool() -> Optional[SandboxPool]:
+    """SANDBOX_POOL_SIZE が 1 以上ならプールを (必要に応じて起動して) 返す。"""
+    global _sandbox_pool
+    if SANDBOX_POOL_SIZE <= 0:
+        return None
+    with _sandbox_pool_lock:
+        if _sandbox_pool is None:
+            _sandbox_pool = SandboxPool(SANDBOX_POOL_SIZE, SANDBOX_MAX_JOBS_PER_WORKER, SANDBOX_WARMUP)
+            _sandbox_pool.start()
+        return _sandbox_pool
+
+
+metrics.gauge(
+    "sandbox_pool_idle_workers",
+    "Warmed-up sandbox workers waiting for a job",
+    callback=lambda: _sandbox_pool.idle_workers if _sandbox_pool is not None else 0,
+)
+metrics.gauge(
+    "program_run_queue_depth",
+    "Program runs waiting to be written to the database",
+    callback=lambda: get_run_log_stats()["queued"],
+)
+
+
+def _shutdown_sandbox_pool() -> None:
+    global _sandbox_pool
+    with _sandbox_pool_lock:
+        if _sandbox_pool is not None:
+            _sandbox_pool.shutdown()
+            _sandbox_pool = None
+
+
+def _execute_in_new_process(code: str) -> Dict[str, Any]:
     """
-    ユーザーコードを別プロセスで実行し、タイムアウトや結果取得を管理する。
+    ユーザーコードを使い捨ての別プロセスで実行し、タイムアウトや結果取得を管理する。
 
     EXECUTION_TIMEOUT で join し、時間超過時はプロセスを kill して安全に終了させる。
     キューに結果が入っていなければエラー応答を返す。
     """
     queue: Queue = Queue()
-    process = Process(target=_execute_user_code, args=(code, queue))
+    process = Process(target=_execute_user_code, args=(code, queue, time.time()))
+    spawn_start = time.perf_counter()
     process.start()
     process.join(EXECUTION_TIMEOUT)
     if process.is_alive():
         process.terminate()
         process.join()
+        _sandbox_timeouts.inc()
+        return _timeout_result()
+    if not queue.empty():
+        result = queue.get()
+        timings = result.get("timings") or {}
+        # プールのワーカーと同じく、実行環境ができてコードを受け付けられるまでを起動時間とする
+        _sandbox_spawn_seconds.observe(timings.get("spawn", 0.0) + timings.get("environment", 0.0), "process")
+        return _finish_timings(result, "process", time.perf_counter() - spawn_start)
+    _sandbox_crashes.inc()
+    return _crash_result()
+
+
+_execution_executor = ThreadPoolExecutor(
+    max_workers=MAX_CONCURRENT_EXECUTIONS, thread_name_prefix="sandbox"
+)
+_execution_slots = asyncio.Semaphore(MAX_CONCURRENT_EXECUTIONS)
+
+
+async def execute_code_async(code: str) -> Dict[str, Any]:
+    """
+    イベントループを塞がないように、execute_code を専用スレッドプールで実行する。
+
+    同時に動かすサンドボックス数は MAX_CONCURRENT_EXECUTIONS で制限し、
+    EXECUTION_QUEUE_TIMEOUT 秒待っても空きが出なければ 503 を返して
+    リクエストが積み上がらないようにする。
+    """
+    _sandboxes_queued.inc()
+    try:
+        await asyncio.wait_for(_execution_slots.acquire(), timeout=EXECUTION_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError as exc:
+        _execution_rejected.inc()
+        retry_after = max(1, math.ceil(EXECUTION_TIMEOUT))
+        raise HTTPException(
+            status_code=503,
+            detail=f"実行待ちが混み合っています。あと {retry_after} 秒ほどしてから再度実行してください。",
+            headers={"Retry-After": str(retry_after)},
+        ) from exc
+    finally:
+        _sandboxes_queued.dec()
+    _sandboxes_active.inc()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_execution_executor, execute_code, code)
+    finally:
+        _sandboxes_active.dec()
+        _execution_slots.release()
+
+
+# hashlib の PBKDF2 は計算中に GIL を解放するので、スレッドでも並列に計算できる
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password")
+# 実行中と待機中のパスワード計算の数。イベントループのスレッドからしか触らない
+_password_tasks_pending = 0
+
+
+async def run_password_task(func: Any, *args: Any) -> Any:
+    """
+    パスワードのハッシュ計算 (とそれを含む処理) を専用スレッドプールで実行する。
+
+    授業開始時にログインが集中してもイベントループを塞がないようにしつつ、
+    待ちが PASSWORD_HASH_MAX_PENDING 件を超えたら積み上げずに 503 を返す。
+    """
+    global _password_tasks_pending
+    if _password_tasks_pending >= PASSWORD_HASH_MAX_PENDING:
+        raise HTTPException(
+            status_code=503,
+            detail="ログインが混み合っています。少し待ってから再度お試しください。",
+            headers={"Retry-After": "2"},
+        )
+    _password_tasks_pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_executor, func, *args)
+    finally:
+        _password_tasks_pending -= 1
+
+
+# 乱数や現在時刻などに依存しそうなコードは結果が毎回変わりうるので、キャッシュしない。
+# 識別子単位で照合する (known や snow に now が含まれるだけでは外さない)。
+# from time import perf_counter のように取り込む場合も、モジュール名で引っかかる
+_NONDETERMINISTIC_CODE = re.compile(
+    r"\b(?:random|default_rng|datetime\w*|now|utcnow|today|time|time_ns|perf_counter(?:_ns)?"
+    r"|monotonic(?:_ns)?|process_time(?:_ns)?|uuid\d?|secrets|urandom|getpid)\b"
+    r"|\b(?:hash|id)\s*\("
+)
+
+
+def _environment_version() -> str:
+    """
+    サンドボックスの実行結果に影響するもの (このファイル・ライブラリのバージョン・設定値) から
+    キャッシュキーに混ぜるバージョン文字列を作る。どれかが変われば以前の結果は使われない。
+    """
+    digest = hashlib.sha256()
+    digest.update(Path(__file__).read_bytes())
+    settings = (
+        bokeh.__version__,
+        np.__version__,
+        EXECUTION_TIMEOUT,
+        MEMORY_LIMIT_MB,
+        PLOT_ADAPTIVE_SAMPLING,
+        PLOT_DOWNSAMPLE_POINTS_PER_PIXEL,
+    )
+    digest.update(repr(settings).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+ENVIRONMENT_VERSION = _environment_version()
+
+
+def _normalize_code(code: str) -> str:
+    """改行コードと行末・前後の空白の違いだけのコードは同じものとして扱う。"""
+    lines = code.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip("\n")
+
+
+def execution_cache_key(code: str) -> Optional[str]:
+    """結果をキャッシュできるコードならキーを、できないなら None を返す。"""
+    normalized = _normalize_code(code)
+    if _NONDETERMINISTIC_CODE.search(normalized):
+        return None
+    return hashlib.sha256(f"{ENVIRONMENT_VERSION}\n{normalized}".encode("utf-8")).hexdigest()
+
+
+class ExecutionResultCache:
+    """
+    実行結果をコードのハッシュで引くキャッシュ。
+
+    メモリ上は合計バイト数で上限を決めた LRU で、EXECUTION_CACHE_DIR が指定されていれば
+    gzip した JSON をディスクにも書き、メモリから追い出された結果や再起動後にも使う。
+    ディスクへの書き込みは専用のスレッド 1 本で順に行い、合計が disk_max_bytes を超えたら
+    最後に使われたのが古いものから消す。get と put はどちらも重いので、イベントループからは
+    スレッドに回して呼ぶこと。
+    """
+
+    # クラッシュなどで残った一時ファイルは、この秒数より古ければ掃除する
+    _STALE_TEMPORARY_SECONDS = 3600
+
+    def __init__(
+        self, max_bytes: int, directory: Optional[Path], disk_max_bytes: int = EXECUTION_CACHE_DISK_MAX_BYTES
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        # ディスク上の合計サイズの見積もり。書き込みスレッドからしか触らない (None なら未集計)
+        self._disk_bytes: Optional[int] = None
+        self._writer = (
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-writer") if directory is not None else None
+        )
+
+    def _disk_path(self, key: str) -> Optional[Path]:
+        if self.directory is None:
+            return None
+        return self.directory / key[:2] / f"{key}.json.gz"
+
+    def _remember(self, key: str, payload: bytes) -> None:
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= len(previous)
+            self._entries[key] = payload
+            self._total_bytes += len(payload)
+            while self._total_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= len(evicted)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+        if payload is None:
+            path = self._disk_path(key)
+            if path is None or not path.exists():
+                return None
+            try:
+                payload = gzip.decompress(path.read_bytes())
+                # ディスクから消す順番は更新時刻で決めるので、使ったものは新しくしておく
+                os.utime(path)
+            except (OSError, EOFError):
+                return None
+            self._remember(key, payload)
+        return json.loads(payload)
+
+    def put(self, key: str, result: Dict[str, Any]) -> None:
+        payload = json.dumps(result, ensure_ascii=False).encode("utf-8")
+        self._remember(key, payload)
+        if self._writer is None:
+            return
+        try:
+            self._writer.submit(self._write_disk, key, payload)
+        except RuntimeError:
+            # close() の後。メモリ上には入っているので、ディスクには書かずに済ませる
+            pass
+
+    def _write_disk(self, key: str, payload: bytes) -> None:
+        path = self._disk_path(key)
+        assert path is not None
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            data = gzip.compress(payload)
+            # 複数のワーカープロセスが同じディレクトリに書くので、一時ファイル名は衝突しないものにする
+            fd, temporary = tempfile.mkstemp(dir=path.parent, prefix=f".{key}.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as output:
+                    output.write(data)
+                os.replace(temporary, path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.unlink(temporary)
+                raise
+        except OSError:
+            # ディスクに書けなくてもメモリ上のキャッシュは使えるので無視する
+            return
+        if self.disk_max_bytes <= 0:
+            return
+        if self._disk_bytes is not None:
+            self._disk_bytes += len(data)
+        if self._disk_bytes is None or self._disk_bytes > self.disk_max_bytes:
+            self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        """
+        ディスク上のキャッシュを数え直し、disk_max_bytes を超えていれば更新時刻の古いものから
+        上限の 9 割まで消す。他のプロセスが書いた分もここで数え直すので見積もりのずれは戻る。
+        """
+        assert self.directory is not None
+        now = time.time()
+        files = []
+        total = 0
+        for path in self.directory.glob("*/*"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            if path.name.endswith(".tmp"):
+                if now - stat.st_mtime > self._STALE_TEMPORARY_SECONDS:
+                    with contextlib.suppress(OSError):
+                        path.unlink()
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        if total > self.disk_max_bytes:
+            target = self.disk_max_bytes * 0.9
+            for _, size, path in sorted(files):
+                if total <= target:
+                    break
+                with contextlib.suppress(OSError):
+                    path.unlink()
+                    total -= size
+        self._disk_bytes = total
+
+    def close(self) -> None:
+        """書き込み待ちの結果をディスクに書き終えるまで待つ。"""
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+
+
+execution_cache: Optional[ExecutionResultCache] = (
+    ExecutionResultCache(EXECUTION_CACHE_MAX_BYTES, Path(EXECUTION_CACHE_DIR) if EXECUTION_CACHE_DIR else None)
+    if EXECUTION_CACHE_MAX_BYTES > 0
+    else None
+)
+_inflight_executions: Dict[str, "asyncio.Task[Dict[str, Any]]"] = {}
+
+
+async def _execute_and_cache(key: str, code: str) -> Dict[str, Any]:
+    try:
+        result = await execute_code_async(code)
+        if result.get("success"):
+            await asyncio.get_running_loop().run_in_executor(None, execution_cache.put, key, result)
+        return result
+    finally:
+        _inflight_executions.pop(key, None)
+
+
+def _retrieve_task_exception(task: "asyncio.Task[Any]") -> None:
+    # 待っていたリクエストがすべて取り消された後に失敗しても "never retrieved" の警告を出さない
+    if not task.cancelled():
+        task.exception()
+
+
+async def execute_code_cached(code: str) -> tuple[Dict[str, Any], bool]:
+    """
+    キャッシュを確認してから実行し、(結果, キャッシュから返したか) を返す。
+
+    同じコードの実行が既に進行中なら、新しくサンドボックスを起動せずにその結果を待つ。
+    実行は最初のリクエストとは別のタスクで行うので、そのリクエストが (接続が切れるなどして)
+    取り消されても、同じ結果を待っている他のリクエストには影響しない。
+    キャッシュに入れるのは成功した実行だけで、タイムアウトなど状況次第の失敗は入れない。
+    """
+    key = execution_cache_key(code) if execution_cache is not None else None
+    if key is None:
+        return await execute_code_async(code), False
+    loop = asyncio.get_running_loop()
+    # ディスクの読み込みや数 MB になりうる JSON の解析はイベントループの外で行う
+    cached = await loop.run_in_executor(None, execution_cache.get, key)
+    if cached is not None:
+        return cached, True
+    inflight = _inflight_executions.get(key)
+    if inflight is not None:
+        return dict(await asyncio.shield(inflight)), True
+
+    task = loop.create_task(_execute_and_cache(key, code))
+    task.add_done_callback(_retrieve_task_exception)
+    _inflight_executions[key] = task
+    return await asyncio.shield(task), False
+
+
+def execute_code(code: str) -> Dict[str, Any]:
+    """
+    ユーザーコードをサンドボックスで実行する。
+
+    ワーカープールが有効ならウォームアップ済みのプロセスに任せ、
+    無効 (SANDBOX_POOL_SIZE=0) なら従来どおり毎回プロセスを起動する。
+    """
+    start = time.perf_counter()
+    pool = _get_sandbox_pool()
+    result = _execute_in_new_process(code) if pool is None else pool.run(code)
+    _sandbox_execution_seconds.observe(
+        time.perf_counter() - start, "success" if result.get("success") else "error"
+    )
+    if result.get("cpu_time") is not None:
+        _sandbox_cpu_seconds.observe(result["cpu_time"])
+    if result.get("plot") is not None and result.get("timings"):
+        _plot_serialization_seconds.observe(result["timings"].get("serialization", 0.0))
+    return result
+
+
+def warm_lesson_cache(
+    cache: Optional[ExecutionResultCache] = None, concurrency: int = LESSON_WARMUP_CONCURRENCY
+) -> list[Dict[str, Any]]:
+    """
+    教材中の ```python ブロックをすべて並列にサンドボックスで実行し、成功した結果を
+    実行結果キャッシュに入れておく。最初にその例を実行した学習者にもすぐ結果を返せる。
+
+    ブロックごとの結果 (ok / error / timeout / uncacheable) を返すので、
+    壊れている・遅すぎる教材コードの確認にも使える。
+    """
+    cache = cache if cache is not None else execution_cache
+    jobs = [
+        (material, index, code)
+        for material in material_store.materials()
+        for index, code in enumerate(material.get("code_blocks", []))
+    ]
+
+    def _warm(job: tuple[Dict[str, Any], int, str]) -> Dict[str, Any]:
+        material, index, code = job
+        key = execution_cache_key(code)
+        entry: Dict[str, Any] = {"material_id": material["id"], "title": material["title"], "block": index}
+        if cache is not None and key is not None and cache.get(key) is not None:
+            return {**entry, "status": "ok", "execution_time": 0.0, "message": "cached"}
+        result = execute_code(code)
+        if result.get("success"):
+            status = "ok" if key is not None else "uncacheable"
+            if cache is not None and key is not None:
+                cache.put(key, result)
+        elif result.get("stderr") == _TIMEOUT_MESSAGE:
+            status = "timeout"
+        else:
+            status = "error"
+        message = (result.get("stderr") or "").strip().splitlines()
         return {
-            "success": False,
-            "plot": None,
-            "stdout": "",
-            "stderr": "処理がタイムアウトしました。コードが長時間実行されていないか確認してください。",
-            "execution_time": EXECUTION_TIMEOUT,
+            **entry,
+            "status": status,
+            "execution_time": float(result.get("execution_time", 0.0)),
+            "message": message[-1] if message and status in ("error", "timeout") else "",
         }
-    if not queue.empty():
-        return queue.get()
-    return {
-        "success": False,
-        "plot": None,
-        "stdout": "",
-        "stderr": "結果の取得中に問題が発生しました。",
-        "execution_time": 0.0,
-    }
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="lesson-warmup") as executor:
+        report = list(executor.map(_warm, jobs))
+    for entry in report:
+        if entry["status"] in ("error", "timeout"):
+            logger.warning(
+                "lesson warm-up %s: material %s (%s) block %s: %s",
+                entry["status"],
+                entry["material_id"],
+                entry["title"],
+                entry["block"],
+                entry["message"],
+            )
+    logger.info(
+        "lesson warm-up finished: %d blocks, %d failed",
+        len(report),
+        sum(entry["status"] in ("error", "timeout") for entry in report),
+    )
+    return report
+
+
+def _accepted_encodings(request: Request) -> Dict[str, float]:
+    encodings: Dict[str, float] = {}
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            encodings[name.lower()] = quality
+    return encodings
+
+
+def _compressed_json_response(request: Request, payload: Any) -> Response:
+    """
+    Accept-Encoding を見て brotli (導入されていれば) か gzip で JSON 応答を圧縮する。
+
+    圧縮前のサイズを X-Uncompressed-Length ヘッダーで返し、転送量の削減を追えるようにする。
+    小さい応答や圧縮を受け付けないクライアントにはそのまま返す。
+    """
+    response = JSONResponse(payload)
+    body = response.body
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["X-Uncompressed-Length"] = str(len(body))
+    if len(body) < RESPONSE_COMPRESSION_MIN_BYTES:
+        return response
+    accepted = _accepted_encodings(request)
+    if brotli is not None and accepted.get("br", 0) > 0:
+        encoding, compressed = "br", brotli.compress(body, quality=5)
+    elif accepted.get("gzip", 0) > 0:
+        encoding, compressed = "gzip", gzip.compress(body, compresslevel=6)
+    else:
+        return response
+    response.body = compressed
+    response.headers["Content-Encoding"] = encoding
+    response.headers["Content-Length"] = str(len(compressed))
+    return response
+
+
+def _route_label(scope: Dict[str, Any]) -> str:
+    """ラベルの種類が増えすぎないよう、実際のパスではなくルートのテンプレートで集計する。"""
+    route = scope.get("route")
+    if route is not None:
+        return getattr(route, "path", "unknown")
+    if scope.get("path", "").startswith("/static/"):
+        return "/static"
+    return "unmatched"
+
+
+class RequestMetricsMiddleware:
+    """リクエストごとの処理時間を、メソッド・ルート・ステータスコード別のヒストグラムに記録する。"""
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _request_duration.observe(
+                time.perf_counter() - start, scope["method"], _route_label(scope), str(status)
+            )
 
 
 app = FastAPI(title="hibikicode-math")
 
+if metrics.METRICS_ENABLED:
+    app.add_middleware(RequestMetricsMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -437,7 +1990,27 @@ app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
 @app.on_event("startup")
 def on_startup() -> None:
+    # 描画用のプロセスプールを fork するので、他のスレッドを起動する前に読み込んでおく
+    material_store.refresh(parallel=True)
     init_db()
+    rate_limiter.load(list_recent_program_runs(max(MIN_EXECUTION_INTERVAL, USER_CPU_BUDGET_WINDOW_SECONDS)))
+    start_session_activity_flusher()
+    start_program_run_writer()
+    _get_sandbox_pool()
+    if LESSON_WARMUP:
+        # 起動を待たせないよう、教材コードの事前実行はバックグラウンドで行う
+        threading.Thread(target=warm_lesson_cache, name="lesson-warmup", daemon=True).start()
+
+
+@app.on_event("shutdown")
+def on_shutdown() -> None:
+    _execution_executor.shutdown(wait=True)
+    _password_executor.shutdown(wait=True)
+    _shutdown_sandbox_pool()
+    if execution_cache is not None:
+        execution_cache.close()
+    stop_program_run_writer()
+    stop_session_activity_flusher()
 
 
 @app.get("/")
@@ -455,10 +2028,17 @@ async def login(request: LoginRequest) -> Dict[str, Any]:
     if not username or not password:
         raise HTTPException(status_code=400, detail="ユーザー名とパスワードを入力してください")
     record = fetch_user_credentials(username)
-    if record is None or not verify_password(password, record["password_hash"]):
+    if record is None or not await run_password_task(verify_password, password, record["password_hash"]):
         raise HTTPException(status_code=401, detail="ユーザー名またはパスワードが正しくありません")
     user = UserRecord(id=record["id"], username=record["username"], is_admin=bool(record["is_admin"]))
+    if password_needs_rehash(record["password_hash"]):
+        # PASSWORD_ITERATIONS を変えたあとは、正しいパスワードが手元にあるログイン時に掛け直す
+        try:
+            set_user_password_hash(user.id, await run_password_task(hash_password, password))
+        except (HTTPException, sqlite3.Error):
+            logger.warning("failed to rehash password for user %s", user.id, exc_info=True)
     token = create_session(user.id)
+    load_user_unlocks(user.id)
     return _auth_payload(user, token)
 
 
@@ -476,13 +2056,16 @@ async def auth_me(current_user: UserRecord = Depends(get_current_user)) -> Dict[
 
 
 @app.post("/api/execute")
-async def run_code(request: CodeRequest, current_user: UserRecord = Depends(get_current_user)) -> JSONResponse:
+async def run_code(
+    request: CodeRequest, http_request: Request, current_user: UserRecord = Depends(get_current_user)
+) -> Response:
     if not request.code.strip():
         raise HTTPException(status_code=400, detail="コードが空です")
     now = datetime.utcnow()
 
     wait_seconds = _seconds_until_next_run(current_user.id, now)
     if wait_seconds > 0:
+        _rate_limited.inc("interval")
         retry_after = math.ceil(wait_seconds)
         raise HTTPException(
             status_code=429,
@@ -492,6 +2075,7 @@ async def run_code(request: CodeRequest, current_user: UserRecord = Depends(get_
 
     cpu_wait_seconds = _seconds_until_cpu_budget_resets(current_user.id, now)
     if cpu_wait_seconds > 0:
+        _rate_limited.inc("cpu_budget")
         retry_after = math.ceil(cpu_wait_seconds)
         limit_window = int(USER_CPU_BUDGET_WINDOW_SECONDS)
         limit_budget = int(USER_CPU_BUDGET_SECONDS)
@@ -503,7 +2087,14 @@ async def run_code(request: CodeRequest, current_user: UserRecord = Depends(get_
             ),
             headers={"Retry-After": str(retry_after)},
         )
-    result = execute_code(request.code)
+    reservation = rate_limiter.reserve(current_user.id, now)
+    try:
+        result, cached = await execute_code_cached(request.code)
+    except BaseException:
+        # 混雑による 503 などで実行しなかった場合は、連続実行の制限にも数えない
+        rate_limiter.cancel(current_user.id, reservation)
+        raise
+    rate_limiter.complete(reservation, float(result.get("execution_time", 0.0)), cached)
     record_program_run(
         current_user.id,
         request.code,
@@ -511,30 +2102,144 @@ async def run_code(request: CodeRequest, current_user: UserRecord = Depends(get_
         result.get("stderr", ""),
         bool(result.get("success")),
         float(result.get("execution_time", 0.0)),
+        cached=cached,
+        # キャッシュから返した結果の timings は元の実行のものなので、この実行としては記録しない
+        timings=None if cached else result.get("timings"),
     )
-    return JSONResponse(result)
+    payload = {**result, "cached": cached}
+    # 段階ごとの所要時間はログ欄で管理者にだけ見せる
+    if cached or not current_user.is_admin:
+        payload.pop("timings", None)
+    return _compressed_json_response(http_request, payload)
+
+
+# 書き込み待ちの実行 (id=None) で終わったページの続きは、DB の最新の行から始める
+_HISTORY_CURSOR_TOP = ("9999-12-31 23:59:59", 2**63 - 1)
+
+
+def _encode_history_cursor(run: Dict[str, Any]) -> str:
+    position = [run["created_at"], run["id"]] if run["id"] is not None else list(_HISTORY_CURSOR_TOP)
+    raw = json.dumps(position).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_history_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, run_id = json.loads(raw)
+        if not isinstance(created_at, str) or not isinstance(run_id, int):
+            raise ValueError
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="before の値が不正です") from None
+    return created_at, run_id
 
 
 @app.get("/api/programs/history")
 async def get_program_history(
-    limit: int = 20, current_user: UserRecord = Depends(get_current_user)
-) -> Dict[str, Any]:
+    request: Request,
+    limit: int = 20,
+    before: Optional[str] = None,
+    summary: bool = False,
+    current_user: UserRecord = Depends(get_current_user),
+) -> Response:
+    """
+    実行履歴を新しい順に返す。続きは応答の next_cursor を before に渡して取得する。
+    summary=true のときはコードと出力の先頭だけを返し、全文は /api/programs/history/{run_id} で取得する。
+    """
     safe_limit = max(1, min(limit, 100))
-    history = list_program_runs_by_user_id(current_user.id, safe_limit)
-    return {"history": history}
+    # 書き込みスレッドのコミットが終わるのを待つことがあるので、イベントループの外で読む
+    history = await run_in_threadpool(
+        list_program_runs_by_user_id,
+        current_user.id,
+        safe_limit,
+        before=_decode_history_cursor(before) if before else None,
+        preview_chars=HISTORY_PREVIEW_CHARS if summary else None,
+    )
+    if not current_user.is_admin:
+        for run in history:
+            run.pop("timings", None)
+    next_cursor = _encode_history_cursor(history[-1]) if len(history) >= safe_limit else None
+    return _compressed_json_response(request, {"history": history, "next_cursor": next_cursor})
+
+
+@app.get("/api/programs/history/{run_id}")
+async def get_program_history_entry(
+    run_id: int, request: Request, current_user: UserRecord = Depends(get_current_user)
+) -> Response:
+    run = await run_in_threadpool(get_program_run, current_user.id, run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="実行履歴が見つかりません")
+    if not current_user.is_admin:
+        run.pop("timings", None)
+    return _compressed_json_response(request, run)
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """
+    If-None-Match が etag と一致するか調べる。圧縮した応答の ETag には
+    "-gzip" などの符号化名を付けているので、それを外して比較する。
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    base = etag.strip('"')
+    for candidate in header.split(","):
+        tag = candidate.strip()
+        if not tag.startswith('"'):
+            continue  # 弱い ETag (W/"...") は強い比較では一致しない
+        tag = tag.strip('"')
+        if tag == base or any(tag == f"{base}-{encoding}" for encoding in ("gzip", "br")):
+            return True
+    return False
+
+
+def _conditional_json_response(request: Request, payload_factory: Any, etag: str) -> Response:
+    """
+    ETag と Cache-Control を付けて JSON を返す。If-None-Match が一致すれば本文を作らずに 304 を返す。
+    教材はユーザーごとに閲覧権限があるので private にし、毎回 ETag で再検証させる。
+    """
+    headers = {"Cache-Control": "private, no-cache", "Vary": "Accept-Encoding, Authorization"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers={**headers, "ETag": etag})
+    response = _compressed_json_response(request, payload_factory())
+    encoding = response.headers.get("Content-Encoding")
+    # 符号化が違えば別の表現なので、強い ETag も変える
+    base = etag.strip('"')
+    response.headers["ETag"] = f'"{base}-{encoding}"' if encoding else etag
+    response.headers.update(headers)
+    return response
 
 
 @app.get("/api/materials")
-async def get_materials(_: UserRecord = Depends(get_current_user)) -> Dict[str, Any]:
-    return {"materials": [{"id": m["id"], "title": m["title"]} for m in MATERIALS]}
+async def get_materials(request: Request, _: UserRecord = Depends(get_current_user)) -> Response:
+    """教材の一覧を返す。version や各教材の version が前回と同じなら本文を取り直す必要はない。"""
+    materials = material_store.materials()
+    version = material_store.version
+    return _conditional_json_response(
+        request,
+        lambda: {
+            "version": version,
+            "materials": [{"id": m["id"], "title": m["title"], "version": m["version"]} for m in materials],
+        },
+        f'"list-{version}"',
+    )
 
 
 @app.get("/api/materials/{material_id}")
-async def get_material(material_id: int, current_user: UserRecord = Depends(get_current_user)) -> Dict[str, Any]:
-    if material_id < 0 or material_id >= len(MATERIALS):
+async def get_material(
+    material_id: int, request: Request, current_user: UserRecord = Depends(get_current_user)
+) -> Response:
+    material = material_store.get(material_id)
+    if material is None:
         raise HTTPException(status_code=404, detail="教材が見つかりません")
     if material_id == 0 or current_user.is_admin or has_unlocked(current_user.id, material_id):
-        return MATERIALS[material_id]
+        return _conditional_json_response(
+            request,
+            lambda: {**_material_payload(material), "version": material["version"]},
+            f'"{material["version"]}"',
+        )
     raise HTTPException(status_code=403, detail="この教材を閲覧するにはパスワードが必要です")
 
 
@@ -544,15 +2249,17 @@ async def unlock_material(
     request: MaterialUnlockRequest,
     current_user: UserRecord = Depends(get_current_user),
 ) -> Dict[str, Any]:
-    if material_id < 0 or material_id >= len(MATERIALS):
+    material = material_store.get(material_id)
+    if material is None:
         raise HTTPException(status_code=404, detail="教材が見つかりません")
+    payload = {**_material_payload(material), "version": material["version"]}
     if material_id == 0:
-        return MATERIALS[material_id]
+        return payload
     if has_unlocked(current_user.id, material_id):
-        return MATERIALS[material_id]
+        return payload
     if (request.password or "").strip() == LESSON_PASSWORD:
         record_unlock(current_user.id, material_id)
-        return MATERIALS[material_id]
+        return payload
     raise HTTPException(status_code=403, detail="パスワードが正しくありません")
 
 
@@ -575,7 +2282,9 @@ async def admin_create_user(
     if not username or not password:
         raise HTTPException(status_code=400, detail="ユーザー名とパスワードは必須です")
     try:
-        user_id = create_user(username, password, is_admin=request.is_admin)
+        user_id = await run_password_task(
+            lambda: create_user(username, password, is_admin=request.is_admin)
+        )
     except sqlite3.IntegrityError as exc:  # pragma: no cover - uniqueness constraint
         raise HTTPException(status_code=400, detail="同じユーザー名が既に存在します") from exc
     return {"user": {"id": user_id, "username": username, "is_admin": request.is_admin}}
@@ -592,11 +2301,13 @@ async def admin_update_user(
     if not payload:
         raise HTTPException(status_code=400, detail="更新する項目がありません")
     try:
-        updated = update_user(
-            user_id,
-            username=payload.get("username"),
-            password=payload.get("password"),
-            is_admin=payload.get("is_admin"),
+        updated = await run_password_task(
+            lambda: update_user(
+                user_id,
+                username=payload.get("username"),
+                password=payload.get("password"),
+                is_admin=payload.get("is_admin"),
+            )
         )
     except sqlite3.IntegrityError as exc:  # pragma: no cover - uniqueness constraint
         raise HTTPException(status_code=400, detail="同じユーザー名が既に存在します") from exc
@@ -615,6 +2326,96 @@ async def admin_delete_user(
     return {"status": "ok"}
 
 
+@app.post("/api/admin/unlocks")
+async def admin_bulk_unlock(
+    request: BulkUnlockRequest, current_user: UserRecord = Depends(get_current_user)
+) -> Dict[str, Any]:
+    """指定したユーザー (省略時は全員) の教材をまとめて解除する。"""
+    _ensure_admin(current_user)
+    count = len(material_store.materials())
+    if not request.material_ids or any(m < 0 or m >= count for m in request.material_ids):
+        raise HTTPException(status_code=400, detail="教材IDが不正です")
+    try:
+        inserted = bulk_unlock(request.user_ids, request.material_ids)
+    except sqlite3.IntegrityError as exc:
+        # 存在しないユーザーIDが含まれていれば外部キー制約で全体がロールバックされる
+        raise HTTPException(status_code=404, detail="ユーザーが見つかりません") from exc
+    return {"status": "ok", "unlocked": inserted}
+
+
+@app.get("/api/admin/materials-stats")
+async def admin_materials_stats(current_user: UserRecord = Depends(get_current_user)) -> Dict[str, Any]:
+    """直近の教材の読み込み (描画・キャッシュ読み込み) にかかった時間を返す。"""
+    _ensure_admin(current_user)
+    return {"version": material_store.version, "stats": material_store.stats}
+
+
+def _stats_days(days: int) -> int:
+    return max(1, min(days, 3660))
+
+
+@app.get("/api/admin/stats")
+async def admin_stats(days: int = 30, current_user: UserRecord = Depends(get_current_user)) -> Dict[str, Any]:
+    """全体の累計と直近 days 日の日別推移を返す。集計テーブルだけを読むので履歴の量によらず速い。"""
+    _ensure_admin(current_user)
+    return get_activity_overview(_stats_days(days))
+
+
+@app.get("/api/admin/stats/users")
+async def admin_user_stats(current_user: UserRecord = Depends(get_current_user)) -> Dict[str, Any]:
+    """ユーザーごとの実行数・成功率・CPU 秒・最終活動を返す。"""
+    _ensure_admin(current_user)
+    users = list_user_activity()
+    for user in users:
+        user["is_admin"] = bool(user.get("is_admin"))
+    return {"users": users}
+
+
+@app.get("/api/admin/stats/users/{user_id}")
+async def admin_user_detail_stats(
+    user_id: int, days: int = 30, current_user: UserRecord = Depends(get_current_user)
+) -> Dict[str, Any]:
+    _ensure_admin(current_user)
+    activity = get_user_activity(user_id, _stats_days(days))
+    if activity is None:
+        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+    return {"user": activity}
+
+
+@app.get("/api/admin/stats/materials")
+async def admin_material_stats(current_user: UserRecord = Depends(get_current_user)) -> Dict[str, Any]:
+    """教材ごとの解除人数を返す。まだ誰も解除していない教材も 0 人として含める。"""
+    _ensure_admin(current_user)
+    counts = {entry["material_id"]: entry for entry in list_material_activity()}
+    materials = []
+    for material in material_store.materials():
+        entry = counts.get(material["id"], {})
+        materials.append(
+            {
+                "material_id": material["id"],
+                "title": material["title"],
+                "unlocks": entry.get("unlocks", 0),
+                "first_unlocked_at": entry.get("first_unlocked_at"),
+                "last_unlocked_at": entry.get("last_unlocked_at"),
+            }
+        )
+    return {"materials": materials}
+
+
+@app.get("/api/admin/query-stats")
+async def admin_query_stats(current_user: UserRecord = Depends(get_current_user)) -> Dict[str, Any]:
+    _ensure_admin(current_user)
+    return {"queries": get_query_stats(), "run_log": get_run_log_stats()}
+
+
+@app.get("/metrics")
+async def prometheus_metrics() -> Response:
+    """Prometheus 形式のメトリクス。METRICS_ENABLED=0 のときは 404 を返す。"""
+    if not metrics.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return Response(metrics.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
 @app.get("/api/status")
 async def status() -> Dict[str, str]:
     return {"status": "ok"}
\ No newline at end of file
@@ -10,6 +10,7 @@ import {
   fetchLesson,
   fetchMaterialsMeta,
   setupMaterialsList,
+  startMaterialsRefresh,
   updateLessonNavigation,
 } from "./js/materials.js";
 import { setupProgramHistory } from "./js/history.js";
@@ -93,6 +94,7 @@ async function bootstrap() {
 
   await ensureAuthenticated();
   await fetchMaterialsMeta();
+  startMaterialsRefresh();
   if (state.materialsMeta.length > 0) {
     fetchLesson(0);
   } else {
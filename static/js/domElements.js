@@ -5,6 +5,7 @@ export const elements = {
   runButton: document.getElementById("run-button"),
   resetButton: document.getElementById("reset-button"),
   executionTime: document.getElementById("execution-time"),
+  executionTimings: document.getElementById("execution-timings"),
   combinedLogOutput: document.getElementById("combined-log"),
   lessonTitle: document.getElementById("lesson-title"),
   lessonContent: document.getElementById("lesson-content"),
@@ -34,63 +34,149 @@ function appendLogSection(container, label, content) {
   container.appendChild(pre);
 }
 
+const HISTORY_PAGE_SIZE = 20;
+// 次のページを取得するためのカーソル。null なら続きはない。
+let nextCursor = null;
+
+/**
+ * 要約表示の項目に、サーバーから取得した全文のコードと出力を表示する。
+ */
+async function showHistoryDetail(entry, item, button) {
+  button.disabled = true;
+  button.textContent = "読み込んでいます...";
+  try {
+    const response = await apiClient.get(`/api/programs/history/${item.id}`);
+    const detail = response.data || {};
+    entry.querySelectorAll(".history-label, pre").forEach((node) => node.remove());
+    button.remove();
+    appendLogSection(entry, "実行コード", detail.code || "");
+    appendLogSection(entry, "標準出力", detail.stdout || "");
+    appendLogSection(entry, "標準エラー", detail.stderr || "");
+  } catch (error) {
+    console.error("Failed to load history entry", error);
+    button.disabled = false;
+    button.textContent = "全文の取得に失敗しました。再試行";
+  }
+}
+
+/**
+ * 履歴 1 件分の要素を作る。コードと出力は先頭部分だけを表示し、
+ * 切り詰めたものは「全文を表示」で詳細を取得する。
+ */
+function createHistoryEntry(item) {
+  const entry = document.createElement("article");
+  entry.className = "history-entry";
+
+  const header = document.createElement("header");
+  const title = document.createElement("strong");
+  title.textContent = formatDate(item.created_at);
+  const status = document.createElement("span");
+  const success = Boolean(item.success);
+  status.className = `status-badge ${success ? "success" : "fail"}`;
+  status.textContent = success ? "成功" : "失敗";
+
+  header.appendChild(title);
+  header.appendChild(status);
+  entry.appendChild(header);
+
+  const meta = document.createElement("div");
+  meta.className = "history-meta";
+  const execution = typeof item.execution_time === "number" ? item.execution_time : 0;
+  const execSpan = document.createElement("span");
+  execSpan.textContent = `実行時間: ${execution.toFixed(3)}s`;
+  meta.appendChild(execSpan);
+  if (item.cached) {
+    const cachedSpan = document.createElement("span");
+    cachedSpan.textContent = "キャッシュから表示";
+    meta.appendChild(cachedSpan);
+  }
+  entry.appendChild(meta);
+
+  appendLogSection(entry, "実行コード", item.code_preview || "");
+  appendLogSection(entry, "標準出力", item.stdout_preview || "");
+  appendLogSection(entry, "標準エラー", item.stderr_preview || "");
+
+  if (item.truncated && item.id !== null && item.id !== undefined) {
+    const button = document.createElement("button");
+    button.type = "button";
+    button.className = "ghost";
+    button.textContent = "全文を表示";
+    button.addEventListener("click", () => showHistoryDetail(entry, item, button));
+    entry.appendChild(button);
+  }
+  return entry;
+}
+
 /**
- * API から得た履歴配列を UI に描画する。コードと出力をセクション分けで表示する。
+ * 「さらに読み込む」ボタンを一覧の末尾に置き直す。続きがなければ取り除く。
  */
-function renderHistory(history = []) {
+function updateLoadMoreButton() {
   if (!elements.historyList) return;
-  elements.historyList.innerHTML = "";
-  if (!history.length) {
-    setHistoryMessage("履歴がありません。");
-    return;
+  elements.historyList.querySelector(".history-load-more")?.remove();
+  if (!nextCursor) return;
+  const button = document.createElement("button");
+  button.type = "button";
+  button.className = "secondary history-load-more";
+  button.textContent = "さらに読み込む";
+  button.addEventListener("click", async () => {
+    button.disabled = true;
+    button.textContent = "読み込んでいます...";
+    await fetchHistoryPage();
+  });
+  elements.historyList.appendChild(button);
+}
+
+/**
+ * API から得た履歴配列を一覧の末尾に追加する。
+ */
+function renderHistory(history = [], { append = false } = {}) {
+  if (!elements.historyList) return;
+  if (!append) {
+    elements.historyList.innerHTML = "";
+    if (!history.length) {
+      setHistoryMessage("履歴がありません。");
+      return;
+    }
   }
   history.forEach((item) => {
-    const entry = document.createElement("article");
-    entry.className = "history-entry";
-
-    const header = document.createElement("header");
-    const title = document.createElement("strong");
-    title.textContent = formatDate(item.created_at);
-    const status = document.createElement("span");
-    const success = Boolean(item.success);
-    status.className = `status-badge ${success ? "success" : "fail"}`;
-    status.textContent = success ? "成功" : "失敗";
-
-    header.appendChild(title);
-    header.appendChild(status);
-    entry.appendChild(header);
-
-    const meta = document.createElement("div");
-    meta.className = "history-meta";
-    const execution = typeof item.execution_time === "number" ? item.execution_time : 0;
-    const execSpan = document.createElement("span");
-    execSpan.textContent = `実行時間: ${execution.toFixed(3)}s`;
-    meta.appendChild(execSpan);
-    entry.appendChild(meta);
-
-    appendLogSection(entry, "実行コード", item.code || "");
-    appendLogSection(entry, "標準出力", item.stdout || "");
-    appendLogSection(entry, "標準エラー", item.stderr || "");
-
-    elements.historyList.appendChild(entry);
+    elements.historyList.appendChild(createHistoryEntry(item));
   });
+  updateLoadMoreButton();
 }
 
 /**
- * サーバーから最新の実行履歴を取得し、renderHistory で反映する。
+ * 要約形式の履歴を 1 ページ分取得する。nextCursor があればその続きを取得して追加する。
  */
-async function loadHistory() {
-  if (!elements.historyList) return;
-  setHistoryMessage("履歴を読み込んでいます...");
+async function fetchHistoryPage() {
+  const append = Boolean(nextCursor);
+  const params = { limit: HISTORY_PAGE_SIZE, summary: true };
+  if (nextCursor) {
+    params.before = nextCursor;
+  }
   try {
-    const response = await apiClient.get("/api/programs/history", { params: { limit: 50 } });
-    renderHistory(response.data?.history || []);
+    const response = await apiClient.get("/api/programs/history", { params });
+    nextCursor = response.data?.next_cursor || null;
+    renderHistory(response.data?.history || [], { append });
   } catch (error) {
     console.error("Failed to load history", error);
-    setHistoryMessage("履歴の取得に失敗しました。");
+    if (append) {
+      updateLoadMoreButton();
+    } else {
+      setHistoryMessage("履歴の取得に失敗しました。");
+    }
   }
 }
 
+/**
+ * サーバーから最新の実行履歴を取得し直し、renderHistory で反映する。
+ */
+async function loadHistory() {
+  if (!elements.historyList) return;
+  nextCursor = null;
+  setHistoryMessage("履歴を読み込んでいます...");
+  await fetchHistoryPage();
+}
+
 /**
  * 履歴モーダルを表示状態にする。
  */
@@ -1,14 +1,56 @@
 import { elements } from "./domElements.js";
+import { state } from "./state.js";
+
+// 段階ごとの所要時間の表示順と表示名
+const TIMING_PHASES = [
+  ["spawn", "起動"],
+  ["environment", "環境構築"],
+  ["exec", "実行"],
+  ["plot_selection", "プロット選択"],
+  ["downsample", "間引き"],
+  ["serialization", "シリアライズ"],
+  ["ipc", "通信"],
+];
+
+/**
+ * サンドボックス内の段階ごとの所要時間を 1 行の説明文にする (管理者向け)。
+ * プールのワーカーでは環境構築を実行の依頼前に済ませているので「事前」と添える。
+ */
+function formatTimings(timings) {
+  const parts = TIMING_PHASES.filter(([key]) => typeof timings[key] === "number").map(([key, label]) => {
+    const text = `${label} ${(timings[key] * 1000).toFixed(1)}ms`;
+    return key === "environment" && timings.mode === "pool" ? `${text} (事前)` : text;
+  });
+  return parts.length ? `内訳: ${parts.join(" / ")}` : "";
+}
+
+/**
+ * サーバー側でグラフの点を間引いた場合に、その内容を 1 行ずつの説明文にする。
+ */
+function formatDownsampleNotes(downsampled = []) {
+  return downsampled
+    .map(
+      (entry) =>
+        `[情報] グラフの点数が多いため ${entry.glyph} を ${entry.original} 点から ${entry.kept} 点に間引いて表示しています。`
+    )
+    .join("\n");
+}
 
 /**
  * 実行結果の標準出力/標準エラーと実行時間を UI に反映する。
- * @param {{execution_time?: number, stdout?: string, stderr?: string}} result
+ * 管理者には、結果に timings があれば段階ごとの内訳も表示する。
+ * @param {{execution_time?: number, stdout?: string, stderr?: string, timings?: Object<string, number|string>, downsampled?: Array<{glyph: string, original: number, kept: number}>}} result
  */
 export function updateLog(result) {
-  const { executionTime, combinedLogOutput } = elements;
+  const { executionTime, executionTimings, combinedLogOutput } = elements;
   executionTime.textContent = result.execution_time
     ? `${result.execution_time.toFixed(3)} 秒`
     : "-";
+  if (executionTimings) {
+    const text = state.currentUser?.is_admin && result.timings ? formatTimings(result.timings) : "";
+    executionTimings.textContent = text;
+    executionTimings.classList.toggle("hidden-control", !text);
+  }
 
   if (!combinedLogOutput) return;
 
@@ -22,6 +64,10 @@ export function updateLog(result) {
   } else if (hasStderr) {
     combined = result.stderr;
   }
+  const notes = formatDownsampleNotes(result.downsampled);
+  if (notes) {
+    combined = combined ? `${combined}\n${notes}` : notes;
+  }
   combinedLogOutput.textContent = combined;
   combinedLogOutput.classList.toggle("error", hasStderr);
 }
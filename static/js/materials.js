@@ -4,6 +4,10 @@ import { apiClient } from "./api.js";
 
 const PASSWORD_PROMPT_MESSAGE =
   "先生に確認しましたか？\n先生に「パスワード」をもらってください";
+// 教材一覧 (各教材の version) を取り直す間隔。教材がサーバー側で更新されたかをこの周期で確認する。
+const MATERIALS_META_MAX_AGE_MS = 30000;
+
+let materialsRefreshTimerId = null;
 
 /**
  * HTML を DOMPurify で無害化してから反映する。
@@ -93,14 +97,42 @@ function renderMaterialsList() {
 }
 
 /**
- * サーバーから教材一覧メタデータを取得する。
+ * 一覧の version と異なる (サーバー側で更新された) 取得済み教材をキャッシュから外す。
+ * 外したものに表示中の教材が含まれていれば true を返す。
+ */
+function dropStaleLessons() {
+  let currentIsStale = false;
+  state.unlockedMaterials.forEach((material, index) => {
+    if (material.version !== state.materialsMeta[index]?.version) {
+      state.unlockedMaterials.delete(index);
+      currentIsStale ||= index === state.currentLessonIndex;
+    }
+  });
+  return currentIsStale;
+}
+
+/**
+ * 教材一覧メタデータを取り直して state と一覧表示に反映する。失敗時は例外をそのまま投げる。
+ * 表示中の教材が更新されていれば取り直して描画し直す。
  */
-export async function fetchMaterialsMeta() {
+async function loadMaterialsMeta({ reloadCurrent = true } = {}) {
+  const response = await apiClient.get("/api/materials");
+  state.materialsMeta = response.data.materials || [];
+  state.materialsCheckedAt = Date.now();
+  const currentIsStale = dropStaleLessons();
+  updateLessonNavigation();
+  renderMaterialsList();
+  if (currentIsStale && reloadCurrent) {
+    await fetchLesson(state.currentLessonIndex);
+  }
+}
+
+/**
+ * サーバーから教材一覧メタデータを取得する。失敗した場合は画面にエラーを表示する。
+ */
+export async function fetchMaterialsMeta(options = {}) {
   try {
-    const response = await apiClient.get("/api/materials");
-    state.materialsMeta = response.data.materials || [];
-    updateLessonNavigation();
-    renderMaterialsList();
+    await loadMaterialsMeta(options);
   } catch (error) {
     console.error(error);
     elements.lessonTitle.textContent = "教材読み込みエラー";
@@ -113,10 +145,30 @@ export async function fetchMaterialsMeta() {
   }
 }
 
+/**
+ * MATERIALS_META_MAX_AGE_MS ごとに教材一覧を確認し、サーバー側で更新された教材を取り直す。
+ * 一覧は ETag で再検証されるので、変わっていなければ 304 で済む。
+ * タブが裏にある間は確認せず、失敗しても表示中の教材はそのまま残す。
+ */
+export function startMaterialsRefresh() {
+  if (materialsRefreshTimerId) return;
+  materialsRefreshTimerId = window.setInterval(() => {
+    if (document.hidden) return;
+    loadMaterialsMeta().catch((error) => console.warn("Materials refresh failed", error));
+  }, MATERIALS_META_MAX_AGE_MS);
+}
+
 /**
  * 指定インデックスの教材をキャッシュから取得、なければ API から取得する。
+ * キャッシュは教材一覧の version と一致する間だけ使う。
  */
 export async function fetchLesson(index, options = {}) {
+  if (Date.now() - state.materialsCheckedAt > MATERIALS_META_MAX_AGE_MS) {
+    // タブが裏にあって定期確認が止まっていた場合など。確認に失敗してもキャッシュした教材を表示する
+    await loadMaterialsMeta({ reloadCurrent: false }).catch((error) =>
+      console.warn("Materials refresh failed", error)
+    );
+  }
   if (state.unlockedMaterials.has(index)) {
     state.currentLessonIndex = index;
     renderLesson(state.unlockedMaterials.get(index));
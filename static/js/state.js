@@ -5,8 +5,10 @@
 export const state = {
   /** @type {import('monaco-editor').editor.IStandaloneCodeEditor | null} */
   editorInstance: null,
-  /** @type {Array<{id: number, title: string}>} */
+  /** @type {Array<{id: number, title: string, version: string}>} */
   materialsMeta: [],
+  /** 教材一覧を最後に取得した時刻 (Date.now()) */
+  materialsCheckedAt: 0,
   /** 取得済み教材（インデックス -> 教材データ）のキャッシュ */
   unlockedMaterials: new Map(),
   /** サーバー上でUNLOCK済みの教材ID集合 */
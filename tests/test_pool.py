@@ -0,0 +1,90 @@
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import main  # noqa: E402
+from main import SandboxPool  # noqa: E402
+
+
+def _wait_idle(pool: SandboxPool, count: int, timeout: float = 10.0) -> None:
+    # 入れ替えは裏のスレッドで行うので、空きの台数が戻るまで待つ
+    deadline = time.monotonic() + timeout
+    while pool.idle_workers < count:
+        assert time.monotonic() < deadline, "replacement worker did not come back"
+        time.sleep(0.01)
+
+
+def _idle_pids(pool: SandboxPool) -> set:
+    with pool._condition:
+        return {worker.process.pid for worker in pool._idle}
+
+
+@pytest.fixture
+def pool():
+    pool = SandboxPool(1, 2, warmup=False)
+    pool.start()
+    yield pool
+    pool.shutdown()
+
+
+def test_worker_is_recycled_after_max_jobs(pool):
+    first = _idle_pids(pool)
+    assert pool.run("print(1)")["stdout"] == "1\n"
+    assert _idle_pids(pool) == first
+    assert pool.run("print(2)")["stdout"] == "2\n"
+    _wait_idle(pool, 1)
+    assert _idle_pids(pool).isdisjoint(first)
+    assert pool.run("print(3)")["stdout"] == "3\n"
+
+
+def test_timed_out_worker_is_replaced(pool, monkeypatch):
+    # CPU 時間の上限は整数秒に切り捨てられるので 1 秒にする
+    monkeypatch.setattr(main, "EXECUTION_TIMEOUT", 1)
+    first = _idle_pids(pool)
+    result = pool.run("while True:\n    pass")
+    assert not result["success"]
+    _wait_idle(pool, 1)
+    assert _idle_pids(pool).isdisjoint(first)
+    assert pool.run("print('ok')")["success"]
+
+
+def test_crashed_worker_is_replaced(pool):
+    first = _idle_pids(pool)
+    with pool._condition:
+        pool._idle[0].process.kill()
+    result = pool.run("print(1)")
+    assert not result["success"]
+    _wait_idle(pool, 1)
+    assert _idle_pids(pool).isdisjoint(first)
+    assert pool.run("print(1)")["success"]
+
+
+def test_acquire_times_out_when_no_worker_is_idle(pool):
+    worker = pool._acquire(1.0)
+    try:
+        start = time.monotonic()
+        assert pool._acquire(0.2) is None
+        assert time.monotonic() - start < 5.0
+    finally:
+        pool._release(worker)
+
+
+def test_shutdown_wakes_waiting_threads(pool):
+    worker = pool._acquire(1.0)
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(pool._acquire(60.0)))
+    waiter.start()
+    time.sleep(0.1)
+    pool.shutdown()
+    waiter.join(5.0)
+    assert not waiter.is_alive()
+    assert acquired == [None]
+    # シャットダウン後に返されたワーカーはプールに戻さずに終了させる
+    pool._release(worker)
+    assert pool.idle_workers == 0
+    assert not worker.process.is_alive()
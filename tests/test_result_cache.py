@@ -0,0 +1,104 @@
+import asyncio
+import secrets
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import main  # noqa: E402
+from main import ExecutionResultCache, execute_code_cached, execution_cache_key  # noqa: E402
+
+
+class _FakeSandbox:
+    """execute_code_async の代わりに、呼ばれた回数を数えて release されるまで結果を返さない。"""
+
+    def __init__(self, success: bool = True) -> None:
+        self.calls = 0
+        self.success = success
+        self.release = asyncio.Event()
+
+    async def __call__(self, code: str) -> dict:
+        self.calls += 1
+        await self.release.wait()
+        return {"success": self.success, "plot": None, "stdout": "1\n", "stderr": "", "execution_time": 0.01}
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    cache = ExecutionResultCache(1024 * 1024, tmp_path / "cache")
+    monkeypatch.setattr(main, "execution_cache", cache)
+    yield cache
+    cache.close()
+
+
+def test_concurrent_runs_share_one_execution(cache, monkeypatch):
+    async def scenario():
+        sandbox = _FakeSandbox()
+        monkeypatch.setattr(main, "execute_code_async", sandbox)
+        requests = [asyncio.create_task(execute_code_cached("print(1)")) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        sandbox.release.set()
+        results = await asyncio.gather(*requests)
+        assert sandbox.calls == 1
+        assert [cached for _, cached in results] == [False, True, True]
+        assert all(result["stdout"] == "1\n" for result, _ in results)
+        # 以降はキャッシュから返り、サンドボックスは使わない
+        result, cached = await execute_code_cached("print(1)")
+        assert cached and result["stdout"] == "1\n"
+        assert sandbox.calls == 1
+        assert not main._inflight_executions
+
+    asyncio.run(scenario())
+
+
+def test_cancelling_the_first_request_does_not_fail_waiters(cache, monkeypatch):
+    async def scenario():
+        sandbox = _FakeSandbox()
+        monkeypatch.setattr(main, "execute_code_async", sandbox)
+        leader = asyncio.create_task(execute_code_cached("print(1)"))
+        await asyncio.sleep(0.05)
+        waiter = asyncio.create_task(execute_code_cached("print(1)"))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        sandbox.release.set()
+        result, cached = await waiter
+        assert cached and result["stdout"] == "1\n"
+        assert leader.cancelled()
+        assert sandbox.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_failed_runs_are_not_cached(cache, monkeypatch):
+    async def scenario():
+        sandbox = _FakeSandbox(success=False)
+        sandbox.release.set()
+        monkeypatch.setattr(main, "execute_code_async", sandbox)
+        for _ in range(2):
+            _, cached = await execute_code_cached("print(1)")
+            assert not cached
+        assert sandbox.calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_disk_tier_survives_restart_and_stays_under_cap(tmp_path):
+    directory = tmp_path / "cache"
+    cache = ExecutionResultCache(1024 * 1024, directory, disk_max_bytes=4096)
+    keys = [execution_cache_key(f"print({i})") for i in range(20)]
+    for i, key in enumerate(keys):
+        # 圧縮しても 1 KB ほど残るよう、ランダムな出力にする
+        cache.put(key, {"success": True, "stdout": f"{i}\n" + secrets.token_hex(1000), "stderr": ""})
+    cache.close()
+
+    files = list(directory.rglob("*.json.gz"))
+    assert 0 < len(files) < len(keys)
+    assert sum(path.stat().st_size for path in files) <= 4096
+    restarted = ExecutionResultCache(1024 * 1024, directory)
+    try:
+        # 最後に書いたものは残っている
+        assert restarted.get(keys[-1])["stdout"].startswith("19\n")
+    finally:
+        restarted.close()
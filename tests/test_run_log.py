@@ -0,0 +1,57 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import database  # noqa: E402
+
+
+@pytest.fixture
+def user_id(monkeypatch, tmp_path):
+    monkeypatch.setattr(database, "DB_PATH", tmp_path / "app.db")
+    database.init_db()
+    yield database.create_user("learner", "password123")
+    database.stop_program_run_writer()
+    database.close_thread_connection()
+
+
+def _stored_runs(user_id: int) -> list:
+    with database._connection("test") as conn:
+        return conn.execute("SELECT id FROM program_runs WHERE user_id = ?", (user_id,)).fetchall()
+
+
+def test_queued_runs_are_listed_before_they_are_written(user_id):
+    # 間隔を長くして、書き込みスレッドがテスト中に書き込まないようにする
+    database.start_program_run_writer(interval=60.0)
+    for i in range(3):
+        database.record_program_run(user_id, f"print({i})", f"{i}\n", "", True, 0.01)
+    assert database.get_run_log_stats()["queued"] == 3
+    assert _stored_runs(user_id) == []
+
+    history = database.list_program_runs_by_user_id(user_id, limit=2, preview_chars=10)
+    assert [run["code_preview"] for run in history] == ["print(2)", "print(1)", "print(0)"]
+    assert all(run["id"] is None for run in history)
+
+    assert database.flush_program_runs() == 3
+    assert database.get_run_log_stats()["queued"] == 0
+    history = database.list_program_runs_by_user_id(user_id, limit=2)
+    assert [run["code"] for run in history] == ["print(2)", "print(1)"]
+    assert all(run["id"] is not None for run in history)
+
+
+def test_stopping_the_writer_writes_the_remaining_runs(user_id):
+    database.start_program_run_writer(interval=60.0)
+    for i in range(5):
+        database.record_program_run(user_id, f"print({i})", f"{i}\n", "", True, 0.01)
+    database.stop_program_run_writer()
+    assert len(_stored_runs(user_id)) == 5
+    stats = database.get_run_log_stats()
+    assert stats["queued"] == 0 and not stats["running"]
+
+
+def test_runs_are_written_directly_without_the_writer(user_id):
+    database.record_program_run(user_id, "print(1)", "1\n", "", True, 0.01)
+    assert len(_stored_runs(user_id)) == 1
+    assert database.get_run_log_stats()["queued"] == 0
@@ -4,21 +4,46 @@
 from __future__ import annotations
 
 import argparse
+import csv
+import gzip
 import json
+import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Iterator
 
 ROOT_DIR = Path(__file__).resolve().parents[1]
 if str(ROOT_DIR) not in sys.path:
     sys.path.insert(0, str(ROOT_DIR))
 
 from database import (  # noqa: E402
+    ARCHIVE_DIR,
+    RETENTION_CHUNK_SIZE,
+    RUN_RETENTION_DAYS,
+    SCHEMA_MIGRATIONS,
+    SESSION_RETENTION_DAYS,
+    archive_program_runs,
+    check_query_plans,
     create_user,
+    create_users_bulk,
+    delete_stale_sessions,
+    delete_unreferenced_blobs,
     delete_user,
+    export_users,
+    get_blob_storage_stats,
+    get_schema_version,
+    hash_password,
+    incremental_vacuum,
     init_db,
+    iter_archived_program_runs,
+    iter_program_runs,
     list_user_programs,
     list_user_unlocks,
     list_users,
+    migrate,
+    rebuild_activity_summaries,
     update_user_password,
 )
 
@@ -38,6 +63,174 @@ def cmd_create_user(args: argparse.Namespace) -> None:
     print(f"Created user '{args.username}' with id {user_id}")
 
 
+_TRUE_VALUES = {"1", "true", "yes", "y", "admin"}
+
+
+def _roster_format(path: Path, fmt: str | None) -> str:
+    if fmt:
+        return fmt
+    return "jsonl" if path.suffix.lower() in (".jsonl", ".ndjson") else "csv"
+
+
+def _read_roster(path: Path, fmt: str) -> Iterator[tuple[int, dict]]:
+    """名簿を (行番号, 行) の形で読む。CSV は見出し行が必要で、行番号はファイル上の行に合わせる。"""
+    with path.open(encoding="utf-8-sig", newline="") as handle:
+        if fmt == "csv":
+            reader = csv.DictReader(handle)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line_number, line in enumerate(handle, start=1):
+            if line.strip():
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError as exc:
+                    row = {"_error": f"invalid JSON: {exc.msg}"}
+                yield line_number, row if isinstance(row, dict) else {"_error": "not a JSON object"}
+
+
+def _validate_roster_row(row: dict, seen: set[str]) -> tuple[dict | None, str | None]:
+    if "_error" in row:
+        return None, row["_error"]
+    username = str(row.get("username") or "").strip()
+    password = str(row.get("password") or "")
+    password_hash = str(row.get("password_hash") or "")
+    if not username:
+        return None, "username is empty"
+    if username in seen:
+        return None, f"username '{username}' appears more than once"
+    if not password and password_hash.count("$") != 2:
+        return None, "password (or an exported password_hash) is required"
+    seen.add(username)
+    is_admin = row.get("is_admin")
+    if not isinstance(is_admin, bool):
+        is_admin = str(is_admin or "").strip().lower() in _TRUE_VALUES
+    return {"username": username, "password": password, "password_hash": password_hash, "is_admin": is_admin}, None
+
+
+def cmd_import_users(args: argparse.Namespace) -> None:
+    fmt = _roster_format(args.file, args.format)
+    started = time.perf_counter()
+    users: list[tuple[int, dict]] = []
+    errors: list[tuple[int, str]] = []
+    seen: set[str] = set()
+    for line_number, row in _read_roster(args.file, fmt):
+        user, error = _validate_roster_row(row, seen)
+        if error is not None:
+            errors.append((line_number, error))
+        else:
+            users.append((line_number, user))
+
+    if args.atomic and errors and not args.dry_run:
+        # 検証で落ちた行が 1 つでもあれば、残りの行も登録しない (ハッシュ計算もしない)
+        for line_number, error in errors:
+            print(f"line {line_number}: {error}", file=sys.stderr)
+        print(f"Imported 0 users, {len(errors)} failed; nothing was imported because of --atomic")
+        sys.exit(1)
+
+    # 平文のパスワードだけを全コアでハッシュする (書き出したハッシュはそのまま使う)
+    to_hash = [user for _, user in users if user["password"]]
+    hash_started = time.perf_counter()
+    workers = args.workers or os.cpu_count() or 1
+    if to_hash:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            hashes = pool.map(
+                hash_password,
+                [user["password"] for user in to_hash],
+                chunksize=max(1, len(to_hash) // (workers * 4)),
+            )
+            for user, password_hash in zip(to_hash, hashes):
+                user["password_hash"] = password_hash
+    hash_seconds = time.perf_counter() - hash_started
+
+    imported = 0
+    insert_started = time.perf_counter()
+    if not args.dry_run and users:
+        results = create_users_bulk((user for _, user in users), atomic=args.atomic)
+        for (line_number, _), (user_id, error) in zip(users, results):
+            if error is not None:
+                errors.append((line_number, error))
+            else:
+                imported += 1
+    insert_seconds = time.perf_counter() - insert_started
+
+    for line_number, error in sorted(errors):
+        print(f"line {line_number}: {error}", file=sys.stderr)
+    total = time.perf_counter() - started
+    rate = len(to_hash) / hash_seconds if hash_seconds > 0 else 0.0
+    action = "Validated" if args.dry_run else "Imported"
+    count = len(users) if args.dry_run else imported
+    print(f"{action} {count} users, {len(errors)} failed, in {total:.2f}s")
+    print(f"  hashing: {len(to_hash)} passwords in {hash_seconds:.2f}s ({rate:.1f}/s, {workers} processes)")
+    print(f"  insert: {insert_seconds:.3f}s (single transaction)")
+    if errors:
+        sys.exit(1)
+
+
+def cmd_export_users(args: argparse.Namespace) -> None:
+    users = export_users(include_password_hash=args.include_password_hash)
+    output = args.output.open("w", encoding="utf-8", newline="") if args.output else sys.stdout
+    try:
+        if args.format == "jsonl":
+            for user in users:
+                output.write(json.dumps(user, ensure_ascii=False) + "\n")
+        else:
+            fields = ["id", "username", "is_admin", "created_at"]
+            if args.include_password_hash:
+                fields.append("password_hash")
+            writer = csv.DictWriter(output, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows({**user, "is_admin": int(user["is_admin"])} for user in users)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    if args.output:
+        print(f"Exported {len(users)} users to {args.output}", file=sys.stderr)
+
+
+_RUN_FIELDS = [
+    "id", "username", "created_at", "success", "execution_time", "cached", "code", "stdout", "stderr", "timings",
+]
+
+
+def cmd_export_runs(args: argparse.Namespace) -> None:
+    started = time.perf_counter()
+    runs = iter_program_runs(
+        usernames=args.username,
+        since=args.since,
+        until=args.until,
+        success=args.success,
+        batch_size=args.batch_size,
+    )
+    use_gzip = args.gzip or (args.output is not None and args.output.suffix == ".gz")
+    if args.output is None:
+        output = gzip.open(sys.stdout.buffer, "wt", encoding="utf-8", newline="") if use_gzip else sys.stdout
+    elif use_gzip:
+        output = gzip.open(args.output, "wt", encoding="utf-8", newline="")
+    else:
+        output = args.output.open("w", encoding="utf-8", newline="")
+    count = 0
+    try:
+        writer = None
+        if args.format == "csv":
+            writer = csv.DictWriter(output, fieldnames=_RUN_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+        for run in runs:
+            if writer is not None:
+                # 段階ごとの所要時間は JSON 文字列として 1 列に入れる。計測していない実行は空欄
+                writer.writerow({**run, "timings": json.dumps(run["timings"]) if run.get("timings") else ""})
+            else:
+                run = {**run, "success": bool(run["success"]), "cached": bool(run["cached"])}
+                output.write(json.dumps(run, ensure_ascii=False) + "\n")
+            count += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - started
+    rate = count / elapsed if elapsed > 0 else 0.0
+    print(f"Exported {count} program runs in {elapsed:.2f}s ({rate:.0f} runs/s)", file=sys.stderr)
+
+
 def cmd_update_password(args: argparse.Namespace) -> None:
     updated = update_user_password(args.username, args.password)
     if not updated:
@@ -64,6 +257,7 @@ def cmd_list_programs(args: argparse.Namespace) -> None:
             "created_at": run["created_at"],
             "success": bool(run["success"]),
             "execution_time": run["execution_time"],
+            "cached": bool(run["cached"]),
             "stdout": run["stdout"],
             "stderr": run["stderr"],
             "code": run["code"],
@@ -80,6 +274,102 @@ def cmd_list_unlocks(args: argparse.Namespace) -> None:
         print(f"material {entry['material_id']} unlocked_at={entry['unlocked_at']}")
 
 
+def cmd_migrate(args: argparse.Namespace) -> None:
+    applied = migrate()
+    for version, description in applied:
+        print(f"applied {version}: {description}")
+    if not applied:
+        print("Schema is up to date.")
+    print(f"schema version {get_schema_version()} (latest {SCHEMA_MIGRATIONS[-1][0]})")
+
+
+def cmd_check_plans(args: argparse.Namespace) -> None:
+    problems = check_query_plans()
+    if not problems:
+        print("All hot queries use an index.")
+        return
+    for problem in problems:
+        print(problem)
+    sys.exit(1)
+
+
+def cmd_storage_stats(args: argparse.Namespace) -> None:
+    stats = get_blob_storage_stats()
+    print(f"{stats['runs']} runs, {stats['blobs']} distinct texts")
+    print(f"logical size: {stats['logical_bytes']} bytes")
+    print(f"deduplicated: {stats['unique_bytes']} bytes")
+    print(f"stored (compressed): {stats['stored_bytes']} bytes")
+    if stats["compression_ratio"] is not None:
+        print(f"compression ratio: {stats['compression_ratio']:.1f}x")
+
+
+def cmd_rebuild_stats(args: argparse.Namespace) -> None:
+    archive_dir = None if args.no_archive else Path(args.archive_dir or ARCHIVE_DIR)
+    if archive_dir is not None and not archive_dir.is_dir():
+        archive_dir = None
+    started = time.perf_counter()
+    result = rebuild_activity_summaries(archive_dir)
+    elapsed = time.perf_counter() - started
+    print(
+        f"Rebuilt activity summaries for {result['users']} users from {result['runs']} program runs "
+        f"({result['archived_runs']} from archives) in {elapsed:.2f}s"
+    )
+
+
+def cmd_retention(args: argparse.Namespace) -> None:
+    result = archive_program_runs(args.days, archive_dir=args.archive_dir, chunk_size=args.chunk_size)
+    print(f"Archived {result['archived']} program runs older than {args.days} days")
+    for month in result["months"]:
+        print(f"  appended to month {month}")
+    # 既定では今回移した実行が参照していた blobs だけを調べる。--sweep-blobs で全件を調べる
+    candidates = None if args.sweep_blobs else result["blob_hashes"]
+    print(f"Deleted {delete_unreferenced_blobs(args.chunk_size, candidates)} unreferenced blobs")
+    print(f"Deleted {delete_stale_sessions(args.session_days, args.chunk_size)} sessions unused for {args.session_days} days")
+    if args.no_vacuum:
+        return
+    vacuum = incremental_vacuum(convert=args.convert_auto_vacuum)
+    if vacuum["full_vacuum"]:
+        print("Ran a full VACUUM to enable incremental vacuum")
+    elif vacuum["conversion_pending"]:
+        print(
+            "Skipped incremental VACUUM: this database predates auto_vacuum=INCREMENTAL. "
+            "Run retention --convert-auto-vacuum once while nobody is using the app to switch it.",
+            file=sys.stderr,
+        )
+    else:
+        print(f"Freed {vacuum['freed_pages']} pages")
+
+
+def cmd_list_archived_programs(args: argparse.Namespace) -> None:
+    shown = 0
+    for run in iter_archived_program_runs(
+        args.archive_dir, username=args.username, since=args.since, until=args.until
+    ):
+        if args.limit is not None and shown >= args.limit:
+            break
+        payload = {
+            "username": run["username"],
+            "created_at": run["created_at"],
+            "success": bool(run["success"]),
+            "execution_time": run["execution_time"],
+            "cached": bool(run["cached"]),
+            "stdout": run["stdout"],
+            "stderr": run["stderr"],
+            "code": run["code"],
+        }
+        print(json.dumps(payload, ensure_ascii=False, indent=2))
+        shown += 1
+    if shown == 0:
+        print("No archived program runs found.")
+
+
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1: {value}")
+    return number
+
+
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description=__doc__)
     sub = parser.add_subparsers(dest="command", required=True)
@@ -92,6 +382,26 @@ def build_parser() -> argparse.ArgumentParser:
     create_parser.add_argument("--admin", action="store_true", help="Create an admin account")
     create_parser.set_defaults(func=cmd_create_user)
 
+    import_parser = sub.add_parser(
+        "import-users", help="Create users from a CSV or JSONL roster (username,password[,is_admin])"
+    )
+    import_parser.add_argument("file", type=Path)
+    import_parser.add_argument("--format", choices=["csv", "jsonl"], default=None, help="Defaults to the file extension")
+    import_parser.add_argument("--workers", type=int, default=None, help="Hashing processes (defaults to all cores)")
+    import_parser.add_argument("--atomic", action="store_true", help="Import nothing if any row fails")
+    import_parser.add_argument("--dry-run", action="store_true", help="Validate and hash without inserting")
+    import_parser.set_defaults(func=cmd_import_users)
+
+    export_parser = sub.add_parser("export-users", help="Write all users as CSV or JSONL")
+    export_parser.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    export_parser.add_argument("--output", type=Path, default=None, help="Defaults to stdout")
+    export_parser.add_argument(
+        "--include-password-hash",
+        action="store_true",
+        help="Include password hashes so the output can be re-imported with import-users",
+    )
+    export_parser.set_defaults(func=cmd_export_users)
+
     update_parser = sub.add_parser("update-password", help="Update an existing user's password")
     update_parser.add_argument("username")
     update_parser.add_argument("password")
@@ -106,17 +416,76 @@ def build_parser() -> argparse.ArgumentParser:
     programs_parser.add_argument("--limit", type=int, default=None)
     programs_parser.set_defaults(func=cmd_list_programs)
 
+    runs_parser = sub.add_parser("export-runs", help="Stream program runs as JSONL or CSV")
+    runs_parser.add_argument("--username", action="append", default=None, help="Repeat to export several users")
+    runs_parser.add_argument("--since", default=None, help="Inclusive, e.g. 2024-04-01")
+    runs_parser.add_argument("--until", default=None, help="Exclusive, e.g. 2024-05-01")
+    success_group = runs_parser.add_mutually_exclusive_group()
+    success_group.add_argument("--succeeded", dest="success", action="store_const", const=True, default=None)
+    success_group.add_argument("--failed", dest="success", action="store_const", const=False)
+    runs_parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    runs_parser.add_argument("--output", type=Path, default=None, help="Defaults to stdout; a .gz name implies --gzip")
+    runs_parser.add_argument("--gzip", action="store_true", help="Compress the output with gzip")
+    runs_parser.add_argument("--batch-size", type=_positive_int, default=500)
+    runs_parser.set_defaults(func=cmd_export_runs)
+
     unlocks_parser = sub.add_parser("list-unlocks", help="Show unlocked materials for a user")
     unlocks_parser.add_argument("username")
     unlocks_parser.set_defaults(func=cmd_list_unlocks)
 
+    sub.add_parser("migrate", help="Apply pending schema migrations").set_defaults(func=cmd_migrate)
+    sub.add_parser(
+        "check-plans", help="Report hot queries whose plan is a full table scan"
+    ).set_defaults(func=cmd_check_plans)
+    sub.add_parser(
+        "storage-stats", help="Show how much the stored program code and output is deduplicated and compressed"
+    ).set_defaults(func=cmd_storage_stats)
+
+    stats_parser = sub.add_parser(
+        "rebuild-stats", help="Recompute the activity summary tables from program runs and unlocks"
+    )
+    stats_parser.add_argument("--archive-dir", type=Path, default=None, help="Defaults to ARCHIVE_DIR")
+    stats_parser.add_argument("--no-archive", action="store_true", help="Ignore runs moved to the archive")
+    stats_parser.set_defaults(func=cmd_rebuild_stats)
+
+    retention_parser = sub.add_parser(
+        "retention", help="Archive old program runs, delete stale sessions and reclaim space"
+    )
+    retention_parser.add_argument("--days", type=int, default=RUN_RETENTION_DAYS, help="Keep runs newer than this")
+    retention_parser.add_argument(
+        "--session-days", type=int, default=SESSION_RETENTION_DAYS, help="Keep sessions used within this"
+    )
+    retention_parser.add_argument("--archive-dir", type=Path, default=None)
+    retention_parser.add_argument("--chunk-size", type=int, default=RETENTION_CHUNK_SIZE)
+    retention_parser.add_argument(
+        "--sweep-blobs",
+        action="store_true",
+        help="Check every blob for references, not just those of the runs archived now (slow)",
+    )
+    retention_parser.add_argument("--no-vacuum", action="store_true", help="Skip incremental VACUUM")
+    retention_parser.add_argument(
+        "--convert-auto-vacuum",
+        action="store_true",
+        help="If needed, run one full VACUUM (locks the whole database) to enable incremental vacuum",
+    )
+    retention_parser.set_defaults(func=cmd_retention)
+
+    archived_parser = sub.add_parser("list-archived-programs", help="Search archived program runs")
+    archived_parser.add_argument("--username", default=None)
+    archived_parser.add_argument("--since", default=None, help="Inclusive, e.g. 2024-04 or 2024-04-01")
+    archived_parser.add_argument("--until", default=None, help="Exclusive, e.g. 2024-05")
+    archived_parser.add_argument("--archive-dir", type=Path, default=None)
+    archived_parser.add_argument("--limit", type=int, default=None)
+    archived_parser.set_defaults(func=cmd_list_archived_programs)
+
     return parser
 
 
 def main(argv: list[str] | None = None) -> None:
-    init_db()
     parser = build_parser()
     args = parser.parse_args(argv)
+    if args.func is not cmd_migrate:
+        init_db()
     args.func(args)
 
 
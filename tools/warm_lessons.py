@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Run every ```python block in lessons/ and store the results in the execution cache."""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from main import (  # noqa: E402
+    EXECUTION_CACHE_DIR,
+    EXECUTION_CACHE_MAX_BYTES,
+    LESSON_WARMUP_CONCURRENCY,
+    ExecutionResultCache,
+    _shutdown_sandbox_pool,
+    warm_lesson_cache,
+)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--cache-dir",
+        default=EXECUTION_CACHE_DIR or None,
+        help="Directory for the on-disk result cache (defaults to EXECUTION_CACHE_DIR)",
+    )
+    parser.add_argument("--concurrency", type=int, default=LESSON_WARMUP_CONCURRENCY)
+    parser.add_argument("--json", action="store_true", help="Print the full report as JSON lines")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = build_parser().parse_args(argv)
+    if not args.cache_dir:
+        print("No cache directory given; results would be lost. Use --cache-dir or EXECUTION_CACHE_DIR.", file=sys.stderr)
+        sys.exit(1)
+    cache = ExecutionResultCache(EXECUTION_CACHE_MAX_BYTES, Path(args.cache_dir))
+    try:
+        report = warm_lesson_cache(cache, concurrency=max(1, args.concurrency))
+    finally:
+        _shutdown_sandbox_pool()
+        cache.close()
+
+    failed = [entry for entry in report if entry["status"] in ("error", "timeout")]
+    if args.json:
+        for entry in report:
+            print(json.dumps(entry, ensure_ascii=False))
+    else:
+        for entry in failed:
+            print(
+                f"[{entry['status']}] material {entry['material_id']} ({entry['title']}) "
+                f"block {entry['block']}: {entry['message']}"
+            )
+        print(f"{len(report)} blocks, {len(report) - len(failed)} ok, {len(failed)} failed")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()